@@ -1,4 +1,4 @@
-from flask import Flask, render_template, request, jsonify, send_from_directory
+from flask import Flask, render_template, request, jsonify, send_from_directory, Response, stream_with_context
 from werkzeug.utils import secure_filename
 import os
 import cv2
@@ -6,12 +6,45 @@ from ultralytics import YOLO
 import base64
 import json
 import csv
-from datetime import datetime
+import io
+import sqlite3
+from datetime import datetime, timedelta
 import threading
 import hashlib
 import tempfile
 import shutil
+import glob
 from contextlib import contextmanager
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, Future, TimeoutError as FuturesTimeoutError
+import queue
+import uuid
+from bisect import bisect_left, bisect_right
+from itertools import islice
+import time
+import atexit
+import signal
+import sys
+import multiprocessing
+from multiprocessing import shared_memory
+import zlib
+import numpy as np
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:  # Opcional: solo para exportar en Parquet/Arrow
+    pa = pq = None
+
+try:
+    import zstandard
+except ImportError:  # Opcional: solo para exportar CSV comprimido con zstd
+    zstandard = None
+
+try:
+    from PIL import Image
+except ImportError:  # Opcional: leer el tamaño sin decodificar (sin él no hay decodificación reducida)
+    Image = None
 
 app = Flask(__name__)
 
@@ -19,10 +52,15 @@ app = Flask(__name__)
 UPLOAD_FOLDER = 'uploads'
 DATA_FOLDER = 'data'
 DATABASE_FOLDER = 'database'
+RESULTS_FOLDER = 'results'
+EXPORTS_FOLDER = 'exports'
 BACKUP_FOLDER = os.path.join(DATA_FOLDER, 'backups')
 PERSISTENCE_FILE = os.path.join(DATA_FOLDER, 'slab_data.json')
 PERSISTENCE_BACKUP = os.path.join(BACKUP_FOLDER, 'slab_data_backup.json')
+STORE_FILE = os.path.join(DATA_FOLDER, 'slab_data.db')  # Almacén SQLite (reemplaza a slab_data.json)
+STORE_BACKUP = os.path.join(BACKUP_FOLDER, 'slab_data_backup.db')
 DATABASE_FILE = os.path.join(DATABASE_FOLDER, 'detecciones_historicas.csv')
+HISTORY_JOURNAL_FILE = os.path.join(DATABASE_FOLDER, 'detecciones_historicas.journal')  # Ediciones/eliminaciones pendientes de compactar
 ALLOWED_EXTENSIONS = {'png', 'jpg', 'jpeg', 'bmp', 'tiff', 'webp'}
 
 # Sistema de bloqueos para evitar condiciones de carrera
@@ -33,21 +71,231 @@ os.makedirs(UPLOAD_FOLDER, exist_ok=True)
 os.makedirs(DATA_FOLDER, exist_ok=True)
 os.makedirs(DATABASE_FOLDER, exist_ok=True)
 os.makedirs(BACKUP_FOLDER, exist_ok=True)
+os.makedirs(RESULTS_FOLDER, exist_ok=True)
+os.makedirs(EXPORTS_FOLDER, exist_ok=True)
 app.config['UPLOAD_FOLDER'] = UPLOAD_FOLDER
-app.config['MAX_CONTENT_LENGTH'] = 16 * 1024 * 1024  # 16MB max
+MAX_CONTENT_MB = float(os.environ.get('SLAB_MAX_CONTENT_MB', 64))  # Máximo por petición (varios archivos o un fragmento)
+app.config['MAX_CONTENT_LENGTH'] = int(MAX_CONTENT_MB * 1024 * 1024)
+
+# Configuración de inferencia por lotes
+DETECT_BATCH_SIZE = int(os.environ.get('SLAB_DETECT_BATCH_SIZE', 8))  # Imágenes por pasada del modelo
+DECODE_WORKERS = int(os.environ.get('SLAB_DECODE_WORKERS', 4))  # Hilos para decodificar imágenes
+DECODED_CACHE_MB = float(os.environ.get('SLAB_DECODED_CACHE_MB', 256))  # Imágenes ya decodificadas en memoria (0 = desactivado)
+DECODE_REDUCED = os.environ.get('SLAB_DECODE_REDUCED', '1') == '1'  # Decodificar JPEG a 1/2, 1/4 u 1/8 si el modelo no necesita más
+
+# Subidas por contenido (sin duplicados)
+UPLOAD_HASH_FOLDER = os.path.join(UPLOAD_FOLDER, 'sha256')  # uploads/sha256/ab/abcdef....jpg
+UPLOAD_CHUNK_SIZE = 1024 * 1024  # Bytes leídos por iteración al recibir un archivo
+UPLOAD_PREDECODE = os.environ.get('SLAB_UPLOAD_PREDECODE', '1') == '1'  # Decodificar en segundo plano tras subir
+# Subidas por fragmentos reanudables (/uploads)
+UPLOAD_SESSIONS_FOLDER = os.path.join(UPLOAD_FOLDER, 'sessions')  # Archivos parciales en curso
+UPLOAD_MAX_FILE_MB = float(os.environ.get('SLAB_UPLOAD_MAX_FILE_MB', 1024))  # Tamaño máximo de un archivo por fragmentos
+UPLOAD_SESSION_CHUNK_MB = float(os.environ.get('SLAB_UPLOAD_SESSION_CHUNK_MB', 4))  # Fragmento propuesto al cliente
+UPLOAD_SESSION_TTL = float(os.environ.get('SLAB_UPLOAD_SESSION_TTL', 24 * 3600))  # Segundos antes de descartar una subida incompleta
+
+# Configuración del planificador de inferencia
+INFERENCE_QUEUE_SIZE = int(os.environ.get('SLAB_INFERENCE_QUEUE_SIZE', 32))  # Solicitudes en espera antes de responder 429
+INFERENCE_WORKERS = int(os.environ.get('SLAB_INFERENCE_WORKERS', 0)) or None  # Hilos dedicados al modelo (por defecto: 1 o uno por proceso del pool; >1 solo con pool)
+INFERENCE_BATCH_WINDOW_MS = float(os.environ.get('SLAB_INFERENCE_BATCH_WINDOW_MS', 25))  # Ventana de agrupación
+INFERENCE_TIMEOUT = float(os.environ.get('SLAB_INFERENCE_TIMEOUT', 60))  # Segundos por solicitud
+INFERENCE_RETRY_AFTER = int(os.environ.get('SLAB_INFERENCE_RETRY_AFTER', 2))  # Segundos sugeridos al cliente
+# Trabajos de detección asíncronos (/detect_jobs)
+JOB_WORKERS = int(os.environ.get('SLAB_JOB_WORKERS', 2))  # Trabajos ejecutándose a la vez
+JOB_MAX_PENDING = int(os.environ.get('SLAB_JOB_MAX_PENDING', 16))  # Trabajos en cola o en ejecución antes de responder 429
+JOB_RESULT_TTL = float(os.environ.get('SLAB_JOB_RESULT_TTL', 600))  # Segundos que se conserva un resultado
+JOB_SSE_HEARTBEAT = 15  # Segundos entre comentarios keep-alive en /events
+# Detección por mosaicos (fotos de alta resolución)
+TILE_SIZE = int(os.environ.get('SLAB_TILE_SIZE', 1024))  # Lado del mosaico en píxeles de la imagen original
+TILE_OVERLAP = float(os.environ.get('SLAB_TILE_OVERLAP', 0.2))  # Fracción de solape entre mosaicos vecinos
+TILE_NMS_IOU = float(os.environ.get('SLAB_TILE_NMS_IOU', 0.5))  # IoU para fusionar cajas entre mosaicos
+TILE_NMS_IOS = float(os.environ.get('SLAB_TILE_NMS_IOS', 0.8))  # Intersección / caja menor (cajas cortadas en bordes)
+
+RESULTS_MAX_MB = float(os.environ.get('SLAB_RESULTS_MAX_MB', 512))  # Tamaño máximo del almacén de imágenes anotadas
+RESULTS_CACHE_MAX_AGE = 365 * 24 * 3600  # Los resultados son inmutables (nombre por contenido)
+IMAGE_MODES = ('base64', 'url', 'none')  # Cómo retornar la imagen anotada en /detect
+# Imágenes derivadas (miniatura / pantalla / original) para listas y vistas previas
+IMAGE_LEVELS = {  # Lado mayor en píxeles de cada nivel (None = original)
+    'thumb': int(os.environ.get('SLAB_THUMB_SIZE', 256)),
+    'screen': int(os.environ.get('SLAB_SCREEN_SIZE', 1600)),
+    'full': None
+}
+DERIVED_FOLDER = os.path.join(UPLOAD_FOLDER, 'derived')  # uploads/derived/<sha256>_<nivel>.jpg
+DERIVED_MAX_MB = float(os.environ.get('SLAB_DERIVED_MAX_MB', 512))  # Tamaño máximo de la caché de derivadas
+DERIVED_JPEG_QUALITY = int(os.environ.get('SLAB_DERIVED_JPEG_QUALITY', 85))
+DEBUG_DETECTIONS = os.environ.get('SLAB_DEBUG_DETECTIONS', '0') == '1'  # Log por cada detección (lento con cientos de cajas)
+
+# Pool de procesos de detección (opcional, para servidores multi-núcleo)
+DETECTOR_POOL_WORKERS = int(os.environ.get('SLAB_POOL_WORKERS', 0))  # 0 = desactivado (modelo en el proceso web)
+DETECTOR_POOL_TORCH_THREADS = int(os.environ.get('SLAB_POOL_TORCH_THREADS', 0))  # 0 = núcleos / procesos
+DETECTOR_POOL_TASK_TIMEOUT = float(os.environ.get('SLAB_POOL_TASK_TIMEOUT', 120))  # Segundos antes de reiniciar un proceso colgado
+DETECTOR_POOL_HEALTH_INTERVAL = float(os.environ.get('SLAB_POOL_HEALTH_INTERVAL', 5))  # Segundos entre revisiones de salud
+DETECTOR_POOL_MAX_LOAD_FAILURES = int(os.environ.get('SLAB_POOL_MAX_LOAD_FAILURES', 3))  # Fallos seguidos al cargar el modelo antes de dar el pool por fallido
+
+# Caché de detecciones (cajas sin filtrar por imagen y modelo)
+DETECTION_CACHE_ENTRIES = int(os.environ.get('SLAB_DETECTION_CACHE_ENTRIES', 512))  # Entradas máximas en memoria
+DETECTION_CACHE_MAX_MB = float(os.environ.get('SLAB_DETECTION_CACHE_MAX_MB', 64))  # Tamaño máximo en memoria
+DETECTION_CACHE_PERSIST = os.environ.get('SLAB_DETECTION_CACHE_PERSIST', '0') == '1'  # Guardar en disco entre reinicios
+DETECTION_CACHE_DISK_ENTRIES = int(os.environ.get('SLAB_DETECTION_CACHE_DISK_ENTRIES', 5000))  # Archivos máximos en disco
+DETECTION_CACHE_FOLDER = os.path.join(DATA_FOLDER, 'detection_cache')
+
+# Histórico CSV de solo-anexar
+HISTORY_COMPACT_OPS = int(os.environ.get('SLAB_HISTORY_COMPACT_OPS', 500))  # Operaciones en el diario que fuerzan compactación
+HISTORY_COMPACT_INTERVAL = float(os.environ.get('SLAB_HISTORY_COMPACT_INTERVAL', 300))  # Segundos entre compactaciones periódicas
+HISTORY_PAGE_SIZE = int(os.environ.get('SLAB_HISTORY_PAGE_SIZE', 100))  # Registros por página en /obtener_datos_historicos
+HISTORY_MAX_PAGE_SIZE = 5000
+EXPORT_CHUNK_ROWS = int(os.environ.get('SLAB_EXPORT_CHUNK_ROWS', 10000))  # Filas por bloque al exportar (memoria acotada)
+PRODUCTION_SHIFTS = os.environ.get('SLAB_SHIFTS', 'A:06-14,B:14-22,C:22-06')  # Turnos "nombre:inicio-fin" (horas)
+
+# Estado persistente en memoria (escritura diferida al almacén)
+PERSIST_FLUSH_INTERVAL = float(os.environ.get('SLAB_PERSIST_FLUSH_INTERVAL', 1.0))  # Segundos para agrupar escrituras (0 = inmediata)
+PERSIST_CHECK_INTERVAL = float(os.environ.get('SLAB_PERSIST_CHECK_INTERVAL', 1.0))  # Segundos entre revisiones de cambios externos
+
+# Backend de inferencia (modelo exportado para CPU)
+INFERENCE_BACKEND = os.environ.get('SLAB_INFERENCE_BACKEND', 'torch')  # torch | onnx | openvino
+INFERENCE_PRECISION = os.environ.get('SLAB_INFERENCE_PRECISION', 'fp32')  # fp32 | fp16 (openvino) | int8
+INFERENCE_IMGSZ = int(os.environ.get('SLAB_INFERENCE_IMGSZ', 640))  # Tamaño de exportación (onnx/openvino); PyTorch usa el imgsz del checkpoint
+INFERENCE_CALIBRATION_DATA = os.environ.get('SLAB_INFERENCE_CALIBRATION_DATA')  # Dataset YAML para INT8 de OpenVINO
+MODELS_FOLDER = os.path.join(DATA_FOLDER, 'models')  # Artefactos exportados, por hash de best.pt
+MODEL_REGISTRY_FOLDER = os.path.join(DATA_FOLDER, 'model_registry')  # Versiones registradas del modelo (<versión>.pt)
+# Arranque por fases (el modelo se carga en segundo plano)
+WARMUP_RUNS = int(os.environ.get('SLAB_WARMUP_RUNS', 2))  # Inferencias sintéticas por proceso antes de estar listo (0 = sin calentamiento)
+WARMUP_SHAPE = (960, 1280)  # Alto x ancho de la imagen sintética (proporción 4:3 de las fotos del patio)
+READY_RETRY_AFTER = 5  # Segundos sugeridos al cliente mientras el modelo carga
+
+# ===== BACKENDS DE INFERENCIA =====
+#
+# best.pt se exporta una sola vez con ultralytics a un runtime optimizado para
+# CPU (ONNX Runtime u OpenVINO) y el artefacto queda en
+# data/models/<md5 de best.pt>/<backend>-<precisión>/ mientras best.pt no
+# cambie. YOLO() carga el artefacto con la misma API y los mismos resultados
+# (boxes.data), así que cajas, caché y mosaicos no distinguen el backend.
+
+INFERENCE_BACKENDS = {
+    'torch': ('fp32',),
+    'onnx': ('fp32', 'int8'),  # int8: cuantización dinámica de ONNX Runtime (sin datos de calibración)
+    'openvino': ('fp32', 'fp16', 'int8')  # int8: NNCF con INFERENCE_CALIBRATION_DATA
+}
+
+def _model_digest(model_path):
+    md5 = hashlib.md5()
+    with open(model_path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b''):
+            md5.update(chunk)
+    return md5.hexdigest()
+
+def exported_model_dir(model_path, backend, precision):
+    return os.path.join(MODELS_FOLDER, _model_digest(model_path)[:16], f"{backend}-{precision}")
+
+def _find_exported_artifact(export_dir, backend):
+    """Archivo .onnx o carpeta *_openvino_model dentro de export_dir (None si no existe)"""
+    pattern = '*.onnx' if backend == 'onnx' else '*_openvino_model'
+    matches = sorted(glob.glob(os.path.join(export_dir, pattern)))
+    return matches[0] if matches else None
+
+def export_model(model_path, backend, precision, imgsz=None):
+    """Exporta best.pt al backend indicado, o reutiliza el artefacto ya exportado, y retorna su ruta"""
+    if backend not in INFERENCE_BACKENDS:
+        raise ValueError(f"Backend no válido: {backend}. Opciones: {list(INFERENCE_BACKENDS)}")
+    if precision not in INFERENCE_BACKENDS[backend]:
+        raise ValueError(f"Precisión {precision} no disponible para {backend}: {list(INFERENCE_BACKENDS[backend])}")
+    if backend == 'torch':
+        return model_path
+    
+    export_dir = exported_model_dir(model_path, backend, precision)
+    artifact = _find_exported_artifact(export_dir, backend)
+    if artifact:
+        return artifact
+    if backend == 'openvino' and precision == 'int8' and not INFERENCE_CALIBRATION_DATA:
+        raise ValueError("INT8 en OpenVINO necesita SLAB_INFERENCE_CALIBRATION_DATA (dataset YAML de calibración)")
+    
+    print(f"📦 Exportando {model_path} a {backend}-{precision}...")
+    started = time.perf_counter()
+    os.makedirs(os.path.dirname(export_dir), exist_ok=True)
+    # Se exporta en una carpeta temporal y se publica con un rename: nunca queda un artefacto a medias
+    work_dir = tempfile.mkdtemp(prefix='.export-', dir=os.path.dirname(export_dir))
+    try:
+        source = os.path.join(work_dir, 'model.pt')
+        shutil.copy2(model_path, source)
+        options = {'imgsz': imgsz or INFERENCE_IMGSZ}
+        if backend == 'onnx':
+            exported = YOLO(source).export(format='onnx', **options)
+            if precision == 'int8':
+                from onnxruntime.quantization import QuantType, quantize_dynamic
+                quantized = os.path.join(work_dir, 'model.int8.tmp')
+                quantize_dynamic(exported, quantized, weight_type=QuantType.QUInt8)
+                os.replace(quantized, exported)
+        else:
+            if precision == 'int8':
+                options.update(int8=True, data=INFERENCE_CALIBRATION_DATA)
+            YOLO(source).export(format='openvino', half=precision == 'fp16', **options)
+        os.remove(source)
+        try:
+            os.replace(work_dir, export_dir)
+        except OSError:
+            # Otro proceso publicó el mismo artefacto mientras exportábamos
+            if not _find_exported_artifact(export_dir, backend):
+                raise
+            shutil.rmtree(work_dir, ignore_errors=True)
+    except Exception:
+        shutil.rmtree(work_dir, ignore_errors=True)
+        raise
+    
+    artifact = _find_exported_artifact(export_dir, backend)
+    print(f"✅ Modelo exportado: {artifact} ({time.perf_counter() - started:.1f}s)")
+    return artifact
+
+def resolve_inference_model(model_path, backend=None, precision=None):
+    """(ruta a cargar con YOLO, backend, precisión) según la configuración
+    
+    Si la exportación falla (p. ej. falta onnxruntime u openvino) se usa best.pt con PyTorch.
+    """
+    backend = backend or INFERENCE_BACKEND
+    precision = precision or INFERENCE_PRECISION
+    if backend == 'torch' or not os.path.exists(model_path):
+        return model_path, 'torch', 'fp32'
+    try:
+        return export_model(model_path, backend, precision), backend, precision
+    except Exception as e:
+        print(f"⚠️ Backend {backend}-{precision} no disponible ({e}); usando PyTorch")
+        return model_path, 'torch', 'fp32'
+
+def model_input_size(model):
+    """Lado de la entrada con la que predice un YOLO ya cargado (imgsz)
+    
+    PyTorch predice con el imgsz de entrenamiento que conserva el checkpoint
+    (model.overrides), no con INFERENCE_IMGSZ; los modelos exportados, con el
+    de sus metadatos, que ultralytics solo conoce tras la primera predicción
+    (hasta entonces, el tamaño con el que se exportan: INFERENCE_IMGSZ).
+    """
+    imgsz = getattr(getattr(model, 'predictor', None), 'imgsz', None) or model.overrides.get('imgsz') or INFERENCE_IMGSZ
+    return int(max(imgsz)) if isinstance(imgsz, (list, tuple)) else int(imgsz)
 
 class BasicSlabDetector:
-    def __init__(self):
+    def __init__(self, load_model=True):
         self.model_path = "best.pt"
         self.model = None
-        self.load_model()
+        self.runtime_path = self.model_path  # Artefacto cargado (best.pt o el modelo exportado)
+        self.backend = 'torch'
+        self.precision = 'fp32'
+        self.model_version = None  # Versión del registro de modelos en uso
+        self.input_size = None  # Lado de entrada del modelo en uso (ver model_input_size)
+        self._swap_lock = threading.Lock()
+        self.pool = None  # DetectorProcessPool cuando el modo multi-proceso está activo
+        self.cache = None  # DetectionCache con las cajas sin filtrar por imagen
+        self.decoded = None  # DecodedImageCache con imágenes ya decodificadas
+        self._model_hash = None
+        self._model_hash_key = None
+        if load_model:
+            self.load_model()
     
     def load_model(self):
         """Carga el modelo YOLO"""
         try:
             if os.path.exists(self.model_path):
-                self.model = YOLO(self.model_path)
-                print(f"✅ Modelo YOLO cargado: {self.model_path}")
+                self.runtime_path, self.backend, self.precision = resolve_inference_model(self.model_path)
+                self.model = YOLO(self.runtime_path, task='detect')
+                self.input_size = model_input_size(self.model)
+                print(f"✅ Modelo YOLO cargado: {self.runtime_path} ({self.backend}-{self.precision})")
             else:
                 print(f"❌ Error: No se encuentra el modelo en {self.model_path}")
                 self.model = None
@@ -55,95 +303,2291 @@ class BasicSlabDetector:
             print(f"❌ Error cargando modelo: {e}")
             self.model = None
     
-    def allowed_file(self, filename):
-        """Verifica si el archivo es válido"""
-        return '.' in filename and filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS
+    def get_model_hash(self):
+        """Hash del archivo del modelo (recalculado solo si el archivo cambia)
+        
+        Con un backend exportado se añade backend y precisión: sus cajas pueden
+        diferir ligeramente de las de PyTorch y no deben mezclarse en la caché.
+        """
+        try:
+            stat = os.stat(self.model_path)
+        except OSError:
+            return None
+        key = (stat.st_mtime_ns, stat.st_size, self.backend, self.precision)
+        if key != self._model_hash_key:
+            self._model_hash = calculate_file_hash(self.model_path)
+            if self._model_hash and self.backend != 'torch':
+                self._model_hash = f"{self._model_hash}:{self.backend}-{self.precision}"
+            self._model_hash_key = key
+        return self._model_hash
+    
+    def _cache_key(self, image_path, factor=1):
+        """Clave de caché (hash de la imagen, hash del modelo) o None si no aplica
+        
+        factor es la reducción con la que se decodifica para el modelo: las cajas
+        de una decodificación reducida no se sirven como si fueran de la completa.
+        """
+        if self.cache is None:
+            return None
+        image_hash = cached_file_hash(image_path)
+        model_hash = self.get_model_hash()
+        if not image_hash or not model_hash:
+            return None
+        return image_hash, model_hash if factor == 1 else f"{model_hash}_r{factor}"
+    
+    def detect_from_cache(self, image_path, confidence=0.60, record_miss=True, log=True):
+        """Detecciones desde la caché (solo refiltrado, sin inferencia) o None si no hay"""
+        key = self._cache_key(image_path, self._inference_decode_factor(image_path)) if self.cache is not None else None
+        cached = self.cache.get(key, record_miss) if key else None
+        if cached is None:
+            return None
+        xyxy, conf = cached
+        if log:
+            print(f"⚡ Caché de detección: {image_path} (refiltrado con conf >= {confidence})")
+        return self._extract_detections(xyxy, conf, confidence, log=log)
+    
+    def model_available(self):
+        """Indica si hay un modelo (local o en el pool de procesos) para detectar"""
+        return self.model is not None or self.pool is not None
+    
+    def install(self, loaded, version):
+        """Pone en uso un modelo ya cargado (ver build_model) y retorna el pool anterior, si lo había
+        
+        Las detecciones en curso terminan con el modelo que tenían; las siguientes
+        usan el nuevo.
+        """
+        with self._swap_lock:
+            previous_pool = self.pool
+            self.model, self.pool = loaded['model'], loaded['pool']
+            self.model_path, self.runtime_path = loaded['model_path'], loaded['runtime_path']
+            self.backend, self.precision = loaded['backend'], loaded['precision']
+            self.input_size = loaded.get('input_size')
+            self.model_version = version
+        return previous_pool
+    
+    def allowed_file(self, filename):
+        """Verifica si el archivo es válido"""
+        return '.' in filename and filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS
+    
+    def detect_slabs(self, image_path, confidence=0.60):
+        """Detecta palanquillas en la imagen"""
+        if not self.model_available():
+            return None, "Modelo YOLO no disponible"
+        
+        cached = self.detect_from_cache(image_path, confidence)
+        if cached is not None:
+            return cached, None
+        
+        # Se decodifica aquí (una vez, reducida si se puede) en vez de pasar la ruta a YOLO:
+        # la misma imagen queda en la caché de decodificadas para dibujar después
+        return self.detect_slabs_batch([image_path], confidence)[0]
+    
+    @staticmethod
+    def _result_to_arrays(result):
+        """Extrae las cajas de un resultado YOLO como arrays numpy (xyxy Nx4, conf N)
+        
+        Usa una sola transferencia al host (boxes.data) en vez de una por caja.
+        """
+        if result is None or result.boxes is None:
+            return np.zeros((0, 4), dtype=np.float32), np.zeros((0,), dtype=np.float32)
+        data = result.boxes.data.cpu().numpy()
+        return data[:, :4], data[:, 4]
+    
+    def _predict_raw(self, images):
+        """Ejecuta el modelo sobre imágenes decodificadas y retorna (xyxy, conf) por imagen"""
+        pool = self.pool  # Una sola lectura: install() puede reemplazarlo entre medias
+        if pool is not None:
+            return pool.predict(images)
+        results = self.model(images, verbose=False)
+        return [self._result_to_arrays(result) for result in results]
+    
+    @staticmethod
+    def _extract_detections(xyxy, confs, confidence, log=True):
+        """Convierte las cajas del modelo en puntos de detección filtrados por confianza
+        
+        Filtro, centros y bbox se calculan con operaciones vectorizadas de numpy.
+        """
+        xyxy = np.asarray(xyxy, dtype=np.float32).reshape(-1, 4)
+        confs = np.asarray(confs, dtype=np.float32).reshape(-1)
+        if log and len(confs):
+            print(f"📊 Detecciones encontradas: {len(confs)}")
+        if log and DEBUG_DETECTIONS:
+            for i, conf in enumerate(confs.tolist()):
+                print(f"   Detección {i+1}: confianza = {conf:.3f}")
+        
+        mask = confs.astype(np.float64) >= confidence
+        boxes = xyxy[mask]
+        kept_confs = confs[mask]
+        # Centro truncado a entero, igual que int((x1 + x2) / 2)
+        centers = ((boxes[:, :2] + boxes[:, 2:]) / 2).astype(np.int64)
+        
+        return [
+            {
+                'x': center_x,
+                'y': center_y,
+                'confidence': conf,
+                'bbox': bbox
+            }
+            for (center_x, center_y), conf, bbox in zip(centers.tolist(), kept_confs.tolist(), boxes.tolist())
+        ]
+    
+    def _decode_image(self, image_path):
+        """Decodifica una imagen desde disco (None si no existe o no es válida)
+        
+        Con caché de imágenes decodificadas el array retornado es de solo lectura.
+        """
+        if self.decoded is not None:
+            return self.decoded.get_or_decode(image_path)
+        if not os.path.exists(image_path):
+            return None
+        return decode_image_file(image_path)
+    
+    def _decode_scaled(self, image_path, min_side, reuse_larger=True):
+        """Decodifica con el menor tamaño cuyo lado mayor sea >= min_side; retorna (imagen, escala)
+        
+        escala convierte coordenadas de la imagen retornada a las del original
+        (1, 2, 4 u 8). Si ya hay en caché una versión más grande se reutiliza en
+        vez de decodificar otra vez (salvo reuse_larger=False, que garantiza la
+        escala pedida). min_side=None decodifica completa.
+        """
+        factor = reduced_decode_factor(image_path, min_side) if DECODE_REDUCED and min_side else 1
+        if self.decoded is None:
+            if not os.path.exists(image_path):
+                return None, 1
+            return decode_image_file(image_path, factor), factor
+        cached = self.decoded.peek_at_least(image_path, factor) if reuse_larger else None
+        if cached is not None:
+            return cached
+        return self.decoded.get_or_decode(image_path, factor), factor
+    
+    def inference_input_size(self):
+        """Lado de entrada del modelo en uso; None si el pool aún no lo informó (se decodifica completa)"""
+        if self.input_size is None and self.pool is not None:
+            self.input_size = self.pool.input_size
+        return self.input_size
+    
+    def _inference_decode_factor(self, image_path):
+        """Reducción con la que se decodifica una imagen para el modelo (1 = completa)"""
+        input_size = self.inference_input_size()
+        return reduced_decode_factor(image_path, input_size) if DECODE_REDUCED and input_size else 1
+    
+    def _decode_for_inference(self, image_path):
+        """Imagen para el modelo: basta con que el lado mayor cubra la entrada del modelo (imgsz)
+        
+        Siempre a la reducción exacta de la clave de caché (nunca una decodificación
+        mayor ya en memoria): las mismas cajas con caché fría o caliente.
+        """
+        return self._decode_scaled(image_path, self.inference_input_size(), reuse_larger=False)
+    
+    def detect_slabs_batch(self, image_paths, confidence=0.60, batch_size=None, log=True):
+        """Detecta palanquillas en varias imágenes con inferencia por lotes
+        
+        Las imágenes de cada lote se decodifican en paralelo (mientras el modelo
+        procesa el lote anterior) y se envían al modelo en una sola pasada.
+        confidence puede ser un umbral único o una lista con un umbral por imagen.
+        Retorna una lista de tuplas (detecciones, error) en el mismo orden que
+        image_paths, con el mismo formato que detect_slabs. log=False silencia
+        los mensajes por lote e imagen (procesamiento masivo).
+        """
+        if not self.model_available():
+            return [(None, "Modelo YOLO no disponible") for _ in image_paths]
+        
+        if isinstance(confidence, (list, tuple)):
+            confidences = list(confidence)
+        else:
+            confidences = [confidence] * len(image_paths)
+        
+        batch_size = max(1, int(batch_size or DETECT_BATCH_SIZE))
+        outputs = [None] * len(image_paths)
+        
+        # Las imágenes ya vistas con este modelo solo se refiltran
+        pending = []
+        for i, image_path in enumerate(image_paths):
+            cached = self.detect_from_cache(image_path, confidences[i], log=log)
+            if cached is not None:
+                outputs[i] = (cached, None)
+            else:
+                pending.append(i)
+        
+        chunks = [pending[start:start + batch_size] for start in range(0, len(pending), batch_size)]
+        
+        if log:
+            print(f"🔍 Procesando {len(image_paths)} imágenes en {len(chunks)} lotes "
+                  f"(batch_size={batch_size}, en caché: {len(image_paths) - len(pending)})")
+            print(f"🎯 Confidence threshold: {confidence}")
+        
+        with ThreadPoolExecutor(max_workers=max(1, DECODE_WORKERS)) as pool:
+            def decode_chunk(chunk):
+                return [pool.submit(self._decode_for_inference, image_paths[i]) for i in chunk]
+            
+            decoding = decode_chunk(chunks[0]) if chunks else []
+            for chunk_index, chunk in enumerate(chunks):
+                images = [future.result() for future in decoding]
+                # Decodificar el siguiente lote mientras el modelo procesa el actual
+                if chunk_index + 1 < len(chunks):
+                    decoding = decode_chunk(chunks[chunk_index + 1])
+                
+                valid = []
+                for i, (image, scale) in zip(chunk, images):
+                    if image is None:
+                        outputs[i] = (None, f"Archivo no encontrado o inválido: {image_paths[i]}")
+                    else:
+                        valid.append((i, image, scale))
+                if not valid:
+                    continue
+                
+                try:
+                    raw_results = self._predict_raw([image for _, image, _ in valid])
+                    for (i, _, scale), (xyxy, conf) in zip(valid, raw_results):
+                        # Cajas en coordenadas del original aunque se haya decodificado reducida
+                        xyxy = np.asarray(xyxy, dtype=np.float32) * scale if scale != 1 else xyxy
+                        # Clave con la escala que vio el modelo
+                        key = self._cache_key(image_paths[i], scale)
+                        if key:
+                            self.cache.put(key, xyxy, conf)
+                        outputs[i] = (self._extract_detections(xyxy, conf, confidences[i], log=log), None)
+                except Exception as e:
+                    error_msg = f"Error procesando lote: {str(e)}"
+                    print(f"❌ {error_msg}")
+                    for i, _, _ in valid:
+                        outputs[i] = (None, error_msg)
+        
+        if log:
+            valid_count = sum(1 for detections, _ in outputs if detections is not None)
+            print(f"✅ Lote completado: {valid_count}/{len(image_paths)} imágenes procesadas")
+        return outputs
+    
+    @staticmethod
+    def _tile_grid(width, height, tile_size, overlap):
+        """Posiciones (x0, y0, x1, y1) de mosaicos solapados que cubren la imagen"""
+        def starts(length):
+            if length <= tile_size:
+                return [0]
+            stride = max(1, int(tile_size * (1 - overlap)))
+            positions = list(range(0, length - tile_size, stride))
+            positions.append(length - tile_size)  # Último mosaico alineado al borde
+            return positions
+        
+        return [
+            (x0, y0, min(x0 + tile_size, width), min(y0 + tile_size, height))
+            for y0 in starts(height)
+            for x0 in starts(width)
+        ]
+    
+    @staticmethod
+    def _merge_boxes(xyxy, confs, iou_threshold, ios_threshold):
+        """NMS entre mosaicos: descarta cajas que solapan con otra de mayor confianza
+        
+        Además del IoU usa intersección sobre la caja menor, para eliminar las
+        cajas recortadas en el borde de un mosaico que quedan dentro de la caja
+        completa detectada en el mosaico vecino.
+        """
+        if len(confs) == 0:
+            return xyxy, confs
+        x1, y1, x2, y2 = xyxy[:, 0], xyxy[:, 1], xyxy[:, 2], xyxy[:, 3]
+        areas = np.maximum(x2 - x1, 0) * np.maximum(y2 - y1, 0)
+        order = np.argsort(-confs, kind='stable')
+        keep = []
+        
+        while order.size:
+            i = order[0]
+            keep.append(i)
+            rest = order[1:]
+            inter_w = np.maximum(0, np.minimum(x2[i], x2[rest]) - np.maximum(x1[i], x1[rest]))
+            inter_h = np.maximum(0, np.minimum(y2[i], y2[rest]) - np.maximum(y1[i], y1[rest]))
+            inter = inter_w * inter_h
+            iou = inter / np.maximum(areas[i] + areas[rest] - inter, 1e-6)
+            ios = inter / np.maximum(np.minimum(areas[i], areas[rest]), 1e-6)
+            order = rest[(iou < iou_threshold) & (ios < ios_threshold)]
+        
+        keep = np.array(keep, dtype=np.int64)
+        return xyxy[keep], confs[keep]
+    
+    def detect_slabs_tiled(self, image_path, confidence=0.60, tile_size=None, overlap=None, include_full=True):
+        """Detección por mosaicos solapados para fotos de alta resolución
+        
+        Divide la imagen en mosaicos de tile_size píxeles con el solape indicado,
+        los procesa por lotes (en paralelo si hay pool de procesos) junto con una
+        pasada de la imagen completa (include_full) para las palanquillas grandes,
+        y fusiona los resultados con NMS entre mosaicos.
+        Retorna (detecciones, error, info) donde info incluye tiempos por etapa.
+        """
+        if not self.model_available():
+            return None, "Modelo YOLO no disponible", None
+        
+        tile_size = max(64, int(tile_size or TILE_SIZE))
+        overlap = min(0.9, max(0.0, float(TILE_OVERLAP if overlap is None else overlap)))
+        timings = {}
+        total_start = time.perf_counter()
+        
+        try:
+            print(f"🧩 Detección por mosaicos: {image_path} (mosaico {tile_size}px, solape {overlap:.0%})")
+            
+            # Las cajas fusionadas se cachean con los parámetros de mosaico en la clave
+            key = self._cache_key(image_path)
+            if key:
+                key = (key[0], f"{key[1]}_t{tile_size}o{int(overlap * 100)}f{int(include_full)}")
+                cached = self.cache.get(key)
+                if cached is not None:
+                    detections = self._extract_detections(*cached, confidence)
+                    timings['total_ms'] = round((time.perf_counter() - total_start) * 1000, 1)
+                    return detections, None, {'cache_hit': True, 'timings': timings}
+            
+            stage_start = time.perf_counter()
+            image = self._decode_image(image_path)
+            if image is None:
+                return None, f"Archivo no encontrado o inválido: {image_path}", None
+            timings['decode_ms'] = round((time.perf_counter() - stage_start) * 1000, 1)
+            
+            stage_start = time.perf_counter()
+            height, width = image.shape[:2]
+            grid = self._tile_grid(width, height, tile_size, overlap)
+            tiles = [image[y0:y1, x0:x1] for x0, y0, x1, y1 in grid]
+            offsets = [(x0, y0) for x0, y0, _, _ in grid]
+            if include_full and len(grid) > 1:
+                tiles.append(image)
+                offsets.append((0, 0))
+            timings['tiling_ms'] = round((time.perf_counter() - stage_start) * 1000, 1)
+            
+            # Inferencia por lotes de mosaicos; con pool de procesos los lotes corren en paralelo
+            stage_start = time.perf_counter()
+            batch_size = max(1, DETECT_BATCH_SIZE)
+            chunks = [tiles[start:start + batch_size] for start in range(0, len(tiles), batch_size)]
+            parallel = self.pool.workers if self.pool is not None else 1
+            if parallel > 1 and len(chunks) > 1:
+                with ThreadPoolExecutor(max_workers=min(parallel, len(chunks))) as pool:
+                    chunk_results = list(pool.map(self._predict_raw, chunks))
+            else:
+                chunk_results = [self._predict_raw(chunk) for chunk in chunks]
+            raw_results = [raw for chunk in chunk_results for raw in chunk]
+            timings['inference_ms'] = round((time.perf_counter() - stage_start) * 1000, 1)
+            
+            stage_start = time.perf_counter()
+            all_boxes = []
+            all_confs = []
+            for (offset_x, offset_y), (xyxy, conf) in zip(offsets, raw_results):
+                if len(conf):
+                    all_boxes.append(np.asarray(xyxy, dtype=np.float32) + np.array([offset_x, offset_y, offset_x, offset_y], dtype=np.float32))
+                    all_confs.append(np.asarray(conf, dtype=np.float32))
+            if all_boxes:
+                merged_xyxy, merged_conf = self._merge_boxes(np.concatenate(all_boxes), np.concatenate(all_confs),
+                                                             TILE_NMS_IOU, TILE_NMS_IOS)
+            else:
+                merged_xyxy, merged_conf = np.zeros((0, 4), dtype=np.float32), np.zeros((0,), dtype=np.float32)
+            if key:
+                self.cache.put(key, merged_xyxy, merged_conf)
+            detections = self._extract_detections(merged_xyxy, merged_conf, confidence)
+            timings['merge_ms'] = round((time.perf_counter() - stage_start) * 1000, 1)
+            timings['total_ms'] = round((time.perf_counter() - total_start) * 1000, 1)
+            
+            print(f"✅ Mosaicos: {len(grid)} ({sum(len(c) for c in all_confs)} cajas antes de fusionar) → "
+                  f"{len(detections)} detecciones válidas en {timings['total_ms']}ms")
+            return detections, None, {
+                'tiles': len(grid),
+                'tile_size': tile_size,
+                'overlap': overlap,
+                'image_size': [width, height],
+                'cache_hit': False,
+                'timings': timings
+            }
+            
+        except Exception as e:
+            error_msg = f"Error en detección por mosaicos: {str(e)}"
+            print(f"❌ {error_msg}")
+            return None, error_msg, None
+    
+    def render_detections(self, image_path, detections, max_side=None):
+        """Dibuja las detecciones sobre la imagen y retorna el array BGR (None si falla)
+        
+        Con max_side la imagen se reduce antes de dibujar (las coordenadas se escalan).
+        """
+        try:
+            # Cargar imagen (copia: se dibuja encima)
+            image, decode_scale = self._decode_scaled(image_path, max_side)
+            if image is None:
+                return None
+            image, scale = resize_to_max_side(image, max_side)
+            scale /= decode_scale
+            image = image.copy()
+            
+            # Dibujar cada detección
+            for i, detection in enumerate(detections):
+                x, y = int(round(detection['x'] * scale)), int(round(detection['y'] * scale))
+                conf = detection['confidence']
+                
+                # Dibujar punto central más grande y visible
+                cv2.circle(image, (x, y), 8, (0, 0, 255), -1)  # Punto rojo sólido
+                cv2.circle(image, (x, y), 10, (255, 255, 255), 2)  # Borde blanco
+                
+                # Dibujar texto de confianza
+                text = f"{i+1}: {conf:.2f}"
+                cv2.putText(image, text, (x-20, y-15), 
+                           cv2.FONT_HERSHEY_SIMPLEX, 0.6, (255, 255, 255), 2)
+                cv2.putText(image, text, (x-20, y-15), 
+                           cv2.FONT_HERSHEY_SIMPLEX, 0.6, (0, 0, 255), 1)
+            
+            return image
+            
+        except Exception as e:
+            print(f"❌ Error dibujando detecciones: {e}")
+            return None
+    
+    def draw_detections(self, image_path, detections, level='full'):
+        """Dibuja las detecciones en la imagen y la retorna como data URL base64"""
+        image = self.render_detections(image_path, detections, IMAGE_LEVELS[level])
+        if image is None:
+            return None
+        
+        # Convertir a base64 para mostrar en web
+        _, buffer = cv2.imencode('.jpg', image)
+        img_str = base64.b64encode(buffer).decode()
+        return f"data:image/jpeg;base64,{img_str}"
+    
+    def save_detections_image(self, image_path, detections, level='full'):
+        """Guarda la imagen anotada en el almacén de resultados y retorna su nombre
+        
+        El nombre se deriva del contenido de la imagen, de las detecciones y del
+        nivel, así que repetir la misma detección reutiliza el archivo sin volver
+        a dibujar.
+        """
+        image_hash = cached_file_hash(image_path)
+        if not image_hash:
+            return None
+        detections_hash = hashlib.md5(json.dumps(detections, sort_keys=True).encode()).hexdigest()
+        level_suffix = '' if level == 'full' else f"_{level}"
+        result_name = f"{image_hash}_{detections_hash[:16]}{level_suffix}.jpg"
+        result_path = os.path.join(RESULTS_FOLDER, result_name)
+        if os.path.exists(result_path):
+            return result_name
+        
+        image = self.render_detections(image_path, detections, IMAGE_LEVELS[level])
+        if image is None:
+            return None
+        ok, buffer = cv2.imencode('.jpg', image)
+        if not ok:
+            return None
+        
+        try:
+            # Escritura atómica para no servir archivos a medio escribir
+            with tempfile.NamedTemporaryFile(dir=RESULTS_FOLDER, suffix='.tmp', delete=False) as temp_file:
+                temp_file.write(buffer.tobytes())
+                temp_filename = temp_file.name
+            os.replace(temp_filename, result_path)
+        except Exception as e:
+            print(f"❌ Error guardando imagen de resultado: {e}")
+            return None
+        
+        prune_results_folder()
+        return result_name
+
+def resize_to_max_side(image, max_side):
+    """Reduce la imagen para que su lado mayor no pase de max_side; retorna (imagen, escala)"""
+    height, width = image.shape[:2]
+    if not max_side or max(height, width) <= max_side:
+        return image, 1.0
+    scale = max_side / max(height, width)
+    size = (max(1, int(round(width * scale))), max(1, int(round(height * scale))))
+    return cv2.resize(image, size, interpolation=cv2.INTER_AREA), scale
+
+def prune_cache_folder(folder, max_mb, label):
+    """Elimina los .jpg menos usados (mtime) si la carpeta supera max_mb"""
+    try:
+        entries = []
+        total = 0
+        for name in os.listdir(folder):
+            if not name.endswith('.jpg'):
+                continue
+            stat = os.stat(os.path.join(folder, name))
+            entries.append((stat.st_mtime, stat.st_size, name))
+            total += stat.st_size
+        
+        limit = max_mb * 1024 * 1024
+        if total <= limit:
+            return
+        for _, size, name in sorted(entries):
+            os.remove(os.path.join(folder, name))
+            total -= size
+            if total <= limit:
+                break
+    except Exception as e:
+        print(f"⚠️ Error limpiando {label}: {e}")
+
+def prune_results_folder():
+    """Elimina las imágenes de resultado más antiguas si el almacén supera RESULTS_MAX_MB"""
+    prune_cache_folder(RESULTS_FOLDER, RESULTS_MAX_MB, 'almacén de resultados')
+
+def detection_image_fields(filepath, detections, image_mode, image_level='full'):
+    """Campos de imagen anotada para la respuesta según image_mode (None si falla el dibujo)
+    
+    - base64: data URL con la imagen completa (compatibilidad)
+    - url: la imagen se guarda en results/ y se retorna su URL cacheable
+    - none: solo coordenadas; el navegador dibuja los puntos sobre la original
+    
+    image_level (thumb / screen / full) limita la resolución de la imagen anotada.
+    """
+    if image_mode == 'none':
+        return {}
+    if image_mode == 'url':
+        result_name = detector.save_detections_image(filepath, detections, image_level)
+        return {'image_url': f"/results/{result_name}"} if result_name else None
+    image_data = detector.draw_detections(filepath, detections, image_level)
+    return {'image_data': image_data} if image_data else None
+
+# ===== CACHÉ DE DETECCIONES =====
+
+class DetectionCache:
+    """Caché LRU de cajas sin filtrar por (hash de imagen, hash de modelo)
+    
+    Cambiar el umbral de confianza sobre una imagen ya procesada es solo un
+    refiltrado en memoria. Opcionalmente persiste cada entrada como .npz en
+    disco para sobrevivir a reinicios.
+    """
+    
+    def __init__(self, max_entries=512, max_bytes=64 * 1024 * 1024, folder=None, max_disk_entries=5000):
+        self.max_entries = max(1, int(max_entries))
+        self.max_bytes = max(1, int(max_bytes))
+        self.folder = folder
+        self.max_disk_entries = max_disk_entries
+        self._entries = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self._stats = {'hits': 0, 'disk_hits': 0, 'misses': 0, 'evictions': 0, 'stores': 0}
+        if self.folder:
+            os.makedirs(self.folder, exist_ok=True)
+    
+    def _disk_path(self, key):
+        return os.path.join(self.folder, f"{key[0]}_{key[1]}.npz")
+    
+    def _insert(self, key, xyxy, conf):
+        """Inserta en memoria y expulsa las entradas menos usadas (requiere el lock)"""
+        if key in self._entries:
+            old_xyxy, old_conf = self._entries.pop(key)
+            self._bytes -= old_xyxy.nbytes + old_conf.nbytes
+        self._entries[key] = (xyxy, conf)
+        self._bytes += xyxy.nbytes + conf.nbytes
+        while self._entries and (len(self._entries) > self.max_entries or self._bytes > self.max_bytes):
+            _, (old_xyxy, old_conf) = self._entries.popitem(last=False)
+            self._bytes -= old_xyxy.nbytes + old_conf.nbytes
+            self._stats['evictions'] += 1
+    
+    def get(self, key, record_miss=True):
+        """Retorna (xyxy, conf) o None (record_miss=False para consultas previas sin contar fallo)"""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+                self._stats['hits'] += 1
+                return entry
+        
+        if self.folder:
+            disk_path = self._disk_path(key)
+            try:
+                with np.load(disk_path) as stored:
+                    entry = (stored['xyxy'], stored['conf'])
+                with self._lock:
+                    self._insert(key, *entry)
+                    self._stats['disk_hits'] += 1
+                return entry
+            except (OSError, KeyError, ValueError):
+                pass
+        
+        if record_miss:
+            with self._lock:
+                self._stats['misses'] += 1
+        return None
+    
+    def put(self, key, xyxy, conf):
+        """Guarda las cajas sin filtrar de una imagen"""
+        xyxy = np.asarray(xyxy, dtype=np.float32).reshape(-1, 4)
+        conf = np.asarray(conf, dtype=np.float32).reshape(-1)
+        with self._lock:
+            self._insert(key, xyxy, conf)
+            self._stats['stores'] += 1
+            stores = self._stats['stores']
+        
+        if self.folder:
+            try:
+                # Escritura atómica: archivo temporal + reemplazo
+                with tempfile.NamedTemporaryFile(dir=self.folder, suffix='.npz', delete=False) as temp_file:
+                    np.savez(temp_file, xyxy=xyxy, conf=conf)
+                    temp_filename = temp_file.name
+                os.replace(temp_filename, self._disk_path(key))
+                if stores % 100 == 0:
+                    self._prune_disk()
+            except Exception as e:
+                print(f"⚠️ Error guardando caché de detección en disco: {e}")
+    
+    def _prune_disk(self):
+        """Elimina los archivos más antiguos si el disco supera el límite"""
+        files = [os.path.join(self.folder, name) for name in os.listdir(self.folder) if name.endswith('.npz')]
+        if len(files) <= self.max_disk_entries:
+            return
+        files.sort(key=os.path.getmtime)
+        for path in files[:len(files) - self.max_disk_entries]:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+    
+    def clear(self):
+        """Vacía la caché en memoria y en disco"""
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
+        if self.folder and os.path.isdir(self.folder):
+            for name in os.listdir(self.folder):
+                if name.endswith('.npz'):
+                    try:
+                        os.remove(os.path.join(self.folder, name))
+                    except OSError:
+                        pass
+    
+    def status(self):
+        """Contadores de aciertos/fallos y ocupación"""
+        with self._lock:
+            stats = dict(self._stats)
+            stats.update({
+                'entries': len(self._entries),
+                'max_entries': self.max_entries,
+                'bytes': self._bytes,
+                'max_bytes': self.max_bytes,
+                'persistent': bool(self.folder)
+            })
+        lookups = stats['hits'] + stats['disk_hits'] + stats['misses']
+        stats['hit_rate'] = round((stats['hits'] + stats['disk_hits']) / lookups, 3) if lookups else 0
+        return stats
+
+_file_hash_memo = OrderedDict()
+_file_hash_memo_lock = threading.Lock()
+
+def cached_file_hash(filepath):
+    """calculate_file_hash memorizado por (ruta, mtime, tamaño) para no releer archivos sin cambios"""
+    try:
+        stat = os.stat(filepath)
+    except OSError:
+        return None
+    key = (os.path.abspath(filepath), stat.st_mtime_ns, stat.st_size)
+    with _file_hash_memo_lock:
+        if key in _file_hash_memo:
+            _file_hash_memo.move_to_end(key)
+            return _file_hash_memo[key]
+    file_hash = calculate_file_hash(filepath)
+    if file_hash:
+        with _file_hash_memo_lock:
+            _file_hash_memo[key] = file_hash
+            while len(_file_hash_memo) > 4096:
+                _file_hash_memo.popitem(last=False)
+    return file_hash
+
+REDUCED_DECODE_FLAGS = {
+    1: cv2.IMREAD_COLOR,
+    2: cv2.IMREAD_REDUCED_COLOR_2,
+    4: cv2.IMREAD_REDUCED_COLOR_4,
+    8: cv2.IMREAD_REDUCED_COLOR_8
+}
+
+def decode_image_file(image_path, factor=1):
+    """Decodifica a 1/factor del tamaño (libjpeg escala en la IDCT: más rápido y menos memoria)
+    
+    Todos estos modos aplican la orientación EXIF, igual que el navegador al
+    mostrar el original, así que las coordenadas coinciden en ambos lados.
+    """
+    return cv2.imread(image_path, REDUCED_DECODE_FLAGS[factor])
+
+def reduced_decode_factor(image_path, min_side):
+    """Mayor factor (8, 4, 2) que deja el lado mayor >= min_side; 1 = decodificación completa
+    
+    Solo lee la cabecera del archivo para conocer el tamaño.
+    """
+    if Image is None or not min_side:
+        return 1
+    try:
+        with Image.open(image_path) as header:
+            longest = max(header.size)
+    except Exception:
+        return 1
+    for factor in (8, 4, 2):
+        if longest / factor >= min_side:
+            return factor
+    return 1
+
+class DecodedImageCache:
+    """Caché LRU de imágenes decodificadas, acotada por bytes
+    
+    La clave es (ruta, mtime, tamaño, factor de reducción), así que un archivo
+    modificado se vuelve a decodificar. Los arrays se guardan como solo
+    lectura: quien necesite dibujar encima debe copiarlos.
+    """
+    
+    def __init__(self, max_bytes):
+        self.max_bytes = max(0, int(max_bytes))
+        self._entries = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self._stats = {'hits': 0, 'misses': 0, 'evictions': 0, 'reduced_decodes': 0, 'decode_ms': 0.0}
+    
+    @staticmethod
+    def _key(image_path, factor=1):
+        try:
+            stat = os.stat(image_path)
+        except OSError:
+            return None
+        return os.path.abspath(image_path), stat.st_mtime_ns, stat.st_size, factor
+    
+    def peek_at_least(self, image_path, factor):
+        """(imagen, factor) ya en caché con resolución >= la de 1/factor, sin decodificar (None si no hay)"""
+        key = self._key(image_path, factor)
+        if key is None:
+            return None
+        with self._lock:
+            for candidate in (8, 4, 2, 1):
+                if candidate > factor:
+                    continue
+                image = self._entries.get(key[:3] + (candidate,))
+                if image is not None:
+                    self._entries.move_to_end(key[:3] + (candidate,))
+                    self._stats['hits'] += 1
+                    return image, candidate
+        return None
+    
+    def get_or_decode(self, image_path, factor=1):
+        key = self._key(image_path, factor)
+        if key is None:
+            return None
+        with self._lock:
+            image = self._entries.get(key)
+            if image is not None:
+                self._entries.move_to_end(key)
+                self._stats['hits'] += 1
+                return image
+            self._stats['misses'] += 1
+        
+        started = time.perf_counter()
+        image = decode_image_file(image_path, factor)
+        with self._lock:
+            self._stats['decode_ms'] += (time.perf_counter() - started) * 1000
+            if factor > 1:
+                self._stats['reduced_decodes'] += 1
+        if image is None or image.nbytes > self.max_bytes:
+            return image
+        image.setflags(write=False)
+        with self._lock:
+            if key not in self._entries:
+                self._entries[key] = image
+                self._bytes += image.nbytes
+            while self._bytes > self.max_bytes:
+                _, old = self._entries.popitem(last=False)
+                self._bytes -= old.nbytes
+                self._stats['evictions'] += 1
+        return image
+    
+    def status(self):
+        with self._lock:
+            return dict(self._stats, decode_ms=round(self._stats['decode_ms'], 1), entries=len(self._entries),
+                        bytes=self._bytes, max_bytes=self.max_bytes, reduced=DECODE_REDUCED)
+
+# ===== POOL DE PROCESOS DE DETECCIÓN =====
+
+def _detector_pool_worker(conn, model_path, torch_threads):
+    """Proceso trabajador: carga el modelo una sola vez y atiende tareas recibidas por conn
+    
+    Las imágenes llegan en un bloque de memoria compartida (solo se envían
+    nombre, forma y desplazamiento); la respuesta son las cajas (xyxy, conf).
+    """
+    try:
+        import torch
+        if torch_threads > 0:
+            torch.set_num_threads(torch_threads)
+        model = YOLO(model_path, task='detect')
+    except Exception as e:
+        conn.send(('load_error', f"Error cargando modelo en proceso {os.getpid()}: {e}"))
+        return
+    
+    conn.send(('ready', os.getpid(), model_input_size(model)))
+    while True:
+        try:
+            message = conn.recv()
+        except (EOFError, OSError):
+            break
+        if message[0] == 'stop':
+            break
+        if message[0] != 'predict':
+            continue
+        
+        _, shm_name, layout = message
+        shm = shared_memory.SharedMemory(name=shm_name)
+        try:
+            images = [np.ndarray(shape, dtype=np.uint8, buffer=shm.buf, offset=offset)
+                      for offset, shape in layout]
+            results = model(images, verbose=False)
+            outputs = [BasicSlabDetector._result_to_arrays(result) for result in results]
+            # Liberar las vistas sobre la memoria compartida antes de cerrarla
+            del images, results
+            conn.send(('ok', outputs))
+        except Exception as e:
+            images = results = None
+            conn.send(('error', str(e)))
+        finally:
+            shm.close()
+
+class DetectorPoolError(Exception):
+    """Fallo de un proceso del pool (caída, timeout o error de inferencia)"""
+
+class DetectorWorkerLost(DetectorPoolError):
+    """El proceso trabajador murió o dejó de responder y debe reemplazarse"""
+
+class DetectorProcessPool:
+    """Pool de N procesos, cada uno con su propia instancia de YOLO
+    
+    Evita el GIL y la contención de hilos de torch en servidores con muchos
+    núcleos. Un hilo de salud reemplaza los procesos caídos sin reiniciar
+    el servidor. Si el modelo no carga en max_load_failures intentos seguidos
+    el pool queda fallido: no se reintenta más y predict falla de inmediato.
+    """
+    
+    def __init__(self, model_path, workers, torch_threads=0, task_timeout=120, health_interval=5, max_load_failures=3):
+        self.model_path = model_path
+        self.workers = max(1, int(workers))
+        self.torch_threads = torch_threads or max(1, (os.cpu_count() or 1) // self.workers)
+        self.task_timeout = task_timeout
+        self.health_interval = health_interval
+        self.max_load_failures = max(1, int(max_load_failures))
+        self._ctx = multiprocessing.get_context('spawn')
+        self._slots = [None] * self.workers
+        self._idle = queue.Queue()
+        self._lock = threading.Lock()
+        self._started = False
+        self._stopping = False
+        self._restarts = 0
+        self._load_failures = 0  # Fallos seguidos al cargar el modelo (se reinicia al quedar uno listo)
+        self.failed = None  # Motivo si el pool dejó de reintentar
+        self.input_size = None  # imgsz del modelo, informado por el primer proceso listo
+    
+    def start(self):
+        """Lanza los procesos trabajadores y el hilo de salud"""
+        with self._lock:
+            if self._started or self._stopping:
+                return
+            for index in range(self.workers):
+                self._spawn(index)
+                self._idle.put(index)
+            self._started = True
+        threading.Thread(target=self._health_loop, name="detector-pool-health", daemon=True).start()
+        atexit.register(self.shutdown)
+        print(f"🧩 Pool de detección iniciado: {self.workers} procesos, {self.torch_threads} hilos torch c/u")
+    
+    def _spawn(self, index):
+        """Crea (o reemplaza) el proceso del slot indicado"""
+        parent_conn, child_conn = self._ctx.Pipe()
+        process = self._ctx.Process(
+            target=_detector_pool_worker,
+            args=(child_conn, self.model_path, self.torch_threads),
+            name=f"slab-detector-{index}",
+            daemon=True
+        )
+        process.start()
+        child_conn.close()
+        self._slots[index] = {'process': process, 'conn': parent_conn, 'ready': False, 'busy': False, 'load_failed': False}
+    
+    def _restart(self, index, reason):
+        """Termina el proceso del slot y lo reemplaza por uno nuevo (requiere el lock)
+        
+        Tras max_load_failures fallos seguidos al cargar el modelo no se reemplaza:
+        el pool queda fallido en vez de recargar YOLO en bucle. Durante el apagado
+        tampoco: shutdown() se encarga de los procesos existentes.
+        """
+        if self._stopping:
+            return
+        slot = self._slots[index]
+        if slot['load_failed']:
+            self._load_failures += 1
+            if self._load_failures >= self.max_load_failures:
+                self.failed = f"El modelo no cargó en {self._load_failures} intentos seguidos: {reason}"
+                print(f"❌ Pool de detección detenido: {self.failed}")
+                return
+        print(f"♻️ Reiniciando proceso de detección {index}: {reason}")
+        try:
+            if slot['process'].is_alive():
+                slot['process'].kill()
+            slot['process'].join(timeout=5)
+            slot['conn'].close()
+        except Exception:
+            pass
+        self._spawn(index)
+        self._restarts += 1
+    
+    def _handle_lifecycle(self, slot, message):
+        """Procesa los avisos de carga del proceso; retorna False si el mensaje es otro"""
+        if message[0] == 'ready':
+            slot['ready'] = True
+            self._load_failures = 0
+            self.input_size = message[2]
+            return True
+        if message[0] == 'load_error':
+            slot['load_failed'] = True
+            slot['load_error'] = message[1]
+            return True
+        return False
+    
+    def _receive(self, slot, timeout):
+        """Espera la respuesta del proceso vigilando que siga vivo"""
+        deadline = time.monotonic() + timeout
+        while True:
+            if slot['conn'].poll(0.25):
+                message = slot['conn'].recv()
+                if self._handle_lifecycle(slot, message):
+                    if slot['load_failed']:
+                        raise DetectorWorkerLost(slot['load_error'])
+                    continue
+                return message
+            if not slot['process'].is_alive():
+                raise DetectorWorkerLost("El proceso de detección terminó inesperadamente")
+            if time.monotonic() > deadline:
+                raise DetectorWorkerLost(f"El proceso de detección no respondió en {timeout}s")
+    
+    @staticmethod
+    def _pack_images(images):
+        """Copia las imágenes a un bloque de memoria compartida y retorna (shm, layout)"""
+        images = [np.ascontiguousarray(image, dtype=np.uint8) for image in images]
+        total = max(1, sum(image.nbytes for image in images))
+        shm = shared_memory.SharedMemory(create=True, size=total)
+        layout = []
+        offset = 0
+        for image in images:
+            view = np.ndarray(image.shape, dtype=np.uint8, buffer=shm.buf, offset=offset)
+            view[...] = image
+            del view
+            layout.append((offset, image.shape))
+            offset += image.nbytes
+        return shm, layout
+    
+    def predict(self, images):
+        """Ejecuta el modelo en un proceso libre y retorna (xyxy, conf) por imagen"""
+        self.start()
+        with self._lock:
+            if self._stopping:
+                raise DetectorPoolError("El pool de detección se está deteniendo")
+            if self.failed:
+                raise DetectorPoolError(self.failed)
+        try:
+            index = self._idle.get(timeout=self.task_timeout)
+        except queue.Empty:
+            raise DetectorPoolError("No hay procesos de detección disponibles")
+        
+        # Bajo el lock: el hilo de salud no puede reiniciar el slot entre tomarlo y marcarlo
+        # ocupado, y un apagado iniciado mientras se esperaba el slot se respeta
+        with self._lock:
+            if self._stopping:
+                self._idle.put(index)
+                raise DetectorPoolError("El pool de detección se está deteniendo")
+            slot = self._slots[index]
+            slot['busy'] = True
+        shm, layout = self._pack_images(images)
+        try:
+            # El primer uso también espera a que el proceso termine de cargar el modelo
+            slot['conn'].send(('predict', shm.name, layout))
+            status, payload = self._receive(slot, self.task_timeout)
+            if status != 'ok':
+                raise DetectorPoolError(payload)
+            return payload
+        except DetectorWorkerLost as e:
+            with self._lock:
+                self._restart(index, str(e))
+            raise
+        except (EOFError, OSError) as e:
+            with self._lock:
+                self._restart(index, str(e))
+            raise DetectorWorkerLost(f"Conexión con el proceso de detección perdida: {e}")
+        finally:
+            shm.close()
+            shm.unlink()
+            self._slots[index]['busy'] = False
+            self._idle.put(index)
+    
+    def _health_loop(self):
+        """Reemplaza procesos caídos mientras están libres"""
+        while not self._stopping:
+            time.sleep(self.health_interval)
+            with self._lock:
+                if self._stopping:
+                    break
+                if self.failed:
+                    break
+                for index, slot in enumerate(self._slots):
+                    if slot and not slot['busy'] and not slot['process'].is_alive():
+                        # Leer lo que dejó el proceso antes de morir (¿llegó a cargar el modelo?)
+                        try:
+                            while slot['conn'].poll():
+                                self._handle_lifecycle(slot, slot['conn'].recv())
+                        except (EOFError, OSError):
+                            pass
+                        reason = slot.get('load_error') or f"código de salida {slot['process'].exitcode}"
+                        self._restart(index, reason)
+                        if self.failed:
+                            break
+    
+    def drain_and_shutdown(self, timeout=None):
+        """Espera a que terminen las tareas en curso (sin aceptar nuevas) y detiene los procesos"""
+        deadline = time.monotonic() + (timeout if timeout is not None else self.task_timeout)
+        for _ in range(self.workers):
+            try:
+                self._idle.get(timeout=max(0.0, deadline - time.monotonic()))
+            except queue.Empty:
+                break
+        self.shutdown()
+    
+    def shutdown(self):
+        """Detiene los procesos trabajadores"""
+        with self._lock:
+            self._stopping = True
+        for slot in self._slots:
+            if not slot:
+                continue
+            try:
+                slot['conn'].send(('stop',))
+                slot['process'].join(timeout=2)
+                if slot['process'].is_alive():
+                    slot['process'].kill()
+            except Exception:
+                pass
+    
+    def status(self):
+        """Estado de cada proceso del pool"""
+        return {
+            'workers': self.workers,
+            'torch_threads': self.torch_threads,
+            'restarts': self._restarts,
+            'started': self._started,
+            'failed': self.failed,
+            'input_size': self.input_size,
+            'processes': [
+                {
+                    'pid': slot['process'].pid,
+                    'alive': slot['process'].is_alive(),
+                    'ready': slot['ready'],
+                    'busy': slot['busy']
+                }
+                for slot in self._slots if slot
+            ]
+        }
+
+# Instancia global
+# El modelo (o el pool de procesos) se carga en segundo plano con
+# load_and_warm_model; importar el módulo no carga nada.
+_is_main_process = multiprocessing.parent_process() is None
+detector = BasicSlabDetector(load_model=False)
+detector.cache = DetectionCache(
+    max_entries=DETECTION_CACHE_ENTRIES,
+    max_bytes=DETECTION_CACHE_MAX_MB * 1024 * 1024,
+    folder=DETECTION_CACHE_FOLDER if DETECTION_CACHE_PERSIST else None,
+    max_disk_entries=DETECTION_CACHE_DISK_ENTRIES
+)
+if DECODED_CACHE_MB > 0:
+    detector.decoded = DecodedImageCache(DECODED_CACHE_MB * 1024 * 1024)
+
+# ===== ARRANQUE POR FASES =====
+
+class StartupTracker:
+    """Fases del arranque: pending → loading → warming_up → ready (o error)
+    
+    El servidor HTTP atiende desde el primer momento; el modelo se carga y se
+    calienta en un hilo de fondo. /ready responde 200 solo en la fase 'ready'.
+    También registra el tiempo hasta la primera detección exitosa.
+    """
+    
+    def __init__(self):
+        self._started = time.monotonic()
+        self._lock = threading.Lock()
+        self._ready = threading.Event()
+        self._thread = None
+        self.phase = 'pending'
+        self.info = {'load_s': None, 'warmup_ms': None, 'ready_s': None, 'first_detect_s': None, 'error': None}
+    
+    def elapsed(self):
+        """Segundos desde que se importó el módulo"""
+        return round(time.monotonic() - self._started, 2)
+    
+    def start(self, target):
+        """Lanza target(tracker) en segundo plano una sola vez (idempotente)"""
+        with self._lock:
+            if self._thread is not None:
+                return
+            self._thread = threading.Thread(target=self.run, args=(target,), name='model-startup', daemon=True)
+        self._thread.start()
+    
+    def run(self, target):
+        """Ejecuta target(tracker) en el hilo actual registrando un fallo como fase 'error'
+        
+        Igual que start(), solo tiene efecto la primera vez.
+        """
+        with self._lock:
+            if self._thread is not None and self._thread is not threading.current_thread():
+                return
+            self._thread = threading.current_thread()
+        try:
+            target(self)
+        except Exception as e:
+            print(f"❌ Error en el arranque del modelo: {e}")
+            self.set_phase('error', error=str(e))
+    
+    def set_phase(self, phase, **info):
+        with self._lock:
+            self.phase = phase
+            self.info.update(info)
+        if phase == 'ready':
+            self._ready.set()
+    
+    @property
+    def ready(self):
+        return self._ready.is_set()
+    
+    def wait(self, timeout=None):
+        return self._ready.wait(timeout)
+    
+    def record_detection(self):
+        """Registra la primera detección exitosa desde el arranque"""
+        with self._lock:
+            if self.info['first_detect_s'] is not None:
+                return
+            self.info['first_detect_s'] = self.elapsed()
+        print(f"⏱️ Primera detección exitosa a los {self.info['first_detect_s']}s del arranque")
+    
+    def status(self):
+        with self._lock:
+            return {'phase': self.phase, 'ready': self.ready, 'uptime_s': self.elapsed(), **self.info}
+
+startup = StartupTracker()
+
+def build_model(model_path):
+    """Carga model_path con el backend configurado, sin ponerlo en uso
+    
+    Retorna el dict que espera BasicSlabDetector.install: modelo local o pool
+    de procesos ya arrancado, rutas, backend y precisión.
+    """
+    if not os.path.exists(model_path):
+        raise RuntimeError(f"Modelo no disponible: {model_path}")
+    # La exportación (si hace falta) se hace una vez aquí; los procesos del pool solo cargan el artefacto
+    runtime_path, backend, precision = resolve_inference_model(model_path)
+    model = pool = None
+    if DETECTOR_POOL_WORKERS > 0:
+        pool = DetectorProcessPool(
+            runtime_path,
+            DETECTOR_POOL_WORKERS,
+            torch_threads=DETECTOR_POOL_TORCH_THREADS,
+            task_timeout=DETECTOR_POOL_TASK_TIMEOUT,
+            health_interval=DETECTOR_POOL_HEALTH_INTERVAL,
+            max_load_failures=DETECTOR_POOL_MAX_LOAD_FAILURES
+        )
+        pool.start()
+    else:
+        model = YOLO(runtime_path, task='detect')
+        print(f"✅ Modelo YOLO cargado: {runtime_path} ({backend}-{precision})")
+    # En modo pool el tamaño lo informa cada proceso al cargar (pool.input_size)
+    return {'model': model, 'pool': pool, 'model_path': model_path, 'runtime_path': runtime_path,
+            'backend': backend, 'precision': precision, 'input_size': model_input_size(model) if model else None}
+
+def warm_up_model(loaded, runs=None):
+    """Inferencias sintéticas sobre un modelo cargado; retorna los milisegundos empleados
+    
+    Paga de antemano la inicialización de kernels y memoria que si no pagaría la
+    primera /detect real; en modo pool se calienta cada proceso.
+    """
+    runs = WARMUP_RUNS if runs is None else runs
+    started = time.perf_counter()
+    image = np.random.default_rng(0).integers(0, 256, (*WARMUP_SHAPE, 3), dtype=np.uint8)
+    pool = loaded['pool']
+    # Los procesos libres se atienden en orden, así que N pasadas seguidas reparten una por proceso
+    for _ in range(runs * (pool.workers if pool else 1)):
+        if pool:
+            pool.predict([image])
+        else:
+            loaded['model']([image], verbose=False)
+    return round((time.perf_counter() - started) * 1000, 1)
+
+def load_and_warm_model(tracker=startup):
+    """Carga la versión activa del registro (o best.pt), la calienta y la pone en uso"""
+    tracker.set_phase('loading')
+    started = time.perf_counter()
+    record = model_registry.boot_version(detector.model_path)
+    loaded = build_model(record['path'] if record else detector.model_path)
+    load_s = round(time.perf_counter() - started, 2)
+    
+    tracker.set_phase('warming_up', load_s=load_s)
+    warmup_ms = warm_up_model(loaded)
+    detector.install(loaded, record['version'] if record else None)
+    
+    tracker.set_phase('ready', warmup_ms=warmup_ms, ready_s=tracker.elapsed())
+    print(f"✅ Modelo {detector.model_version or detector.model_path} listo a los {tracker.info['ready_s']}s "
+          f"del arranque (carga {load_s}s, calentamiento {warmup_ms}ms)")
+
+# ===== REGISTRO DE MODELOS =====
+
+class ModelRegistry:
+    """Versiones del modelo (archivo inmutable + md5) y cambio en caliente sin reiniciar
+    
+    Cada versión se copia a data/model_registry/<versión>.pt y se anota en la
+    tabla `models` del almacén; la versión activa y la anterior se guardan en
+    meta. activate() carga, exporta y calienta la versión en un hilo de fondo
+    mientras el modelo actual sigue atendiendo, y después la instala en el
+    detector de una sola vez; rollback() vuelve a la versión anterior.
+    
+    Al arrancar, un best.pt con contenido nuevo se registra y se activa (el
+    flujo de siempre: reemplazar best.pt y reiniciar sigue funcionando).
+    """
+    
+    ACTIVE_KEY = '_active_model'
+    PREVIOUS_KEY = '_previous_model'
+    
+    def __init__(self, store, folder):
+        self.store = store
+        self.folder = folder
+        self._switch_lock = threading.Lock()  # Un cambio de modelo a la vez
+        self._switch = {'state': 'idle', 'target': None, 'error': None, 'started_at': None, 'finished_at': None}
+    
+    def active_version(self):
+        return self.store.get_meta(self.ACTIVE_KEY)
+    
+    def previous_version(self):
+        return self.store.get_meta(self.PREVIOUS_KEY)
+    
+    def get(self, version):
+        return self.store.get_model(version)
+    
+    def list(self):
+        active = self.active_version()
+        return [dict(record, active=record['version'] == active) for record in self.store.list_models()]
+    
+    def register(self, source_path, version=None, notes=None, move=False):
+        """Registra el archivo como nueva versión; retorna (registro, creado)
+        
+        Si ese mismo contenido (md5) ya estaba registrado se retorna la versión existente.
+        """
+        digest = _model_digest(source_path)
+        existing = self.store.find_model_by_hash(digest)
+        if existing:
+            if not os.path.exists(existing['path']):
+                # El archivo de la versión se perdió: se restaura con este mismo contenido
+                os.makedirs(self.folder, exist_ok=True)
+                (os.replace if move else shutil.copy2)(source_path, existing['path'])
+            elif move:
+                os.remove(source_path)
+            return existing, False
+        
+        if version is None:
+            count = len(self.store.list_models())
+            version = next(f"v{n}" for n in range(count + 1, count + 1000) if not self.store.get_model(f"v{n}"))
+        if not version or secure_filename(version) != version:
+            raise ValueError(f"Versión no válida: {version!r} (solo letras, números, '.', '-' y '_')")
+        if self.store.get_model(version):
+            raise ValueError(f"La versión {version} ya existe")
+        
+        os.makedirs(self.folder, exist_ok=True)
+        path = os.path.join(self.folder, f"{version}.pt")
+        if move:
+            os.replace(source_path, path)
+        else:
+            temp_path = path + '.tmp'
+            shutil.copy2(source_path, temp_path)
+            os.replace(temp_path, path)
+        record = self.store.add_model(version, path, digest, os.path.getsize(path), notes)
+        print(f"📒 Modelo registrado: {version} ({digest[:12]}, {record['size'] / 1024 / 1024:.1f} MB)")
+        return record, True
+    
+    def boot_version(self, default_path):
+        """Versión a cargar al arrancar (registra best.pt si su contenido es nuevo)"""
+        default = None
+        if os.path.exists(default_path):
+            default, created = self.register(default_path, notes=f"{os.path.basename(default_path)} al arrancar")
+            if created or not self.active_version():
+                self._set_active(default['version'])
+        active = self.store.get_model(self.active_version() or '')
+        if active and not os.path.exists(active['path']) and default:
+            print(f"⚠️ Falta el archivo de la versión activa {active['version']}; se usa {default['version']}")
+            self._set_active(default['version'])
+            active = default
+        return active
+    
+    def _set_active(self, version):
+        current = self.active_version()
+        if current and current != version:
+            self.store.set_meta(self.PREVIOUS_KEY, current)
+        self.store.set_meta(self.ACTIVE_KEY, version)
+    
+    def activate(self, version):
+        """Empieza a cambiar a `version` en segundo plano
+        
+        Lanza KeyError si la versión no existe y retorna False si ya hay un cambio en curso.
+        """
+        record = self.store.get_model(version)
+        if record is None:
+            raise KeyError(version)
+        if not self._switch_lock.acquire(blocking=False):
+            return False
+        self._switch = {'state': 'loading', 'target': version, 'error': None,
+                        'started_at': datetime.now().isoformat(), 'finished_at': None}
+        threading.Thread(target=self._activate, args=(record,), name='model-switch', daemon=True).start()
+        return True
+    
+    def rollback(self):
+        """Vuelve a la versión activa anterior (False si no hay o si ya hay un cambio en curso)"""
+        previous = self.previous_version()
+        if not previous or not self.store.get_model(previous):
+            return False
+        return self.activate(previous)
+    
+    def _activate(self, record):
+        previous_pool = None
+        loaded = None
+        installed = False
+        try:
+            started = time.perf_counter()
+            loaded = build_model(record['path'])
+            self._switch['state'] = 'warming_up'
+            warm_up_model(loaded)
+            previous_pool = detector.install(loaded, record['version'])
+            installed = True
+            self._set_active(record['version'])
+            self._switch.update(state='done', finished_at=datetime.now().isoformat())
+            print(f"🔁 Modelo cambiado en caliente a {record['version']} ({time.perf_counter() - started:.1f}s)")
+        except Exception as e:
+            print(f"❌ Error cambiando al modelo {record['version']}: {e}")
+            self._switch.update(state='error', error=str(e), finished_at=datetime.now().isoformat())
+            # El pool del modelo que no llegó a ponerse en uso se detiene (si no, sus procesos quedan vivos)
+            if loaded and loaded['pool'] is not None and not installed:
+                loaded['pool'].shutdown()
+        finally:
+            self._switch_lock.release()
+        if previous_pool is not None:
+            # El pool anterior termina sus tareas en curso antes de cerrarse
+            previous_pool.drain_and_shutdown()
+    
+    def status(self):
+        return {
+            'active': self.active_version(),
+            'previous': self.previous_version(),
+            'in_use': detector.model_version,
+            'switch': dict(self._switch)
+        }
+
+# ===== PLANIFICADOR DE INFERENCIA =====
+
+class SchedulerFullError(Exception):
+    """La cola de inferencia está llena (backpressure)"""
+
+class SchedulerTimeoutError(Exception):
+    """La solicitud no se completó dentro del tiempo límite"""
+
+class _InferenceRequest:
+    """Solicitud encolada: una o varias imágenes con su umbral de confianza
+    
+    Si call está definido, la solicitud es una tarea exclusiva (p. ej. detección
+    por mosaicos) que el hilo trabajador ejecuta tal cual, sin agrupar.
+    """
+    
+    def __init__(self, image_paths, confidence, batch_size=None, call=None):
+        self.image_paths = list(image_paths)
+        self.confidence = confidence
+        self.batch_size = batch_size
+        self.call = call
+        self.future = Future()
+        self.enqueued_at = time.monotonic()
+
+class InferenceScheduler:
+    """Cola acotada con hilos dedicados al modelo que agrupan solicitudes en micro-lotes
+    
+    Los hilos de Flask nunca llaman al modelo directamente: encolan la solicitud
+    y esperan el resultado. Cada hilo trabajador toma la primera solicitud de la
+    cola y espera hasta batch_window_ms por otras para ejecutarlas juntas en una
+    sola pasada del modelo (hasta max_batch imágenes).
+    """
+    
+    def __init__(self, detector, queue_size=32, workers=1, batch_window_ms=25, max_batch=8):
+        self.detector = detector
+        self.workers = max(1, int(workers))
+        self.batch_window = max(0.0, float(batch_window_ms)) / 1000.0
+        self.max_batch = max(1, int(max_batch))
+        self._queue = queue.Queue(maxsize=max(1, int(queue_size)))
+        self._threads = []
+        self._lock = threading.Lock()
+        self._stats = {
+            'submitted': 0,
+            'completed': 0,
+            'rejected': 0,
+            'timed_out': 0,
+            'batches': 0,
+            'images': 0
+        }
+    
+    def _ensure_started(self):
+        """Arranca los hilos trabajadores en el primer uso"""
+        with self._lock:
+            if self._threads:
+                return
+            for i in range(self.workers):
+                thread = threading.Thread(target=self._worker_loop, name=f"inference-worker-{i}", daemon=True)
+                thread.start()
+                self._threads.append(thread)
+            print(f"🧵 Planificador de inferencia iniciado: {self.workers} hilo(s), "
+                  f"ventana {self.batch_window * 1000:.0f}ms, lote máx {self.max_batch}")
+    
+    def submit(self, image_paths, confidence, batch_size=None, timeout=None):
+        """Encola imágenes y espera sus resultados (lista de tuplas (detecciones, error))
+        
+        Lanza SchedulerFullError si la cola está llena y SchedulerTimeoutError si
+        no hay resultado antes de timeout segundos.
+        """
+        return self._enqueue_and_wait(_InferenceRequest(image_paths, confidence, batch_size), timeout)
+    
+    def run(self, function, *args, timeout=None, **kwargs):
+        """Ejecuta function(*args, **kwargs) en un hilo del modelo y espera su resultado"""
+        call = lambda: function(*args, **kwargs)
+        return self._enqueue_and_wait(_InferenceRequest([], None, call=call), timeout)
+    
+    def _enqueue_and_wait(self, request_item, timeout):
+        """Encola la solicitud respetando el límite de la cola y espera el resultado"""
+        self._ensure_started()
+        try:
+            self._queue.put_nowait(request_item)
+        except queue.Full:
+            with self._lock:
+                self._stats['rejected'] += 1
+            raise SchedulerFullError("Cola de inferencia llena")
+        
+        with self._lock:
+            self._stats['submitted'] += 1
+        
+        try:
+            return request_item.future.result(timeout=timeout)
+        except FuturesTimeoutError:
+            # Si aún no empezó, se descarta sin ocupar al modelo
+            request_item.future.cancel()
+            with self._lock:
+                self._stats['timed_out'] += 1
+            raise SchedulerTimeoutError(f"Sin resultado tras {timeout}s")
+    
+    def detect(self, image_path, confidence, timeout=None):
+        """Equivalente encolado de detector.detect_slabs"""
+        return self.submit([image_path], confidence, timeout=timeout)[0]
+    
+    def _collect_batch(self):
+        """Toma la primera solicitud y agrupa las que lleguen dentro de la ventana"""
+        batch = [self._queue.get()]
+        if batch[0].call is not None:
+            return batch
+        image_count = len(batch[0].image_paths)
+        deadline = time.monotonic() + self.batch_window
+        
+        while image_count < self.max_batch:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                request_item = self._queue.get(timeout=remaining)
+            except queue.Empty:
+                break
+            batch.append(request_item)
+            image_count += len(request_item.image_paths)
+        return batch
+    
+    def _worker_loop(self):
+        """Bucle del hilo trabajador: ejecuta micro-lotes contra el detector"""
+        while True:
+            batch = self._collect_batch()
+            # Descartar solicitudes canceladas por timeout antes de empezar
+            active = [item for item in batch if item.future.set_running_or_notify_cancel()]
+            calls = [item for item in active if item.call is not None]
+            active = [item for item in active if item.call is None]
+            
+            for item in calls:
+                try:
+                    item.future.set_result(item.call())
+                except Exception as e:
+                    print(f"❌ Error en tarea de inferencia: {e}")
+                    item.future.set_exception(e)
+                with self._lock:
+                    self._stats['completed'] += 1
+            
+            if not active:
+                continue
+            
+            image_paths = []
+            confidences = []
+            for item in active:
+                image_paths.extend(item.image_paths)
+                confidences.extend([item.confidence] * len(item.image_paths))
+            
+            batch_size = active[0].batch_size if len(active) == 1 and active[0].batch_size else self.max_batch
+            
+            try:
+                outputs = self.detector.detect_slabs_batch(image_paths, confidences, batch_size)
+            except Exception as e:
+                print(f"❌ Error en hilo de inferencia: {e}")
+                for item in active:
+                    item.future.set_exception(e)
+                continue
+            
+            offset = 0
+            for item in active:
+                count = len(item.image_paths)
+                item.future.set_result(outputs[offset:offset + count])
+                offset += count
+            
+            with self._lock:
+                self._stats['completed'] += len(active)
+                self._stats['batches'] += 1
+                self._stats['images'] += len(image_paths)
+    
+    def status(self):
+        """Estado de la cola y contadores acumulados"""
+        with self._lock:
+            stats = dict(self._stats)
+        stats.update({
+            'queue_depth': self._queue.qsize(),
+            'queue_size': self._queue.maxsize,
+            'workers': self.workers,
+            'batch_window_ms': self.batch_window * 1000,
+            'max_batch': self.max_batch,
+            'avg_batch_images': round(stats['images'] / stats['batches'], 2) if stats['batches'] else 0
+        })
+        return stats
+
+def inference_worker_threads():
+    """Hilos del planificador: sin pool de procesos, uno solo
+    
+    El predictor de un objeto YOLO no es seguro entre hilos, así que varios
+    hilos sobre el modelo del proceso web se rechazan (se usa 1); para
+    paralelizar está el pool, con un modelo por proceso.
+    """
+    if DETECTOR_POOL_WORKERS > 0:
+        return INFERENCE_WORKERS or DETECTOR_POOL_WORKERS
+    if INFERENCE_WORKERS and INFERENCE_WORKERS > 1 and _is_main_process:
+        print(f"⚠️ SLAB_INFERENCE_WORKERS={INFERENCE_WORKERS} ignorado: sin pool de procesos (SLAB_POOL_WORKERS) "
+              f"el modelo no admite predicciones concurrentes, se usa 1 hilo")
+    return 1
+
+scheduler = InferenceScheduler(
+    detector,
+    queue_size=INFERENCE_QUEUE_SIZE,
+    workers=inference_worker_threads(),
+    batch_window_ms=INFERENCE_BATCH_WINDOW_MS,
+    max_batch=DETECT_BATCH_SIZE
+)
+
+def scheduler_busy_response(error):
+    """Respuesta HTTP de backpressure con Retry-After"""
+    if isinstance(error, SchedulerFullError):
+        status, message = 429, 'Servidor ocupado: demasiadas detecciones en cola'
+    else:
+        status, message = 503, 'Tiempo de espera de inferencia agotado'
+    return jsonify({
+        'success': False,
+        'error': message,
+        'retry_after': INFERENCE_RETRY_AFTER
+    }), status, {'Retry-After': str(INFERENCE_RETRY_AFTER)}
+
+# ===== TRABAJOS DE DETECCIÓN ASÍNCRONOS =====
+
+def parse_detect_params(data):
+    """Valida los parámetros de /detect; retorna (params, None) o (None, (mensaje, código))"""
+    data = data or {}
+    filepath = data.get('filepath')
+    image_mode = data.get('image_mode', 'base64')
+    image_level = data.get('image_level', 'full')
+    
+    if not filepath or not os.path.exists(filepath):
+        return None, ('File not found', 400)
+    
+    if image_mode not in IMAGE_MODES:
+        return None, (f'image_mode no válido: {image_mode}. Opciones: {list(IMAGE_MODES)}', 400)
+    
+    if image_level not in IMAGE_LEVELS:
+        return None, (f'image_level no válido: {image_level}. Opciones: {list(IMAGE_LEVELS)}', 400)
+    
+    try:
+        params = {
+            'filepath': filepath,
+            'confidence': float(data.get('confidence', 0.60)),
+            'image_mode': image_mode,
+            'image_level': image_level,
+            'tiled': bool(data.get('tiled', False)),
+            'tile_size': int(data['tile_size']) if data.get('tile_size') is not None else None,
+            'tile_overlap': float(data['tile_overlap']) if data.get('tile_overlap') is not None else None,
+            'include_full': bool(data.get('include_full', True))
+        }
+    except (ValueError, TypeError):
+        return None, ('confidence, tile_size y tile_overlap deben ser números válidos', 400)
+    return params, None
+
+def run_detection(params, on_stage=None):
+    """Detección completa: caché → cola de inferencia → imagen anotada
+    
+    Retorna (resultado, None) o (None, (mensaje, código)). El resultado incluye
+    'timings' con los milisegundos de cada etapa. on_stage(nombre) se llama al
+    empezar cada etapa. Propaga SchedulerFullError / SchedulerTimeoutError.
+    
+    La imagen se decodifica en la etapa 'decode': a la reducción exacta que
+    espera el modelo y, si hace falta, al tamaño de la imagen anotada (que
+    reutiliza la anterior cuando alcanza); inferencia y dibujo la toman de la
+    caché de decodificadas.
+    """
+    if not startup.ready:
+        return None, (f"Modelo cargándose ({startup.phase}), reintente en {READY_RETRY_AFTER}s", 503)
+    
+    timings = {}
+    filepath, confidence = params['filepath'], params['confidence']
+    model_version = detector.model_version
+    
+    def stage(name):
+        if on_stage:
+            on_stage(name)
+        return time.perf_counter()
+    
+    started = time.perf_counter()
+    image_level = params.get('image_level', 'full')
+    render_side = IMAGE_LEVELS[image_level] if params['image_mode'] != 'none' else 0
+    needs_decode = params['tiled'] or detector.detect_from_cache(filepath, confidence, record_miss=False, log=False) is None
+    if detector.decoded is not None and (needs_decode or params['image_mode'] != 'none'):
+        decode_started = stage('decode')
+        # Mosaicos usan el original. El modelo recibe la reducción exacta de su clave de caché;
+        # la imagen anotada puede reutilizar cualquier decodificación igual o mayor
+        if params['tiled']:
+            image, decode_scale = detector._decode_scaled(filepath, None)
+        elif needs_decode:
+            image, decode_scale = detector._decode_for_inference(filepath)
+        else:
+            image, decode_scale = None, None
+        if params['image_mode'] != 'none' and not params['tiled']:
+            render_image, render_scale = detector._decode_scaled(filepath, render_side)
+            if image is None:
+                image, decode_scale = render_image, render_scale
+        if image is None:
+            return None, (f"Archivo no encontrado o inválido: {filepath}", 400)
+        timings['decode_ms'] = round((time.perf_counter() - decode_started) * 1000, 1)
+        timings['decode_scale'] = decode_scale
+    
+    inference_started = stage('inference')
+    tiling_info = None
+    if params['tiled']:
+        # Detección por mosaicos: tarea exclusiva en un hilo del modelo
+        detections, error, tiling_info = scheduler.run(
+            detector.detect_slabs_tiled, filepath, confidence,
+            tile_size=params['tile_size'], overlap=params['tile_overlap'],
+            include_full=params['include_full'],
+            timeout=INFERENCE_TIMEOUT
+        )
+        cache_hit = bool(tiling_info and tiling_info.get('cache_hit'))
+    else:
+        # Las imágenes ya procesadas con este modelo se refiltran sin pasar por la cola
+        detections = detector.detect_from_cache(filepath, confidence, record_miss=False)
+        cache_hit = detections is not None
+        error = None
+        if not cache_hit:
+            detections, error = scheduler.detect(filepath, confidence, timeout=INFERENCE_TIMEOUT)
+    timings['inference_ms'] = round((time.perf_counter() - inference_started) * 1000, 1)
+    
+    if error:
+        return None, (error, 500)
+    
+    # Dibujar detecciones
+    render_started = stage('render')
+    image_fields = detection_image_fields(filepath, detections, params['image_mode'], image_level)
+    timings['render_ms'] = round((time.perf_counter() - render_started) * 1000, 1)
+    
+    if image_fields is None:
+        return None, ('Error generating result image', 500)
+    
+    timings['total_ms'] = round((time.perf_counter() - started) * 1000, 1)
+    result = {
+        'success': True,
+        'count': len(detections),
+        'detections': detections,
+        'cache_hit': cache_hit,
+        'model_version': model_version,
+        'timings': timings
+    }
+    result.update(image_fields)
+    if tiling_info:
+        result['tiling'] = tiling_info
+    startup.record_detection()
+    return result, None
+
+class DetectionJobs:
+    """Trabajos de detección en segundo plano con estado consultable
+    
+    Un ThreadPoolExecutor acotado ejecuta run_detection fuera de los hilos de
+    Flask; como mucho max_pending trabajos pueden estar en cola o en ejecución.
+    Cada trabajo pasa por queued → running (etapas inference/render) → done o
+    error, y guarda los tiempos de cada etapa. Los trabajos terminados se
+    conservan ttl segundos para recoger el resultado. Cada cambio de estado
+    notifica a los clientes SSE que esperan en la condición.
+    """
     
-    def detect_slabs(self, image_path, confidence=0.60):
-        """Detecta palanquillas en la imagen"""
-        if not self.model:
-            return None, "Modelo YOLO no disponible"
-        
-        try:
-            print(f"🔍 Procesando imagen: {image_path}")
-            print(f"🎯 Confidence threshold: {confidence}")
-            
-            # Verificar que el archivo existe
-            if not os.path.exists(image_path):
-                return None, f"Archivo no encontrado: {image_path}"
-            
-            # Ejecutar detección
-            results = self.model(image_path, verbose=True)
-            
-            detection_points = []
-            if results and results[0].boxes is not None:
-                boxes = results[0].boxes
-                print(f"📊 Detecciones encontradas: {len(boxes)}")
-                
-                for i, conf_tensor in enumerate(boxes.conf):
-                    conf = float(conf_tensor.item())
-                    print(f"   Detección {i+1}: confianza = {conf:.3f}")
-                    
-                    if conf >= confidence:
-                        x1, y1, x2, y2 = boxes.xyxy[i].cpu().numpy()
-                        center_x = int((x1 + x2) / 2)
-                        center_y = int((y1 + y2) / 2)
-                        
-                        detection_points.append({
-                            'x': center_x,
-                            'y': center_y,
-                            'confidence': float(conf),
-                            'bbox': [float(x1), float(y1), float(x2), float(y2)]
-                        })
-            
-            print(f"✅ Detecciones válidas (conf >= {confidence}): {len(detection_points)}")
-            return detection_points, None
+    FINAL_STATES = ('done', 'error')
+    
+    def __init__(self, workers=2, max_pending=16, ttl=600):
+        self.workers = max(1, int(workers))
+        self.max_pending = max(1, int(max_pending))
+        self.ttl = ttl
+        self._executor = None
+        self._jobs = OrderedDict()
+        self._pending = 0
+        self._condition = threading.Condition()
+    
+    def submit(self, params):
+        """Crea y encola un trabajo; lanza SchedulerFullError si hay demasiados pendientes"""
+        with self._condition:
+            self._prune()
+            if self._pending >= self.max_pending:
+                raise SchedulerFullError("Demasiados trabajos de detección pendientes")
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='detect-job')
             
-        except Exception as e:
-            error_msg = f"Error procesando imagen: {str(e)}"
-            print(f"❌ {error_msg}")
-            return None, error_msg
+            job_id = uuid.uuid4().hex
+            self._jobs[job_id] = {
+                'job_id': job_id,
+                'status': 'queued',
+                'stage': 'queued',
+                'filepath': params['filepath'],
+                'created_at': datetime.now().isoformat(),
+                'finished_at': None,
+                'timings': {},
+                'error': None,
+                'version': 0,
+                '_created': time.monotonic(),
+                '_finished': None,
+                '_result': None
+            }
+            self._pending += 1
+        self._executor.submit(self._run, job_id, params)
+        return job_id
     
-    def draw_detections(self, image_path, detections):
-        """Dibuja las detecciones en la imagen"""
+    def _update(self, job_id, **changes):
+        with self._condition:
+            job = self._jobs.get(job_id)
+            if job is None:
+                return
+            job.update(changes)
+            job['version'] += 1
+            self._condition.notify_all()
+    
+    def _run(self, job_id, params):
+        job_started = time.monotonic()
+        with self._condition:
+            job = self._jobs.get(job_id)
+            queue_ms = round((job_started - job['_created']) * 1000, 1) if job else 0
+        self._update(job_id, status='running', stage='inference', timings={'queue_ms': queue_ms})
+        
         try:
-            # Cargar imagen
-            image = cv2.imread(image_path)
-            if image is None:
-                return None
-            
-            # Dibujar cada detección
-            for i, detection in enumerate(detections):
-                x, y = detection['x'], detection['y']
-                conf = detection['confidence']
-                
-                # Dibujar punto central más grande y visible
-                cv2.circle(image, (x, y), 8, (0, 0, 255), -1)  # Punto rojo sólido
-                cv2.circle(image, (x, y), 10, (255, 255, 255), 2)  # Borde blanco
-                
-                # Dibujar texto de confianza
-                text = f"{i+1}: {conf:.2f}"
-                cv2.putText(image, text, (x-20, y-15), 
-                           cv2.FONT_HERSHEY_SIMPLEX, 0.6, (255, 255, 255), 2)
-                cv2.putText(image, text, (x-20, y-15), 
-                           cv2.FONT_HERSHEY_SIMPLEX, 0.6, (0, 0, 255), 1)
-            
-            # Convertir a base64 para mostrar en web
-            _, buffer = cv2.imencode('.jpg', image)
-            img_str = base64.b64encode(buffer).decode()
-            return f"data:image/jpeg;base64,{img_str}"
-            
+            result, failure = run_detection(params, on_stage=lambda name: self._update(job_id, stage=name))
+        except SchedulerFullError:
+            result, failure = None, ('Servidor ocupado: demasiadas detecciones en cola', 429)
+        except SchedulerTimeoutError:
+            result, failure = None, ('Tiempo de espera de inferencia agotado', 503)
         except Exception as e:
-            print(f"❌ Error dibujando detecciones: {e}")
-            return None
+            print(f"❌ Error en trabajo de detección {job_id}: {e}")
+            result, failure = None, (str(e), 500)
+        
+        timings = {'queue_ms': queue_ms, **(result['timings'] if result else {})}
+        with self._condition:
+            self._pending -= 1
+        if failure:
+            self._update(job_id, status='error', stage='error', error=failure[0], error_code=failure[1],
+                         timings=timings, finished_at=datetime.now().isoformat(), _finished=time.monotonic())
+        else:
+            print(f"✅ Trabajo {job_id[:8]}: {result['count']} palanquillas detectadas")
+            self._update(job_id, status='done', stage='done', timings=timings, _result=result,
+                         finished_at=datetime.now().isoformat(), _finished=time.monotonic())
+    
+    def _prune(self):
+        """Olvida los trabajos terminados hace más de ttl segundos (requiere _condition)
+        
+        El plazo cuenta desde el final del trabajo, no desde su creación: un trabajo
+        que pasó mucho tiempo en cola conserva su resultado los ttl segundos completos.
+        """
+        now = time.monotonic()
+        for job_id in [job_id for job_id, job in self._jobs.items()
+                       if job['status'] in self.FINAL_STATES and now - job['_finished'] > self.ttl]:
+            del self._jobs[job_id]
+    
+    @staticmethod
+    def _public(job):
+        return {key: value for key, value in job.items() if not key.startswith('_')}
+    
+    def get(self, job_id):
+        """Estado público del trabajo (sin el resultado) o None"""
+        with self._condition:
+            job = self._jobs.get(job_id)
+            return self._public(job) if job else None
+    
+    def result(self, job_id):
+        """(estado público, resultado o None)"""
+        with self._condition:
+            job = self._jobs.get(job_id)
+            if job is None:
+                return None, None
+            return self._public(job), job['_result']
+    
+    def wait_for_change(self, job_id, version, timeout):
+        """Espera a que el trabajo pase de `version`; retorna el estado público o None"""
+        with self._condition:
+            self._condition.wait_for(
+                lambda: job_id not in self._jobs or self._jobs[job_id]['version'] != version,
+                timeout=timeout
+            )
+            job = self._jobs.get(job_id)
+            return self._public(job) if job else None
+    
+    def status(self):
+        with self._condition:
+            counts = {}
+            for job in self._jobs.values():
+                counts[job['status']] = counts.get(job['status'], 0) + 1
+            return {'workers': self.workers, 'max_pending': self.max_pending,
+                    'pending': self._pending, 'jobs': counts}
 
-# Instancia global
-detector = BasicSlabDetector()
+detection_jobs = DetectionJobs(JOB_WORKERS, JOB_MAX_PENDING, JOB_RESULT_TTL)
 
 # Esta función se definirá después de todas las funciones de persistencia
 
 # ===== SISTEMA DE BASE DE DATOS CSV =====
 
+class HistoryCursorError(ValueError):
+    """Cursor de paginación de otra generación del histórico (se compactó o reescribió)"""
+
+class HistoryLog:
+    """Histórico CSV de solo-anexar con índices en memoria por fecha y por imagen
+    
+    Las filas nuevas se anexan al CSV. Editar o eliminar no reescribe el
+    archivo: la operación se anexa a un diario JSONL ({"op": "set"|"del"})
+    que referencia la fila por su posición (id) en el CSV, así que cada
+    cambio cuesta O(1) de E/S sin importar el tamaño del histórico.
+    
+    La primera línea del diario guarda tamaño y md5 del CSV al que se
+    refiere; si el CSV se editó a mano el diario se descarta. La compactación
+    en segundo plano reescribe el CSV solo con las filas vivas: anota antes
+    una marca {"op": "compact"} con el md5 del CSV nuevo para que, si se
+    interrumpe, al recargar se sepa si el reemplazo llegó a hacerse.
+    """
+    
+    FIELDS = ['fecha', 'nombre_imagen', 'numero_lote', 'cantidad_slabs']
+    
+    def __init__(self, csv_path, journal_path, lock, compact_ops=500, compact_interval=300):
+        self.csv_path = csv_path
+        self.journal_path = journal_path
+        self.compact_ops = compact_ops
+        self.compact_interval = compact_interval
+        self._lock = lock
+        self._loaded = False
+        self._rows = []  # id -> registro (None = eliminado o inválido)
+        self._by_fecha = {}
+        self._by_image = {}
+        self._live = 0
+        self._journal_ops = 0
+        self._needs_newline = False
+        self._file_state = None
+        self._generation = None  # md5 corto del CSV base: cambia cuando los ids se renumeran
+        self._sorted = None  # [(fecha, id)] ordenado, se recalcula tras cambios
+        self._hourly = {}  # 'YYYY-MM-DD HH' -> [slabs, registros]
+        self._daily = {}  # 'YYYY-MM-DD' -> [slabs, registros]
+        self._day_lot = {}  # 'YYYY-MM-DD' -> {numero_lote: [slabs, registros]}
+        self._compactor = None
+        self._compact_event = threading.Event()
+        self._stats = {'loads': 0, 'appends': 0, 'journal_writes': 0, 'compactions': 0}
+    
+    @staticmethod
+    def _clean_row(row):
+        """Registro validado con los 4 campos como texto, o None si la fila es inválida"""
+        if not all(row.get(key) is not None and str(row[key]).strip() != '' for key in HistoryLog.FIELDS):
+            return None
+        return {key: str(row[key]).strip() for key in HistoryLog.FIELDS}
+    
+    def _current_state(self):
+        states = []
+        for path in (self.csv_path, self.journal_path):
+            try:
+                stat = os.stat(path)
+                states.append((stat.st_size, stat.st_mtime_ns))
+            except OSError:
+                states.append(None)
+        return tuple(states)
+    
+    def _ensure_loaded(self):
+        """Carga el histórico; lo recarga si otro proceso o una edición manual cambió los archivos"""
+        if self._loaded and self._current_state() == self._file_state:
+            return
+        self._load()
+    
+    def _load(self):
+        if not os.path.exists(self.csv_path):
+            inicializar_base_datos()
+        with open(self.csv_path, 'rb') as f:
+            raw = f.read()
+        
+        self._rows = [self._clean_row(row) for row in
+                      csv.DictReader(io.StringIO(raw.decode('utf-8'), newline=''))]
+        invalid = self._rows.count(None)
+        if invalid:
+            print(f"⚠️ {invalid} filas del histórico ignoradas por campos faltantes")
+        self._needs_newline = bool(raw) and not raw.endswith(b'\n')
+        
+        ops = self._read_journal(raw)
+        for op in ops:
+            self._apply(op)
+        self._journal_ops = len(ops)
+        self._rebuild_indexes()
+        self._loaded = True
+        self._file_state = self._current_state()
+        self._stats['loads'] += 1
+    
+    def _read_journal(self, raw):
+        """Operaciones del diario válidas para este CSV (reinicia el diario si no corresponde)"""
+        header, ops, compacted = None, [], False
+        if os.path.exists(self.journal_path):
+            with open(self.journal_path, 'r', encoding='utf-8') as f:
+                for index, line in enumerate(f):
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        break  # Línea incompleta por un corte: se ignora desde aquí
+                    if index == 0:
+                        header = entry
+                    elif entry.get('op') == 'compact':
+                        # El CSV ya es el compactado: el diario anterior ya está aplicado
+                        if entry.get('md5') == hashlib.md5(raw).hexdigest():
+                            compacted = True
+                            break
+                    else:
+                        ops.append(entry)
+        
+        valid = (isinstance(header, dict) and header.get('op') == 'base'
+                 and len(raw) >= header.get('size', -1)
+                 and hashlib.md5(raw[:header['size']]).hexdigest() == header.get('md5'))
+        if valid and not compacted:
+            self._generation = header['md5'][:12]
+            return ops
+        
+        if ops and not compacted:
+            print(f"⚠️ Diario del histórico no corresponde al CSV (¿edición manual?), {len(ops)} operaciones descartadas")
+        self._write_journal_header(raw)
+        return []
+    
+    def _write_journal_header(self, csv_bytes):
+        header = {'op': 'base', 'size': len(csv_bytes), 'md5': hashlib.md5(csv_bytes).hexdigest()}
+        # Nuevo CSV base (compactado, reescrito o editado a mano): los ids anteriores ya no valen
+        self._generation = header['md5'][:12]
+        temp_path = self.journal_path + '.tmp'
+        with open(temp_path, 'w', encoding='utf-8') as f:
+            f.write(json.dumps(header) + '\n')
+        os.replace(temp_path, self.journal_path)
+    
+    def _apply(self, op):
+        """Aplica una operación del diario a las filas en memoria"""
+        if op.get('op') == 'set':
+            row_id = op.get('id')
+            if isinstance(row_id, int) and 0 <= row_id < len(self._rows) and self._rows[row_id]:
+                for campo, valor in op.get('values', {}).items():
+                    if campo in self.FIELDS:
+                        self._rows[row_id][campo] = str(valor)
+        elif op.get('op') == 'del':
+            for row_id in op.get('ids', []):
+                if isinstance(row_id, int) and 0 <= row_id < len(self._rows):
+                    self._rows[row_id] = None
+    
+    def _rebuild_indexes(self):
+        self._by_fecha, self._by_image, self._live = {}, {}, 0
+        self._sorted = None
+        self._hourly, self._daily, self._day_lot = {}, {}, {}
+        for row_id, row in enumerate(self._rows):
+            if row:
+                self._index(row_id, row)
+    
+    def _index(self, row_id, row):
+        self._by_fecha.setdefault(row['fecha'], []).append(row_id)
+        self._by_image.setdefault(row['nombre_imagen'], []).append(row_id)
+        self._live += 1
+        self._sorted = None
+        self._rollup(row, 1)
+    
+    def _unindex(self, row_id, row):
+        for index, key in ((self._by_fecha, row['fecha']), (self._by_image, row['nombre_imagen'])):
+            ids = index.get(key, [])
+            if row_id in ids:
+                ids.remove(row_id)
+            if not ids:
+                index.pop(key, None)
+        self._live -= 1
+        self._sorted = None
+        self._rollup(row, -1)
+    
+    def _rollup(self, row, sign):
+        """Suma (sign=1) o resta (sign=-1) la fila en los acumulados por hora y por día/lote"""
+        try:
+            slabs = int(row['cantidad_slabs'])
+        except ValueError:
+            slabs = 0
+        day = row['fecha'][:10]
+        lots = self._day_lot.setdefault(day, {})
+        for buckets, key in ((self._hourly, row['fecha'][:13]), (self._daily, day),
+                             (lots, row['numero_lote'])):
+            bucket = buckets.setdefault(key, [0, 0])
+            bucket[0] += sign * slabs
+            bucket[1] += sign
+            if bucket[1] <= 0:
+                del buckets[key]
+        if not lots:
+            del self._day_lot[day]
+    
+    def _write_journal(self, op):
+        with open(self.journal_path, 'a', encoding='utf-8') as f:
+            f.write(json.dumps(op, ensure_ascii=False) + '\n')
+        self._apply_indexed(op)
+        self._journal_ops += 1
+        self._stats['journal_writes'] += 1
+        self._file_state = self._current_state()
+        if self._journal_ops >= self.compact_ops:
+            self._compact_event.set()
+        self._start_compactor()
+    
+    def _apply_indexed(self, op):
+        """Aplica la operación manteniendo los índices al día"""
+        ids = [op['id']] if op['op'] == 'set' else op['ids']
+        rows = [(row_id, self._rows[row_id]) for row_id in ids if self._rows[row_id]]
+        for row_id, row in rows:
+            self._unindex(row_id, row)
+        self._apply(op)
+        for row_id, _ in rows:
+            if self._rows[row_id]:
+                self._index(row_id, self._rows[row_id])
+    
+    # --- Consultas ---
+    
+    def records(self):
+        """Copia de los registros vivos en orden del archivo"""
+        with self._lock:
+            self._ensure_loaded()
+            return [dict(row) for row in self._rows if row]
+    
+    def get(self, row_id):
+        with self._lock:
+            self._ensure_loaded()
+            row = self._rows[row_id] if 0 <= row_id < len(self._rows) else None
+            return dict(row) if row else None
+    
+    def ids_by_fecha(self, fecha):
+        with self._lock:
+            self._ensure_loaded()
+            return list(self._by_fecha.get(fecha, []))
+    
+    def ids_by_image(self, nombre_imagen):
+        with self._lock:
+            self._ensure_loaded()
+            return list(self._by_image.get(nombre_imagen, []))
+    
+    def totals(self, kind, desde=None, hasta=None):
+        """Acumulados [(clave, slabs, registros)] por 'hora' o 'dia' entre días inclusivos"""
+        with self._lock:
+            self._ensure_loaded()
+            source = self._hourly if kind == 'hora' else self._daily
+            items = [(key, bucket[0], bucket[1]) for key, bucket in source.items()
+                     if (desde is None or key[:10] >= desde) and (hasta is None or key[:10] <= hasta)]
+        return sorted(items)
+    
+    def lot_totals(self, desde=None, hasta=None):
+        """Acumulados {numero_lote: [slabs, registros]} sumando los días del rango"""
+        totals = {}
+        with self._lock:
+            self._ensure_loaded()
+            for day, lots in self._day_lot.items():
+                if (desde is not None and day < desde) or (hasta is not None and day > hasta):
+                    continue
+                for lote, (slabs, registros) in lots.items():
+                    total = totals.get(lote)
+                    if total is None:
+                        totals[lote] = [slabs, registros]
+                    else:
+                        total[0] += slabs
+                        total[1] += registros
+        return totals
+    
+    def query(self, desde=None, hasta=None, numero_lote=None, nombre_imagen=None,
+              descending=False, after=None):
+        """Registros filtrados y ordenados por (fecha, id): retorna (generación, iterador de (id, registro))
+        
+        `desde`/`hasta` son prefijos de fecha inclusivos ('2025-08-06' o
+        '2025-08-06 09:45:54') y `after` es el cursor (fecha, id, generación)
+        del último registro ya entregado. Los ids son posiciones en el CSV y la
+        compactación los renumera, así que un cursor de otra generación lanza
+        HistoryCursorError en vez de saltar o repetir filas. Con nombre_imagen
+        solo se recorren las filas de su índice. El rango se ubica por búsqueda
+        binaria sobre una instantánea del orden, así que no se mantiene el
+        bloqueo mientras se consume el iterador.
+        """
+        with self._lock:
+            self._ensure_loaded()
+            if after is not None and after[2] != self._generation:
+                raise HistoryCursorError("El histórico se compactó después de generar el cursor; vuelva a la primera página")
+            if nombre_imagen is not None:
+                keys = sorted((self._rows[row_id]['fecha'], row_id) for row_id in self._by_image.get(nombre_imagen, []))
+            else:
+                if self._sorted is None:
+                    self._sorted = sorted((row['fecha'], row_id) for row_id, row in enumerate(self._rows) if row)
+                keys = self._sorted
+            rows, generation = self._rows, self._generation
+        
+        after = after[:2] if after is not None else None
+        return generation, self._iter_range(keys, rows, desde, hasta, numero_lote, nombre_imagen, descending, after)
+    
+    @staticmethod
+    def _iter_range(keys, rows, desde, hasta, numero_lote, nombre_imagen, descending, after):
+        """Genera (id, registro) de keys dentro de [desde, hasta] y posteriores al cursor (fecha, id)"""
+        lo = bisect_left(keys, (desde, -1)) if desde else 0
+        hi = bisect_right(keys, (hasta, float('inf'))) if hasta else len(keys)
+        if after is not None:
+            if descending:
+                hi = min(hi, bisect_left(keys, after))
+            else:
+                lo = max(lo, bisect_right(keys, after))
+        
+        positions = range(hi - 1, lo - 1, -1) if descending else range(lo, hi)
+        for position in positions:
+            row_id = keys[position][1]
+            row = rows[row_id] if row_id < len(rows) else None
+            if not row:
+                continue
+            if nombre_imagen is not None and row['nombre_imagen'] != nombre_imagen:
+                continue
+            if numero_lote is not None and row['numero_lote'] != numero_lote:
+                continue
+            yield row_id, dict(row)
+    
+    # --- Cambios ---
+    
+    def append(self, registros):
+        """Anexa registros al final del CSV; retorna sus ids"""
+        with self._lock:
+            self._ensure_loaded()
+            rows = [{key: str(registro[key]) for key in self.FIELDS} for registro in registros]
+            with open(self.csv_path, 'a', newline='', encoding='utf-8') as file:
+                if self._needs_newline:
+                    file.write('\r\n')
+                    self._needs_newline = False
+                csv.DictWriter(file, fieldnames=self.FIELDS).writerows(rows)
+            
+            ids = []
+            for row in rows:
+                self._rows.append(row)
+                ids.append(len(self._rows) - 1)
+                self._index(ids[-1], row)
+            self._stats['appends'] += len(rows)
+            self._file_state = self._current_state()
+            return ids
+    
+    def update(self, row_id, values):
+        """Cambia campos de una fila (una línea en el diario)"""
+        with self._lock:
+            self._ensure_loaded()
+            if not (0 <= row_id < len(self._rows)) or not self._rows[row_id]:
+                return False
+            self._write_journal({'op': 'set', 'id': row_id,
+                                 'values': {campo: str(valor) for campo, valor in values.items()}})
+            return True
+    
+    def delete(self, ids):
+        """Marca filas como eliminadas (lápida en el diario)"""
+        with self._lock:
+            self._ensure_loaded()
+            ids = [row_id for row_id in ids if 0 <= row_id < len(self._rows) and self._rows[row_id]]
+            if ids:
+                self._write_journal({'op': 'del', 'ids': ids})
+            return len(ids)
+    
+    def replace_image(self, nombre_imagen, registros):
+        """Sustituye los registros de una imagen: lápida de los anteriores y anexo de los nuevos"""
+        with self._lock:
+            self.delete(self.ids_by_image(nombre_imagen))
+            return self.append(registros)
+    
+    def rewrite(self, registros):
+        """Reescribe el CSV completo con los registros dados (y vacía el diario)"""
+        with self._lock:
+            self._write_compacted([{key: str(r[key]) for key in self.FIELDS} for r in registros])
+    
+    def reset(self):
+        """Olvida el estado en memoria y el diario (tras reescribir el CSV por fuera)"""
+        with self._lock:
+            if os.path.exists(self.journal_path):
+                os.remove(self.journal_path)
+            self._loaded = False
+            self._rows, self._journal_ops = [], 0
+            self._rebuild_indexes()
+    
+    # --- Compactación ---
+    
+    def compact(self):
+        """Reescribe el CSV solo con filas vivas; retorna cuántas filas muertas se eliminaron"""
+        with self._lock:
+            self._ensure_loaded()
+            dead = len(self._rows) - self._live
+            if not self._journal_ops and not dead:
+                return 0
+            self._write_compacted([row for row in self._rows if row])
+            self._stats['compactions'] += 1
+            print(f"🗜️ Histórico compactado: {self._live} registros, {dead} filas eliminadas/obsoletas descartadas")
+            return dead
+    
+    def _write_compacted(self, rows):
+        buffer = io.StringIO(newline='')
+        writer = csv.DictWriter(buffer, fieldnames=self.FIELDS)
+        writer.writeheader()
+        writer.writerows(rows)
+        data = buffer.getvalue().encode('utf-8')
+        
+        # 1) marca de compactación, 2) reemplazo atómico del CSV, 3) diario nuevo
+        if os.path.exists(self.journal_path):
+            with open(self.journal_path, 'a', encoding='utf-8') as f:
+                f.write(json.dumps({'op': 'compact', 'md5': hashlib.md5(data).hexdigest()}) + '\n')
+        temp_path = self.csv_path + '.tmp'
+        with open(temp_path, 'wb') as f:
+            f.write(data)
+        os.replace(temp_path, self.csv_path)
+        self._write_journal_header(data)
+        
+        self._rows = [dict(row) for row in rows]
+        self._rebuild_indexes()
+        self._journal_ops = 0
+        self._needs_newline = False
+        self._loaded = True
+        self._file_state = self._current_state()
+    
+    def _start_compactor(self):
+        if self._compactor is None or not self._compactor.is_alive():
+            self._compactor = threading.Thread(target=self._compactor_loop, name='history-compactor', daemon=True)
+            self._compactor.start()
+    
+    def _compactor_loop(self):
+        while True:
+            # Despierta por intervalo o cuando el diario supera compact_ops
+            self._compact_event.wait(self.compact_interval)
+            self._compact_event.clear()
+            try:
+                if self._journal_ops:
+                    self.compact()
+            except Exception as e:
+                print(f"⚠️ Error compactando histórico: {e}")
+    
+    def status(self):
+        with self._lock:
+            return {
+                'loaded': self._loaded,
+                'records': self._live,
+                'rows_in_file': len(self._rows),
+                'journal_ops': self._journal_ops,
+                **self._stats
+            }
+
+history_log = HistoryLog(DATABASE_FILE, HISTORY_JOURNAL_FILE, _database_lock,
+                         HISTORY_COMPACT_OPS, HISTORY_COMPACT_INTERVAL)
+
 def inicializar_base_datos():
     """Inicializa el archivo CSV si no existe"""
     if not os.path.exists(DATABASE_FILE):
@@ -173,6 +2617,7 @@ def inicializar_base_datos():
                             parts = line.split(',')
                             if len(parts) >= 4:
                                 writer.writerow(parts[:4])
+                history_log.reset()
                 print(f"✅ Header CSV corregido: {DATABASE_FILE}")
 
 def guardar_deteccion_historica(nombre_imagen, numero_lote, cantidad_slabs):
@@ -180,14 +2625,13 @@ def guardar_deteccion_historica(nombre_imagen, numero_lote, cantidad_slabs):
     try:
         fecha_actual = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
         
-        # Verificar si el archivo existe, si no, inicializarlo
-        if not os.path.exists(DATABASE_FILE):
-            inicializar_base_datos()
-        
-        # Añadir nueva fila al CSV
-        with open(DATABASE_FILE, 'a', newline='', encoding='utf-8') as file:
-            writer = csv.writer(file)
-            writer.writerow([fecha_actual, nombre_imagen, numero_lote, cantidad_slabs])
+        # Añadir nueva fila al final del CSV
+        history_log.append([{
+            'fecha': fecha_actual,
+            'nombre_imagen': nombre_imagen,
+            'numero_lote': numero_lote,
+            'cantidad_slabs': cantidad_slabs
+        }])
         
         print(f"📊 Detección guardada en BBDD: {nombre_imagen} - Lote {numero_lote} - {cantidad_slabs} slabs")
         return True
@@ -197,34 +2641,9 @@ def guardar_deteccion_historica(nombre_imagen, numero_lote, cantidad_slabs):
         return False
 
 def leer_base_datos_historica():
-    """Lee todos los registros de la base de datos histórica"""
+    """Lee todos los registros de la base de datos histórica (desde el índice en memoria)"""
     try:
-        if not os.path.exists(DATABASE_FILE):
-            inicializar_base_datos()
-            return []
-        
-        registros = []
-        with open(DATABASE_FILE, 'r', newline='', encoding='utf-8') as file:
-            reader = csv.DictReader(file)
-            for row in reader:
-                # Validar que la fila tenga todos los campos requeridos
-                if all(key in row and row[key] is not None and row[key].strip() != '' 
-                       for key in ['fecha', 'nombre_imagen', 'numero_lote', 'cantidad_slabs']):
-                    # Limpiar y validar datos
-                    try:
-                        registro_limpio = {
-                            'fecha': row['fecha'].strip(),
-                            'nombre_imagen': row['nombre_imagen'].strip(),
-                            'numero_lote': str(row['numero_lote']).strip(),
-                            'cantidad_slabs': str(row['cantidad_slabs']).strip()
-                        }
-                        registros.append(registro_limpio)
-                    except Exception as e:
-                        print(f"⚠️ Fila ignorada por datos inválidos: {row}, Error: {e}")
-                        continue
-                else:
-                    print(f"⚠️ Fila ignorada por campos faltantes: {row}")
-        
+        registros = history_log.records()
         print(f"📚 Leídos {len(registros)} registros válidos de la base de datos")
         return registros
         
@@ -238,31 +2657,12 @@ def actualizar_registro_historico(fecha_original, campo, nuevo_valor):
         if not os.path.exists(DATABASE_FILE):
             return False, "Base de datos no existe"
         
-        # Leer todos los registros
-        registros = []
-        with open(DATABASE_FILE, 'r', newline='', encoding='utf-8') as file:
-            reader = csv.DictReader(file)
-            for row in reader:
-                registros.append(row)
-        
-        # Buscar y actualizar el registro específico
-        registro_encontrado = False
-        for registro in registros:
-            if registro['fecha'] == fecha_original:
-                if campo in registro:
-                    registro[campo] = str(nuevo_valor)
-                    registro_encontrado = True
-                    break
-        
-        if not registro_encontrado:
+        # Primer registro con esa fecha (mismo criterio que antes)
+        ids = history_log.ids_by_fecha(fecha_original)
+        if not ids or campo not in HistoryLog.FIELDS:
             return False, "Registro no encontrado"
         
-        # Escribir todos los registros de vuelta al archivo
-        with open(DATABASE_FILE, 'w', newline='', encoding='utf-8') as file:
-            fieldnames = ['fecha', 'nombre_imagen', 'numero_lote', 'cantidad_slabs']
-            writer = csv.DictWriter(file, fieldnames=fieldnames)
-            writer.writeheader()
-            writer.writerows(registros)
+        history_log.update(ids[0], {campo: nuevo_valor})
         
         print(f"📊 Registro actualizado: {campo} = {nuevo_valor} para fecha {fecha_original}")
         return True, f"Campo {campo} actualizado exitosamente"
@@ -277,20 +2677,8 @@ def eliminar_registro_historico(fecha_original):
         if not os.path.exists(DATABASE_FILE):
             return False, "Base de datos no existe"
         
-        # Leer todos los registros
-        registros = []
-        with open(DATABASE_FILE, 'r', newline='', encoding='utf-8') as file:
-            reader = csv.DictReader(file)
-            for row in reader:
-                if row['fecha'] != fecha_original:
-                    registros.append(row)
-        
-        # Escribir registros filtrados de vuelta al archivo
-        with open(DATABASE_FILE, 'w', newline='', encoding='utf-8') as file:
-            fieldnames = ['fecha', 'nombre_imagen', 'numero_lote', 'cantidad_slabs']
-            writer = csv.DictWriter(file, fieldnames=fieldnames)
-            writer.writeheader()
-            writer.writerows(registros)
+        # Todas las filas con esa fecha (mismo criterio que antes)
+        history_log.delete(history_log.ids_by_fecha(fecha_original))
         
         print(f"📊 Registro eliminado del histórico: fecha {fecha_original}")
         return True, "Registro eliminado exitosamente"
@@ -303,13 +2691,12 @@ def sincronizar_lote_con_historico(nombre_imagen, numero_lote_anterior, numero_l
     """Sincroniza cambios de lote con el histórico - maneja reorganización inteligente"""
     try:
         # Buscar el registro más reciente del lote anterior para esta imagen
-        registros = leer_base_datos_historica()
-        registro_anterior = None
-        for registro in registros:
-            if (registro['nombre_imagen'] == nombre_imagen and 
-                str(registro['numero_lote']) == str(numero_lote_anterior)):
-                # Guardar el más reciente (último en la lista)
-                registro_anterior = registro
+        row_id, registro_anterior = None, None
+        for candidate_id in history_log.ids_by_image(nombre_imagen):
+            registro = history_log.get(candidate_id)
+            if registro and str(registro['numero_lote']) == str(numero_lote_anterior):
+                # Guardar el más reciente (último en el archivo)
+                row_id, registro_anterior = candidate_id, registro
         
         if registro_anterior:
             cantidad_anterior = int(registro_anterior['cantidad_slabs'])
@@ -317,12 +2704,11 @@ def sincronizar_lote_con_historico(nombre_imagen, numero_lote_anterior, numero_l
             if numero_lote_anterior == numero_lote_nuevo:
                 # Mismo lote, solo actualizar cantidad (reorganización parcial)
                 print(f"📊 Actualizando cantidad del lote {numero_lote_anterior}: {cantidad_anterior} → {cantidad_slabs}")
-                actualizar_registro_historico(registro_anterior['fecha'], 'cantidad_slabs', cantidad_slabs)
+                history_log.update(row_id, {'cantidad_slabs': cantidad_slabs})
             else:
-                # Diferente lote: cambio completo de número
+                # Diferente lote: cambio completo de número (una sola operación)
                 print(f"📊 Cambiando lote completo: {numero_lote_anterior} → {numero_lote_nuevo}")
-                actualizar_registro_historico(registro_anterior['fecha'], 'numero_lote', numero_lote_nuevo)
-                actualizar_registro_historico(registro_anterior['fecha'], 'cantidad_slabs', cantidad_slabs)
+                history_log.update(row_id, {'numero_lote': numero_lote_nuevo, 'cantidad_slabs': cantidad_slabs})
         else:
             print(f"⚠️ No se encontró registro anterior para lote {numero_lote_anterior} en {nombre_imagen}")
         
@@ -333,116 +2719,770 @@ def sincronizar_lote_con_historico(nombre_imagen, numero_lote_anterior, numero_l
         print(f"❌ Error sincronizando lote: {e}")
         return False
 
-# ===== SISTEMA DE PERSISTENCIA =====
+def parse_shifts(spec):
+    """Convierte "A:06-14,B:14-22,C:22-06" en [(nombre, inicio, fin)]"""
+    shifts = []
+    for part in spec.split(','):
+        name, hours = part.strip().split(':')
+        start, end = (int(h) % 24 for h in hours.split('-'))
+        shifts.append((name.strip(), start, end))
+    return shifts
+
+def shift_for_hour(day, hour, shifts):
+    """(día del turno, nombre) para una hora; los turnos que cruzan medianoche cuentan en el día en que empiezan"""
+    for name, start, end in shifts:
+        if start < end and start <= hour < end:
+            return day, name
+        if start >= end and (hour >= start or hour < end):
+            if hour < end:
+                day = (datetime.strptime(day, '%Y-%m-%d') - timedelta(days=1)).strftime('%Y-%m-%d')
+            return day, name
+    return day, None
+
+def estadisticas_produccion(agrupar='dia', desde=None, hasta=None, shifts=None):
+    """Totales de cantidad_slabs desde los acumulados precalculados del histórico"""
+    totals = {}
+    if agrupar == 'lote':
+        totals = {(lote,): total for lote, total in history_log.lot_totals(desde, hasta).items()}
+        fields = ('numero_lote',)
+    else:
+        shifts = shifts or parse_shifts(PRODUCTION_SHIFTS)
+        bucket_hasta = hasta
+        if agrupar == 'turno' and hasta:
+            # El turno nocturno del último día termina al día siguiente
+            bucket_hasta = (datetime.strptime(hasta, '%Y-%m-%d') + timedelta(days=1)).strftime('%Y-%m-%d')
+        kind = 'dia' if agrupar == 'dia' else 'hora'
+        for bucket_key, slabs, registros in history_log.totals(kind, desde, bucket_hasta):
+            day = bucket_key[:10]
+            if agrupar == 'hora':
+                key = (day, int(bucket_key[11:13]))
+            elif agrupar == 'turno':
+                key = shift_for_hour(day, int(bucket_key[11:13]), shifts)
+                if (desde and key[0] < desde) or (hasta and key[0] > hasta):
+                    continue
+            else:
+                key = (day,)
+            totals.setdefault(key, [0, 0])
+            totals[key][0] += slabs
+            totals[key][1] += registros
+        fields = {'hora': ('dia', 'hora'), 'turno': ('dia', 'turno')}.get(agrupar, ('dia',))
+    
+    return [dict(zip(fields, key), cantidad_slabs=slabs, registros=registros)
+            for key, (slabs, registros) in sorted(totals.items(), key=lambda item: tuple('' if k is None else k for k in item[0]))]
+
+# ===== SISTEMA DE PERSISTENCIA =====
+
+@contextmanager
+def persistence_file_lock():
+    """Context manager para bloqueo seguro del archivo de persistencia"""
+    with _persistence_lock:
+        yield
+
+def calculate_file_hash(filepath):
+    """Calcula hash MD5 de un archivo para verificar integridad"""
+    try:
+        hash_md5 = hashlib.md5()
+        with open(filepath, "rb") as f:
+            for chunk in iter(lambda: f.read(4096), b""):
+                hash_md5.update(chunk)
+        return hash_md5.hexdigest()
+    except:
+        return None
+
+def normalize_image_record(img):
+    """Asegura los campos requeridos de un registro de imagen (puntos siempre como lista de objetos)"""
+    img.setdefault('status', 'loaded')
+    img['manualPoints'] = decode_points(img.get('manualPoints') or [])
+    img.setdefault('batches', [])
+    img.setdefault('nextPointId', 1)
+    return img
+
+# ===== CODIFICACIÓN COLUMNAR DE PUNTOS =====
+
+# En disco y (si el cliente lo pide) en la red, manualPoints viaja como columnas paralelas
+# {"format": "columnar-2", "count": n, "id": [...], "x": [...], "y": [...], ...} en vez de
+# una lista de objetos que repite las claves en cada punto. En memoria siempre son objetos.
+# La codificación es sin pérdida: confianza con precisión completa y, en "absent", los índices
+# de los puntos que no tenían la clave (distinto de tenerla con valor null).
+POINTS_FORMAT = 'columnar-2'
+LEGACY_POINTS_FORMAT = 'columnar-1'  # null = sin valor; batchNumber siempre presente (lo envía la UI)
+POINT_COLUMNS = ('id', 'x', 'y', 'confidence', 'isOriginal', 'batchNumber')
+REQUIRED_POINT_COLUMNS = ('id', 'x', 'y')
+TRANSIENT_POINT_KEYS = ('isSelected',)  # Estado de la UI, no se guarda
+
+def encode_points(points):
+    """Lista de puntos -> columnas paralelas (se omiten las columnas que ningún punto tiene)"""
+    if isinstance(points, dict):
+        return points
+    columns = {key: [] for key in POINT_COLUMNS}
+    absent = {}
+    extra = {}
+    for index, point in enumerate(points):
+        for key in POINT_COLUMNS:
+            if key not in point and key not in REQUIRED_POINT_COLUMNS:
+                absent.setdefault(key, []).append(index)
+            columns[key].append(point.get(key))
+        rest = {key: value for key, value in point.items()
+                if key not in POINT_COLUMNS and key not in TRANSIENT_POINT_KEYS}
+        if rest:
+            # Campos poco comunes: se conservan por índice sin añadir columnas
+            extra[str(index)] = rest
+    
+    columns['confidence'] = [None if value is None else float(value) for value in columns['confidence']]
+    columns['isOriginal'] = [None if value is None else int(bool(value)) for value in columns['isOriginal']]
+    
+    encoded = {'format': POINTS_FORMAT, 'count': len(points)}
+    for key, values in columns.items():
+        if key in REQUIRED_POINT_COLUMNS or len(absent.get(key, ())) < len(points):
+            encoded[key] = values
+        else:
+            absent.pop(key, None)
+    if absent:
+        encoded['absent'] = absent
+    if extra:
+        encoded['extra'] = extra
+    return encoded
+
+def decode_points(value):
+    """Columnas paralelas -> lista de puntos; una lista (formato anterior) se devuelve tal cual"""
+    if not isinstance(value, dict):
+        return value if isinstance(value, list) else []
+    legacy = value.get('format') == LEGACY_POINTS_FORMAT
+    if value.get('format') != POINTS_FORMAT and not legacy:
+        raise ValueError(f"Formato de puntos desconocido: {value.get('format')}")
+    
+    count = value.get('count', len(value.get('id', [])))
+    columns = [(key, value[key], set(value.get('absent', {}).get(key, ())))
+               for key in POINT_COLUMNS if key not in REQUIRED_POINT_COLUMNS and key in value]
+    extra = value.get('extra', {})
+    points = []
+    for index in range(count):
+        point = {'id': value['id'][index], 'x': value['x'][index], 'y': value['y'][index]}
+        for key, values, missing in columns:
+            if index in missing or (legacy and values[index] is None):
+                continue
+            point[key] = bool(values[index]) if key == 'isOriginal' and values[index] is not None else values[index]
+        if legacy:
+            point.setdefault('batchNumber', None)
+        point.update(extra.get(str(index), {}))
+        points.append(point)
+    return points
+
+def pack_image_record(img):
+    """Copia del registro con los puntos en formato columnar (para disco y red)"""
+    packed = dict(img)
+    packed['manualPoints'] = encode_points(img.get('manualPoints') or [])
+    return packed
+
+def wants_columnar_points():
+    """El cliente pide puntos columnares con ?points=columnar"""
+    return request.args.get('points') == 'columnar'
+
+# Campos que definen el contenido de una imagen (sin marcas de tiempo ni revisión)
+IMAGE_CONTENT_KEYS = ('status', 'manualPoints', 'batches', 'nextPointId', 'detectionSummary')
+
+def image_content_hash(img):
+    """Hash estable del contenido de una imagen: igual contenido, igual hash"""
+    # Se hashea la forma columnar: lo que se guarda, sin campos transitorios de la UI
+    content = {key: img.get(key) for key in IMAGE_CONTENT_KEYS}
+    content['manualPoints'] = encode_points(content['manualPoints'] or [])
+    payload = json.dumps(content, sort_keys=True, separators=(',', ':'), ensure_ascii=False, default=str)
+    return hashlib.sha256(payload.encode('utf-8')).hexdigest()[:16]
+
+def image_etag(img):
+    """ETag de una imagen: revisión + hash de contenido"""
+    return f"{img.get('revision', 0)}-{img.get('contentHash') or image_content_hash(img)}"
+
+def load_legacy_json_data(candidates=None):
+    """Lee el antiguo slab_data.json (o su respaldo) con validación robusta
+    
+    Retorna (datos, archivo_origen) o (None, None) si no hay ninguno válido.
+    """
+    for attempt_file in candidates or [PERSISTENCE_FILE, PERSISTENCE_BACKUP]:
+        if not os.path.exists(attempt_file):
+            continue
+        
+        try:
+            with open(attempt_file, 'r', encoding='utf-8') as f:
+                data = json.load(f)
+            
+            # Validar estructura básica
+            if not isinstance(data, dict):
+                raise ValueError("Datos no tienen estructura dict")
+            
+            # Validar cada imagen
+            data['images'] = [normalize_image_record(img) for img in data.get('images', [])
+                              if isinstance(img, dict) and 'name' in img]
+            data.setdefault('next_image_id', 1)
+            data.setdefault('last_updated', None)
+            return data, attempt_file
+            
+        except Exception as e:
+            print(f"❌ Error con {attempt_file}: {e}")
+            continue
+    
+    return None, None
+
+class SlabStore:
+    """Almacén SQLite (modo WAL) con una fila por imagen indexada por nombre
+    
+    Leer o guardar una imagen solo toca su fila, en vez de parsear y reescribir
+    todo el documento. El rowid conserva el orden de la antigua lista JSON y
+    los campos de nivel superior del documento (next_image_id, last_updated...)
+    se guardan en la tabla meta. Las claves de meta que empiezan con "_" son
+    internas. Los puntos de cada fila se guardan en formato columnar.
+    """
+    
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS images (
+            name TEXT PRIMARY KEY,
+            status TEXT,
+            data TEXT NOT NULL,
+            updated_at TEXT
+        );
+        CREATE TABLE IF NOT EXISTS meta (
+            key TEXT PRIMARY KEY,
+            value TEXT
+        );
+        CREATE TABLE IF NOT EXISTS uploads (
+            sha256 TEXT PRIMARY KEY,
+            path TEXT NOT NULL,
+            size INTEGER,
+            original_name TEXT,
+            uploads INTEGER NOT NULL DEFAULT 1,
+            created_at TEXT,
+            last_upload_at TEXT
+        );
+        CREATE TABLE IF NOT EXISTS upload_sessions (
+            id TEXT PRIMARY KEY,
+            filename TEXT NOT NULL,
+            size INTEGER NOT NULL,
+            chunk_size INTEGER NOT NULL,
+            total_chunks INTEGER NOT NULL,
+            sha256 TEXT,
+            received TEXT NOT NULL DEFAULT '[]',
+            created_at TEXT,
+            updated_at TEXT
+        );
+        CREATE TABLE IF NOT EXISTS models (
+            version TEXT PRIMARY KEY,
+            path TEXT NOT NULL,
+            md5 TEXT NOT NULL,
+            size INTEGER,
+            notes TEXT,
+            registered_at TEXT
+        );
+    """
+    
+    def __init__(self, path, backup_path):
+        self.path = path
+        self.backup_path = backup_path
+        self._conn = None
+        self._lock = threading.RLock()
+    
+    def _open(self):
+        """Abre la base de datos; si está dañada la restaura desde el respaldo"""
+        conn = sqlite3.connect(self.path, check_same_thread=False, isolation_level=None)
+        try:
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            if conn.execute('PRAGMA quick_check').fetchone()[0] != 'ok':
+                raise sqlite3.DatabaseError("quick_check falló")
+        except sqlite3.DatabaseError as e:
+            conn.close()
+            if not os.path.exists(self.backup_path):
+                raise
+            print(f"🔄 Almacén dañado ({e}), restaurando desde respaldo...")
+            shutil.copy2(self.backup_path, self.path)
+            conn = sqlite3.connect(self.path, check_same_thread=False, isolation_level=None)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+        conn.executescript(self.SCHEMA)
+        return conn
+    
+    def _connection(self):
+        """Conexión compartida, abierta en el primer uso (migra el JSON si hace falta)"""
+        with self._lock:
+            if self._conn is None:
+                self._conn = self._open()
+                self._migrate_legacy_json()
+                self._upgrade_points_format()
+            return self._conn
+    
+    @contextmanager
+    def _transaction(self):
+        """Transacción de escritura (BEGIN IMMEDIATE ... COMMIT / ROLLBACK)"""
+        with self._lock:
+            conn = self._connection()
+            conn.execute('BEGIN IMMEDIATE')
+            try:
+                yield conn
+                conn.execute('COMMIT')
+            except Exception:
+                conn.execute('ROLLBACK')
+                raise
+    
+    @staticmethod
+    def _encode(record):
+        return json.dumps(pack_image_record(record), ensure_ascii=False, separators=(',', ':'))
+    
+    def _write_image(self, conn, record):
+        conn.execute(
+            "INSERT INTO images (name, status, data, updated_at) VALUES (?, ?, ?, ?) "
+            "ON CONFLICT(name) DO UPDATE SET status = excluded.status, data = excluded.data, "
+            "updated_at = excluded.updated_at",
+            (record['name'], record.get('status'), self._encode(record), record.get('updatedAt'))
+        )
+    
+    def _set_meta(self, conn, key, value):
+        conn.execute("INSERT INTO meta (key, value) VALUES (?, ?) "
+                     "ON CONFLICT(key) DO UPDATE SET value = excluded.value", (key, json.dumps(value)))
+    
+    def set_meta(self, key, value):
+        with self._transaction() as conn:
+            self._set_meta(conn, key, value)
+    
+    def get_meta(self, key, default=None):
+        with self._lock:
+            row = self._connection().execute("SELECT value FROM meta WHERE key = ?", (key,)).fetchone()
+        return json.loads(row[0]) if row else default
+    
+    def get_image(self, name):
+        """Registro de una imagen por nombre (None si no existe)"""
+        with self._lock:
+            row = self._connection().execute("SELECT data FROM images WHERE name = ?", (name,)).fetchone()
+        return normalize_image_record(json.loads(row[0])) if row else None
+    
+    def upsert_image(self, record):
+        """Inserta o actualiza solo la fila de esta imagen"""
+        with self._transaction() as conn:
+            self._write_image(conn, record)
+            self._set_meta(conn, 'last_updated', datetime.now().isoformat())
+    
+    def upsert_images(self, records):
+        """Inserta o actualiza varias imágenes en una sola transacción"""
+        with self._transaction() as conn:
+            for record in records:
+                self._write_image(conn, record)
+            self._set_meta(conn, 'last_updated', datetime.now().isoformat())
+    
+    def count(self):
+        with self._lock:
+            return self._connection().execute("SELECT COUNT(*) FROM images").fetchone()[0]
+    
+    def data_version(self):
+        """Cambia solo cuando OTRA conexión (otro proceso) confirma cambios en el almacén"""
+        with self._lock:
+            return self._connection().execute("PRAGMA data_version").fetchone()[0]
+    
+    def load_document(self):
+        """Documento completo {"images": [...], ...} con el formato del antiguo JSON"""
+        with self._lock:
+            conn = self._connection()
+            rows = conn.execute("SELECT data FROM images ORDER BY rowid").fetchall()
+            meta_rows = conn.execute("SELECT key, value FROM meta").fetchall()
+        
+        data = {key: json.loads(value) for key, value in meta_rows if not key.startswith('_')}
+        data['images'] = [normalize_image_record(json.loads(row[0])) for row in rows]
+        data.setdefault('next_image_id', 1)
+        data.setdefault('last_updated', None)
+        return data
+    
+    def replace_all(self, data):
+        """Reemplaza todo el contenido por el documento indicado (una transacción)"""
+        with self._transaction() as conn:
+            conn.execute("DELETE FROM images")
+            conn.execute("DELETE FROM meta WHERE key NOT LIKE '\\_%' ESCAPE '\\'")
+            for record in data.get('images', []):
+                if isinstance(record, dict) and record.get('name'):
+                    self._write_image(conn, normalize_image_record(record))
+            for key, value in data.items():
+                if key != 'images':
+                    self._set_meta(conn, key, value)
+    
+    def get_upload(self, sha256):
+        """Registro de un archivo subido por su hash de contenido (None si no existe)"""
+        with self._lock:
+            cursor = self._connection().execute("SELECT * FROM uploads WHERE sha256 = ?", (sha256,))
+            row = cursor.fetchone()
+            return dict(zip([column[0] for column in cursor.description], row)) if row else None
+    
+    def record_upload(self, sha256, path, size, original_name):
+        """Registra una subida (o cuenta una repetición del mismo contenido)"""
+        now = datetime.now().isoformat()
+        with self._transaction() as conn:
+            conn.execute(
+                "INSERT INTO uploads (sha256, path, size, original_name, created_at, last_upload_at) "
+                "VALUES (?, ?, ?, ?, ?, ?) ON CONFLICT(sha256) DO UPDATE SET "
+                "path = excluded.path, uploads = uploads + 1, last_upload_at = excluded.last_upload_at",
+                (sha256, path, size, original_name, now, now)
+            )
+        return self.get_upload(sha256)
+    
+    def clear_uploads(self):
+        """Olvida todas las subidas y subidas por fragmentos (una transacción)"""
+        with self._transaction() as conn:
+            uploads = conn.execute("DELETE FROM uploads").rowcount
+            sessions = conn.execute("DELETE FROM upload_sessions").rowcount
+        return uploads, sessions
+    
+    def create_upload_session(self, session_id, filename, size, chunk_size, total_chunks, sha256=None):
+        """Registra una subida por fragmentos nueva"""
+        now = datetime.now().isoformat()
+        with self._transaction() as conn:
+            conn.execute(
+                "INSERT INTO upload_sessions (id, filename, size, chunk_size, total_chunks, sha256, created_at, updated_at) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                (session_id, filename, size, chunk_size, total_chunks, sha256, now, now)
+            )
+        return self.get_upload_session(session_id)
+    
+    def get_upload_session(self, session_id):
+        """Subida por fragmentos con la lista de fragmentos recibidos (None si no existe)"""
+        with self._lock:
+            cursor = self._connection().execute("SELECT * FROM upload_sessions WHERE id = ?", (session_id,))
+            row = cursor.fetchone()
+            if not row:
+                return None
+            session = dict(zip([column[0] for column in cursor.description], row))
+            session['received'] = json.loads(session['received'])
+            return session
+    
+    def mark_chunk_received(self, session_id, index):
+        """Añade un fragmento a la lista de recibidos (idempotente)"""
+        with self._transaction() as conn:
+            row = conn.execute("SELECT received FROM upload_sessions WHERE id = ?", (session_id,)).fetchone()
+            if row is None:
+                return None
+            received = set(json.loads(row[0]))
+            received.add(index)
+            conn.execute(
+                "UPDATE upload_sessions SET received = ?, updated_at = ? WHERE id = ?",
+                (json.dumps(sorted(received)), datetime.now().isoformat(), session_id)
+            )
+        return self.get_upload_session(session_id)
+    
+    def delete_upload_session(self, session_id):
+        with self._transaction() as conn:
+            conn.execute("DELETE FROM upload_sessions WHERE id = ?", (session_id,))
+    
+    def stale_upload_sessions(self, updated_before):
+        """Ids de subidas por fragmentos sin actividad desde la fecha ISO indicada"""
+        with self._lock:
+            rows = self._connection().execute(
+                "SELECT id FROM upload_sessions WHERE updated_at < ?", (updated_before,)
+            ).fetchall()
+            return [row[0] for row in rows]
+    
+    def _model_rows(self, where='', args=()):
+        with self._lock:
+            cursor = self._connection().execute(f"SELECT * FROM models {where} ORDER BY registered_at", args)
+            columns = [column[0] for column in cursor.description]
+            return [dict(zip(columns, row)) for row in cursor.fetchall()]
+    
+    def list_models(self):
+        """Versiones de modelo registradas, de la más antigua a la más reciente"""
+        return self._model_rows()
+    
+    def get_model(self, version):
+        rows = self._model_rows("WHERE version = ?", (version,))
+        return rows[0] if rows else None
+    
+    def find_model_by_hash(self, md5):
+        rows = self._model_rows("WHERE md5 = ?", (md5,))
+        return rows[0] if rows else None
+    
+    def add_model(self, version, path, md5, size, notes=None):
+        with self._transaction() as conn:
+            conn.execute(
+                "INSERT INTO models (version, path, md5, size, notes, registered_at) VALUES (?, ?, ?, ?, ?, ?)",
+                (version, path, md5, size, notes, datetime.now().isoformat())
+            )
+        return self.get_model(version)
+    
+    def backup(self, destination):
+        """Copia consistente del almacén (API de respaldo de SQLite)"""
+        with self._lock:
+            target = sqlite3.connect(destination)
+            try:
+                self._connection().backup(target)
+            finally:
+                target.close()
+    
+    def _migrate_legacy_json(self, candidates=None, force=False):
+        """Importa slab_data.json (o su respaldo) la primera vez que se abre el almacén"""
+        if not force and self.get_meta('_migrated_from_json'):
+            return 0
+        
+        legacy_data, source = load_legacy_json_data(candidates)
+        imported = 0
+        with self._transaction() as conn:
+            has_rows = conn.execute("SELECT 1 FROM images LIMIT 1").fetchone() is not None
+            if legacy_data and (force or not has_rows):
+                if force:
+                    conn.execute("DELETE FROM images")
+                for record in legacy_data['images']:
+                    self._write_image(conn, record)
+                    imported += 1
+                for key in ('next_image_id', 'last_updated', 'optimized_at'):
+                    if key in legacy_data:
+                        self._set_meta(conn, key, legacy_data[key])
+            self._set_meta(conn, '_migrated_from_json', {
+                'source': source,
+                'images': imported,
+                'at': datetime.now().isoformat()
+            })
+        
+        if imported:
+            print(f"📦 Migración a SQLite: {imported} imágenes importadas desde {source}")
+        return imported
+    
+    def _upgrade_points_format(self):
+        """Reescribe una sola vez las filas con puntos como lista de objetos (o en un formato
+        columnar anterior) al formato columnar actual"""
+        if self.get_meta('_points_format') == POINTS_FORMAT:
+            return 0
+        
+        upgraded = 0
+        with self._transaction() as conn:
+            for (data,) in conn.execute("SELECT data FROM images").fetchall():
+                record = json.loads(data)
+                points = record.get('manualPoints')
+                if isinstance(points, list) or (isinstance(points, dict) and points.get('format') != POINTS_FORMAT):
+                    self._write_image(conn, normalize_image_record(record))
+                    upgraded += 1
+            self._set_meta(conn, '_points_format', POINTS_FORMAT)
+        
+        if upgraded:
+            print(f"📐 Puntos convertidos a formato columnar en {upgraded} imágenes")
+        return upgraded
+    
+    def migrate_from_json(self, candidates=None):
+        """Reimporta manualmente un archivo JSON (reemplaza las imágenes actuales)"""
+        self._connection()
+        return self._migrate_legacy_json(candidates, force=True)
+
+store = SlabStore(STORE_FILE, STORE_BACKUP)
+
+class PersistentStateCache:
+    """Estado persistente en memoria (dict por nombre de imagen) sobre el SlabStore
+
+    Las lecturas se sirven desde memoria sin tocar el disco. Las escrituras
+    actualizan la memoria, marcan la imagen como sucia y un hilo escritor las
+    agrupa: espera `flush_interval` segundos desde el primer cambio pendiente y
+    escribe todas las imágenes sucias en una sola transacción. Si otro proceso
+    modifica el almacén (PRAGMA data_version), el estado se recarga conservando
+    los cambios locales aún no escritos.
+    """
+
+    def __init__(self, store, flush_interval=1.0, check_interval=1.0):
+        self.store = store
+        self.flush_interval = flush_interval
+        self.check_interval = check_interval
+        self._lock = threading.RLock()
+        self._flush_lock = threading.Lock()  # Siempre se toma ANTES que _lock
+        self._images = None  # OrderedDict nombre -> registro (orden del almacén)
+        self._meta = {}
+        self._dirty = {}  # nombre -> versión del cambio pendiente
+        self._version = 0
+        self._data_version = None
+        self._last_check = 0.0
+        self._wakeup = threading.Event()
+        self._writer = None
+        self._etag = None  # ETag del documento completo (se invalida con cada cambio)
+        self._stats = {'reloads': 0, 'flushes': 0, 'flushed_images': 0, 'flush_errors': 0}
+
+    def _ensure_loaded(self):
+        """Carga el estado la primera vez y lo recarga si otro proceso escribió (requiere _lock)"""
+        now = time.monotonic()
+        if self._images is not None and now - self._last_check < self.check_interval:
+            return
+        self._last_check = now
+        data_version = self.store.data_version()
+        if self._images is not None and data_version == self._data_version:
+            return
+
+        document = self.store.load_document()
+        images = OrderedDict((img['name'], img) for img in document.pop('images'))
+        if self._images is not None:
+            print(f"🔄 Cambios externos en {self.store.path}, recargando estado en memoria")
+            # Los cambios locales aún no escritos tienen prioridad
+            for name in self._dirty:
+                images[name] = self._images[name]
+        self._images = images
+        self._meta = document
+        self._data_version = data_version
+        self._etag = None
+        self._stats['reloads'] += 1
+
+    def get_image(self, name):
+        """Copia del registro de una imagen (None si no existe)"""
+        with self._lock:
+            self._ensure_loaded()
+            record = self._images.get(name)
+            return dict(record) if record is not None else None
+
+    def count(self):
+        with self._lock:
+            self._ensure_loaded()
+            return len(self._images)
+    
+    def names(self):
+        """Nombres de las imágenes en orden del almacén"""
+        with self._lock:
+            self._ensure_loaded()
+            return list(self._images)
+
+    def find_images(self, predicate):
+        """Copias de los registros que cumplen predicate(registro), sin copiar el resto"""
+        with self._lock:
+            self._ensure_loaded()
+            return [dict(record) for record in self._images.values() if predicate(record)]
+    
+    def document_etag(self):
+        """ETag del documento completo sin serializarlo (revisión y hash de cada imagen + metadatos)"""
+        with self._lock:
+            self._ensure_loaded()
+            if self._etag is None:
+                digest = hashlib.sha256(json.dumps(self._meta, sort_keys=True, default=str).encode('utf-8'))
+                for name, record in self._images.items():
+                    digest.update(f"\n{name}\t{image_etag(record)}".encode('utf-8'))
+                self._etag = digest.hexdigest()[:32]
+            return self._etag
+    
+    def load_document(self):
+        """Documento completo {"images": [...], ...} desde memoria"""
+        with self._lock:
+            self._ensure_loaded()
+            data = dict(self._meta)
+            data['images'] = [dict(record) for record in self._images.values()]
+            return data
+
+    def upsert_image(self, record):
+        self.upsert_images([record])
+
+    def upsert_images(self, records):
+        """Actualiza la memoria y programa la escritura diferida"""
+        with self._lock:
+            self._ensure_loaded()
+            for record in records:
+                self._version += 1
+                record = normalize_image_record(dict(record))
+                record['contentHash'] = image_content_hash(record)
+                self._images[record['name']] = record
+                self._dirty[record['name']] = self._version
+            self._meta['last_updated'] = datetime.now().isoformat()
+            self._etag = None
+        self._schedule_flush()
 
-@contextmanager
-def persistence_file_lock():
-    """Context manager para bloqueo seguro del archivo de persistencia"""
-    with _persistence_lock:
-        yield
+    def replace_all(self, data):
+        """Reemplaza todo el contenido (se escribe de inmediato, descarta cambios pendientes)"""
+        with self._flush_lock, self._lock:
+            self.store.replace_all(data)
+            self._dirty.clear()
+            self._images = None
+            self._last_check = 0.0
+            self._ensure_loaded()
 
-def calculate_file_hash(filepath):
-    """Calcula hash MD5 de un archivo para verificar integridad"""
-    try:
-        hash_md5 = hashlib.md5()
-        with open(filepath, "rb") as f:
-            for chunk in iter(lambda: f.read(4096), b""):
-                hash_md5.update(chunk)
-        return hash_md5.hexdigest()
-    except:
-        return None
+    def set_meta(self, key, value):
+        with self._lock:
+            self._ensure_loaded()
+            self.store.set_meta(key, value)
+            self._meta[key] = value
+            self._etag = None
+
+    def _schedule_flush(self):
+        if self.flush_interval <= 0:
+            self.flush()
+            return
+        with self._lock:
+            if self._writer is None or not self._writer.is_alive():
+                self._writer = threading.Thread(target=self._writer_loop, name='persist-writer', daemon=True)
+                self._writer.start()
+        self._wakeup.set()
+
+    def _writer_loop(self):
+        while True:
+            self._wakeup.wait()
+            # Ventana de agrupación: los cambios que lleguen mientras tanto salen en la misma escritura
+            time.sleep(self.flush_interval)
+            self._wakeup.clear()
+            self.flush()
+
+    def flush(self):
+        """Escribe las imágenes sucias en una transacción; retorna cuántas se escribieron"""
+        with self._flush_lock:
+            with self._lock:
+                if not self._dirty:
+                    return 0
+                pending = dict(self._dirty)
+                records = [self._images[name] for name in pending if name in self._images]
+
+            try:
+                self.store.upsert_images(records)
+            except Exception as e:
+                # Quedan sucias y se reintentan en la siguiente escritura
+                self._stats['flush_errors'] += 1
+                print(f"❌ Error escribiendo estado persistente: {e}")
+                return 0
+
+            with self._lock:
+                for name, version in pending.items():
+                    # Si se modificó durante la escritura, sigue sucia
+                    if self._dirty.get(name) == version:
+                        del self._dirty[name]
+                self._stats['flushes'] += 1
+                self._stats['flushed_images'] += len(records)
+            return len(records)
+
+    def status(self):
+        with self._lock:
+            return {
+                'loaded': self._images is not None,
+                'images': len(self._images) if self._images is not None else None,
+                'dirty': len(self._dirty),
+                'flush_interval': self.flush_interval,
+                **self._stats
+            }
+
+state_cache = PersistentStateCache(store, PERSIST_FLUSH_INTERVAL, PERSIST_CHECK_INTERVAL)
+model_registry = ModelRegistry(store, MODEL_REGISTRY_FOLDER)
+atexit.register(state_cache.flush)  # Escribir los cambios pendientes al cerrar
 
 def create_backup_if_needed():
-    """Crea respaldo del archivo de persistencia si es necesario"""
+    """Crea respaldo del almacén de persistencia si es necesario"""
     try:
-        if os.path.exists(PERSISTENCE_FILE):
-            # Verificar si necesita respaldo (cada hora)
-            backup_needed = True
-            if os.path.exists(PERSISTENCE_BACKUP):
-                persistence_time = os.path.getmtime(PERSISTENCE_FILE)
-                backup_time = os.path.getmtime(PERSISTENCE_BACKUP)
-                backup_needed = (persistence_time - backup_time) > 3600  # 1 hora
-            
-            if backup_needed:
-                shutil.copy2(PERSISTENCE_FILE, PERSISTENCE_BACKUP)
-                print(f"💾 Respaldo creado: {PERSISTENCE_BACKUP}")
+        # Verificar si necesita respaldo (cada hora)
+        backup_needed = True
+        if os.path.exists(STORE_BACKUP):
+            backup_needed = (time.time() - os.path.getmtime(STORE_BACKUP)) > 3600  # 1 hora
+        
+        if backup_needed:
+            state_cache.flush()
+            store.backup(STORE_BACKUP)
+            print(f"💾 Respaldo creado: {STORE_BACKUP}")
+        return True
     except Exception as e:
         print(f"⚠️ Error creando respaldo: {e}")
+        return False
 
 def load_persistent_data():
-    """Carga datos persistentes desde archivo JSON con validación robusta"""
+    """Carga el documento completo de datos persistentes desde el almacén"""
     with persistence_file_lock():
-        # Intentar cargar archivo principal
-        for attempt_file in [PERSISTENCE_FILE, PERSISTENCE_BACKUP]:
-            if not os.path.exists(attempt_file):
-                continue
-                
-            try:
-                with open(attempt_file, 'r', encoding='utf-8') as f:
-                    data = json.load(f)
-                
-                # Validar estructura básica
-                if not isinstance(data, dict):
-                    raise ValueError("Datos no tienen estructura dict")
-                
-                if 'images' not in data:
-                    data['images'] = []
-                
-                # Validar cada imagen
-                valid_images = []
-                for img in data.get('images', []):
-                    if isinstance(img, dict) and 'name' in img:
-                        # Asegurar campos requeridos
-                        img.setdefault('status', 'loaded')
-                        img.setdefault('manualPoints', [])
-                        img.setdefault('batches', [])
-                        img.setdefault('nextPointId', 1)
-                        valid_images.append(img)
-                
-                data['images'] = valid_images
-                data.setdefault('next_image_id', 1)
-                data.setdefault('last_updated', None)
-                
-                # Si es el respaldo, restaurar al principal
-                if attempt_file == PERSISTENCE_BACKUP:
-                    print(f"🔄 Restaurando desde respaldo...")
-                    save_persistent_data_internal(data)
-                
-                print(f"✅ Datos cargados: {len(data.get('images', []))} imágenes")
-                return data
-                
-            except Exception as e:
-                print(f"❌ Error con {attempt_file}: {e}")
-                continue
-        
-        # Si no se pudo cargar ningún archivo, crear estructura nueva
-        print("🆕 Creando estructura de datos nueva")
-        return {"images": [], "next_image_id": 1, "last_updated": None}
+        try:
+            data = state_cache.load_document()
+            print(f"✅ Datos cargados: {len(data.get('images', []))} imágenes")
+            return data
+        except Exception as e:
+            print(f"❌ Error cargando datos: {e}")
+            print("🆕 Creando estructura de datos nueva")
+            return {"images": [], "next_image_id": 1, "last_updated": None}
 
 def save_persistent_data_internal(data):
     """Función interna para guardar sin bloqueo (ya debe estar en contexto de bloqueo)"""
     try:
         data["last_updated"] = datetime.now().isoformat()
-        
-        # Escribir a archivo temporal primero (operación atómica)
-        with tempfile.NamedTemporaryFile(mode='w', encoding='utf-8', 
-                                         dir=DATA_FOLDER, delete=False) as temp_file:
-            json.dump(data, temp_file, indent=2, ensure_ascii=False)
-            temp_filename = temp_file.name
-        
-        # Verificar que se escribió correctamente
-        try:
-            with open(temp_filename, 'r', encoding='utf-8') as f:
-                test_data = json.load(f)
-            if len(test_data.get('images', [])) != len(data.get('images', [])):
-                raise ValueError("Verificación de integridad falló")
-        except Exception as e:
-            os.unlink(temp_filename)
-            raise e
-        
-        # Mover archivo temporal al definitivo (operación atómica)
-        shutil.move(temp_filename, PERSISTENCE_FILE)
-        
+        state_cache.replace_all(data)
         print(f"💾 Datos guardados: {len(data.get('images', []))} imágenes")
         return True
         
@@ -451,19 +3491,14 @@ def save_persistent_data_internal(data):
         return False
 
 def save_persistent_data(data):
-    """Guarda datos persistentes en archivo JSON de forma segura"""
+    """Guarda el documento completo de datos persistentes de forma segura"""
     with persistence_file_lock():
         create_backup_if_needed()
         return save_persistent_data_internal(data)
 
 def find_image_data_by_name(filename):
-    """Busca datos de imagen por nombre de archivo de forma segura"""
-    with persistence_file_lock():
-        persistent_data = load_persistent_data()
-        for img_data in persistent_data.get('images', []):
-            if img_data.get('name') == filename:
-                return img_data.copy()  # Retornar copia para evitar modificaciones accidentales
-        return None
+    """Busca datos de imagen por nombre (desde el estado en memoria)"""
+    return state_cache.get_image(filename)
 
 def verify_image_exists_and_has_data(filename):
     """Verifica si una imagen existe y tiene datos de lotes"""
@@ -480,46 +3515,59 @@ def verify_image_exists_and_has_data(filename):
     else:
         return False, f"Imagen en estado '{status}' sin datos de lotes"
 
-def save_image_data(image_data):
-    """Guarda o actualiza datos de una imagen específica de forma robusta"""
+class RevisionConflictError(Exception):
+    """El cliente guardó sobre una revisión que ya no es la actual (HTTP 409)"""
+    
+    def __init__(self, record, revision):
+        super().__init__(f"Revisión desactualizada (actual: {revision})")
+        self.record = record
+        self.revision = revision
+
+def save_image_data(image_data, base_revision=None):
+    """Guarda o actualiza datos de una imagen específica de forma robusta
+    
+    base_revision es la revisión sobre la que el cliente hizo sus cambios; si la
+    imagen ya va por otra no se guarda nada y se lanza RevisionConflictError.
+    Sin base_revision (clientes anteriores) se guarda sin comprobar.
+    Retorna la nueva revisión de la imagen (o False si no se pudo guardar).
+    """
     if not image_data or not image_data.get('name'):
         print("❌ Error: Datos de imagen inválidos")
         return False
     
     with persistence_file_lock():
-        persistent_data = load_persistent_data()
-        
-        # Buscar si ya existe
-        existing_index = -1
-        for i, img_data in enumerate(persistent_data.get('images', [])):
-            if img_data.get('name') == image_data.get('name'):
-                existing_index = i
-                break
+        existing_data = state_cache.get_image(image_data.get('name'))
+        current_revision = (existing_data or {}).get('revision', 0)
+        if isinstance(base_revision, int) and base_revision != current_revision:
+            print(f"⚠️ Guardado rechazado para {image_data.get('name')}: revisión {base_revision}, actual {current_revision}")
+            raise RevisionConflictError(existing_data, current_revision)
         
         # Preparar datos OPTIMIZADOS para guardar (solo lo esencial)
         detection_summary = None
         if image_data.get('detectionData'):
             # Solo guardar resumen de detección, NO los datos completos pesados
+            previous_summary = (existing_data or {}).get('detectionSummary') or {}
             detection_summary = {
                 'count': image_data['detectionData'].get('count', 0),
                 'confidence_used': image_data.get('confidence_used', 0.60),
+                'model_version': image_data['detectionData'].get('model_version') or previous_summary.get('model_version'),
                 'detected_at': datetime.now().isoformat()
             }
         
         # Preservar datos existentes importantes
-        existing_data = {}
-        if existing_index >= 0:
-            existing_data = persistent_data['images'][existing_index]
+        is_new = existing_data is None
+        existing_data = existing_data or {}
         
         data_to_save = {
             'name': image_data.get('name'),
             'status': image_data.get('status', existing_data.get('status', 'loaded')),
-            'manualPoints': image_data.get('manualPoints', existing_data.get('manualPoints', [])),
+            'manualPoints': decode_points(image_data.get('manualPoints', existing_data.get('manualPoints', []))),
             'batches': image_data.get('batches', existing_data.get('batches', [])),
             'nextPointId': image_data.get('nextPointId', existing_data.get('nextPointId', 1)),
             'detectionSummary': detection_summary or existing_data.get('detectionSummary'),
             'createdAt': existing_data.get('createdAt', datetime.now().isoformat()),
-            'updatedAt': datetime.now().isoformat()
+            'updatedAt': datetime.now().isoformat(),
+            'revision': existing_data.get('revision', 0) + 1
         }
         
         # Validar datos antes de guardar
@@ -528,20 +3576,22 @@ def save_image_data(image_data):
         if not isinstance(data_to_save['batches'], list):
             data_to_save['batches'] = []
         
-        if existing_index >= 0:
-            # Actualizar existente
-            persistent_data['images'][existing_index] = data_to_save
-            print(f"🔄 Datos actualizados para: {image_data.get('name')}")
-        else:
-            # Agregar nuevo
-            persistent_data['images'].append(data_to_save)
-            print(f"➕ Nuevos datos guardados para: {image_data.get('name')}")
-        
         # Sincronizar con base de datos CSV si tiene lotes
         if data_to_save['status'] == 'with-batches' and data_to_save['batches']:
             sync_with_database(data_to_save)
         
-        return save_persistent_data_internal(persistent_data)
+        try:
+            # Se escribe en memoria; el escritor en segundo plano lo lleva al almacén
+            state_cache.upsert_image(data_to_save)
+        except Exception as e:
+            print(f"❌ Error guardando datos: {e}")
+            return False
+        
+        if is_new:
+            print(f"➕ Nuevos datos guardados para: {image_data.get('name')}")
+        else:
+            print(f"🔄 Datos actualizados para: {image_data.get('name')}")
+        return data_to_save['revision']
 
 def sync_with_database(image_data):
     """Sincroniza datos de imagen con la base de datos CSV"""
@@ -550,14 +3600,10 @@ def sync_with_database(image_data):
             return
         
         with _database_lock:
-            # Verificar si ya existe en CSV
-            existing_records = leer_base_datos_historica()
             image_name = image_data['name']
             
-            # Remover registros antiguos de esta imagen
-            filtered_records = [r for r in existing_records if r['nombre_imagen'] != image_name]
-            
-            # Agregar registros actuales
+            # Registros actuales de la imagen
+            new_records = []
             for batch in image_data['batches']:
                 batch_number = batch.get('number', 'N/A')
                 slab_count = len([p for p in image_data.get('manualPoints', []) 
@@ -569,10 +3615,10 @@ def sync_with_database(image_data):
                     'numero_lote': str(batch_number),
                     'cantidad_slabs': str(slab_count)
                 }
-                filtered_records.append(new_record)
+                new_records.append(new_record)
             
-            # Escribir de vuelta al CSV
-            escribir_base_datos_historica(filtered_records)
+            # Lápida para los registros antiguos de esta imagen y anexo de los nuevos (sin reescribir el CSV)
+            history_log.replace_image(image_name, new_records)
             
     except Exception as e:
         print(f"⚠️ Error sincronizando con CSV: {e}")
@@ -607,93 +3653,1112 @@ def clean_csv_database():
             with open(DATABASE_FILE, 'w', newline='', encoding='utf-8') as file:
                 writer = csv.writer(file)
                 writer.writerow(['fecha', 'nombre_imagen', 'numero_lote', 'cantidad_slabs'])
+            history_log.reset()
             print(f"🗑️ CSV reinicializado con solo headers: {DATABASE_FILE}")
             
-            print(f"🗑️ CSV histórico limpiado exitosamente. Eliminados {registros_existentes} registros")
-            return True
+            print(f"🗑️ CSV histórico limpiado exitosamente. Eliminados {registros_existentes} registros")
+            return True
+            
+    except Exception as e:
+        print(f"❌ Error limpiando CSV: {e}")
+        return False
+
+def clean_uploaded_images():
+    """Limpia todas las imágenes subidas del directorio uploads
+    
+    Incluye las subidas por contenido (uploads/sha256/), los fragmentos en curso
+    (uploads/sessions/) y las imágenes derivadas (uploads/derived/), y olvida sus
+    registros en el almacén para que /upload/exists y /images no sirvan nada borrado.
+    """
+    try:
+        if not os.path.exists(UPLOAD_FOLDER):
+            print("📁 Directorio uploads no existe")
+            store.clear_uploads()
+            return True, 0
+        
+        # Archivos sueltos del formato anterior en la raíz de uploads
+        file_paths = [os.path.join(UPLOAD_FOLDER, f) for f in os.listdir(UPLOAD_FOLDER)
+                      if f.lower().endswith(('.png', '.jpg', '.jpeg', '.bmp', '.tiff', '.webp'))]
+        for folder in (UPLOAD_HASH_FOLDER, UPLOAD_SESSIONS_FOLDER, DERIVED_FOLDER):
+            for root, _, names in os.walk(folder):
+                file_paths.extend(os.path.join(root, name) for name in names)
+        
+        deleted_count = 0
+        for file_path in file_paths:
+            try:
+                if os.path.isfile(file_path):
+                    os.remove(file_path)
+                    deleted_count += 1
+                    print(f"🗑️ Imagen eliminada: {os.path.relpath(file_path, UPLOAD_FOLDER)}")
+            except Exception as e:
+                print(f"⚠️ Error eliminando {file_path}: {e}")
+        
+        # Subcarpetas de hash ya vacías (uploads/sha256/ab/)
+        for root, dirs, _ in os.walk(UPLOAD_HASH_FOLDER, topdown=False):
+            for name in dirs:
+                try:
+                    os.rmdir(os.path.join(root, name))
+                except OSError:
+                    pass
+        
+        uploads, sessions = store.clear_uploads()
+        print(f"✅ {deleted_count} archivos eliminados del directorio uploads "
+              f"({uploads} subidas y {sessions} subidas por fragmentos olvidadas)")
+        return True, deleted_count
+        
+    except Exception as e:
+        print(f"❌ Error limpiando imágenes: {e}")
+        return False, str(e)
+
+def optimize_persistent_data():
+    """Optimiza la persistencia eliminando datos pesados innecesarios de cada imagen
+    
+    Solo escribe si alguna imagen tiene campos sobrantes; si no, no toca el almacén.
+    """
+    optimized_keys = ('name', 'status', 'manualPoints', 'batches', 'nextPointId',
+                      'detectionSummary', 'createdAt', 'updatedAt', 'revision', 'contentHash')
+    with persistence_file_lock():
+        try:
+            # Reescribir solo las imágenes con campos sobrantes (p. ej. detectionData pesado)
+            changed = [{key: img_data.get(key) for key in optimized_keys}
+                       for img_data in state_cache.find_images(lambda record: not set(record) <= set(optimized_keys))]
+            
+            if not changed:
+                print(f"✅ Persistencia ya optimizada ({state_cache.count()} imágenes), nada que reescribir")
+                return True
+            
+            state_cache.upsert_images(changed)
+            state_cache.set_meta('optimized_at', datetime.now().isoformat())
+            
+            print(f"✅ Persistencia optimizada: {len(changed)} de {state_cache.count()} imágenes reescritas")
+            return True
+            
+        except Exception as e:
+            print(f"❌ Error optimizando persistencia: {e}")
+            return False
+
+def escribir_base_datos_historica(registros):
+    """Reescribe la base de datos CSV completa de forma segura (reemplazo atómico)"""
+    try:
+        history_log.rewrite(registros)
+    except Exception as e:
+        print(f"❌ Error escribiendo CSV: {e}")
+        raise e
+
+# ===== EDICIÓN INCREMENTAL DE ANOTACIONES =====
+
+class ImageOpError(ValueError):
+    """Operación de edición inválida (se rechaza todo el lote de operaciones)"""
+
+def _find_point(points, point_id):
+    for point in points:
+        if point.get('id') == point_id:
+            return point
+    raise ImageOpError(f"Punto {point_id} no existe")
+
+def _find_batch(batches, number=None, batch_id=None):
+    """Lote por id (si se indica) o el más reciente con ese número"""
+    for batch in reversed(batches):
+        if batch_id is not None:
+            if batch.get('id') == batch_id:
+                return batch
+        elif batch.get('number') == number:
+            return batch
+    raise ImageOpError(f"Lote {batch_id if batch_id is not None else number} no existe")
+
+def _batch_entry_id(entry):
+    # Los lotes guardan ids sueltos o {id, x, y} según la ruta de la UI que los creó
+    return entry.get('id') if isinstance(entry, dict) else entry
+
+def _unlink_point(batches, point_id):
+    for batch in batches:
+        batch['points'] = [entry for entry in batch.get('points', []) if _batch_entry_id(entry) != point_id]
+
+def _link_point(batch, point):
+    entries = batch.setdefault('points', [])
+    if entries and isinstance(entries[0], dict):
+        entries.append({'id': point['id'], 'x': point.get('x'), 'y': point.get('y')})
+    else:
+        entries.append(point['id'])
+
+def _op_add_point(record, op):
+    point = dict(op.get('point') or {})
+    if 'x' not in point or 'y' not in point:
+        raise ImageOpError("add_point requiere point.x y point.y")
+    if point.get('id') is None:
+        point['id'] = record['nextPointId']
+    if any(p.get('id') == point['id'] for p in record['manualPoints']):
+        raise ImageOpError(f"Punto {point['id']} ya existe")
+    point.setdefault('confidence', 1.0)
+    point.setdefault('isOriginal', False)
+    point.setdefault('batchNumber', None)
+    point['isSelected'] = False
+    record['manualPoints'].append(point)
+    if isinstance(point['id'], int):
+        record['nextPointId'] = max(record['nextPointId'], point['id'] + 1)
+    if point['batchNumber'] is not None:
+        _link_point(_find_batch(record['batches'], point['batchNumber'], op.get('batch_id')), point)
+
+def _op_move_point(record, op):
+    point = _find_point(record['manualPoints'], op.get('id'))
+    point['x'], point['y'] = op['x'], op['y']
+    point['isOriginal'] = False
+    # Los lotes con entradas {id, x, y} llevan una copia de la posición
+    for batch in record['batches']:
+        for entry in batch.get('points', []):
+            if isinstance(entry, dict) and entry.get('id') == point['id']:
+                entry['x'], entry['y'] = op['x'], op['y']
+
+def _op_delete_point(record, op):
+    point = _find_point(record['manualPoints'], op.get('id'))
+    record['manualPoints'].remove(point)
+    _unlink_point(record['batches'], point['id'])
+
+def _op_assign_point(record, op):
+    point = _find_point(record['manualPoints'], op.get('id'))
+    number = op.get('batch')
+    target = _find_batch(record['batches'], number, op.get('batch_id')) if number is not None or op.get('batch_id') is not None else None
+    _unlink_point(record['batches'], point['id'])
+    point['batchNumber'] = target.get('number') if target else None
+    point['isSelected'] = False
+    if target:
+        _link_point(target, point)
+        target['updatedAt'] = datetime.now().isoformat()
+
+def _op_create_batch(record, op):
+    batch = dict(op.get('batch') or {})
+    if batch.get('number') is None:
+        raise ImageOpError("create_batch requiere batch.number")
+    now = datetime.now().isoformat()
+    batch['points'] = []
+    batch['imageName'] = record['name']
+    batch.setdefault('createdAt', now)
+    batch.setdefault('updatedAt', now)
+    if batch.get('id') is not None and any(b.get('id') == batch['id'] for b in record['batches']):
+        raise ImageOpError(f"Lote {batch['id']} ya existe")
+    record['batches'].append(batch)
+
+def _op_rename_batch(record, op):
+    batch = _find_batch(record['batches'], op.get('number'), op.get('batch_id'))
+    new_number = op.get('new_number')
+    if new_number is None:
+        raise ImageOpError("rename_batch requiere new_number")
+    member_ids = {_batch_entry_id(entry) for entry in batch.get('points', [])}
+    for point in record['manualPoints']:
+        if point.get('id') in member_ids:
+            point['batchNumber'] = new_number
+    batch['number'] = new_number
+    batch['updatedAt'] = datetime.now().isoformat()
+
+def _op_delete_batch(record, op):
+    batch = _find_batch(record['batches'], op.get('number'), op.get('batch_id'))
+    member_ids = {_batch_entry_id(entry) for entry in batch.get('points', [])}
+    for point in record['manualPoints']:
+        if point.get('id') in member_ids:
+            point['batchNumber'] = None
+    record['batches'].remove(batch)
+
+def _op_set_status(record, op):
+    if not op.get('status'):
+        raise ImageOpError("set_status requiere status")
+    record['status'] = op['status']
+
+IMAGE_OPS = {
+    'add_point': _op_add_point,
+    'move_point': _op_move_point,
+    'delete_point': _op_delete_point,
+    'assign_point': _op_assign_point,
+    'create_batch': _op_create_batch,
+    'rename_batch': _op_rename_batch,
+    'delete_batch': _op_delete_batch,
+    'set_status': _op_set_status,
+}
+
+# Operaciones que cambian el recuento por lote (requieren sincronizar el CSV)
+BATCH_OPS = {'add_point', 'delete_point', 'assign_point', 'create_batch', 'rename_batch', 'delete_batch', 'set_status'}
+
+def apply_image_ops(name, revision, ops):
+    """Aplica una lista de operaciones sobre una sola imagen con control optimista de versión
+    
+    Todas las operaciones se aplican sobre una copia y se guardan juntas o ninguna.
+    Retorna (registro, None) o (None, (mensaje, código)).
+    """
+    if not isinstance(ops, list) or not ops:
+        return None, ("Se requiere una lista de operaciones", 400)
+    
+    with persistence_file_lock():
+        existing = state_cache.get_image(name)
+        if existing is None:
+            return None, ("No se encontraron datos para esta imagen", 404)
+        if revision != existing.get('revision', 0):
+            return None, (f"Revisión desactualizada (actual: {existing.get('revision', 0)})", 409)
+        
+        # Copia profunda de lo editable: el registro en memoria no se toca hasta confirmar
+        record = dict(existing)
+        record['manualPoints'] = [dict(point) for point in existing.get('manualPoints', [])]
+        record['batches'] = [dict(batch, points=[dict(entry) if isinstance(entry, dict) else entry
+                                                 for entry in batch.get('points', [])])
+                             for batch in existing.get('batches', [])]
+        
+        for index, op in enumerate(ops):
+            handler = IMAGE_OPS.get(op.get('op')) if isinstance(op, dict) else None
+            if handler is None:
+                return None, (f"Operación {index}: tipo desconocido", 400)
+            try:
+                handler(record, op)
+            except (ImageOpError, KeyError, TypeError) as e:
+                return None, (f"Operación {index} ({op.get('op')}): {e}", 400)
+        
+        record['revision'] = existing.get('revision', 0) + 1
+        record['updatedAt'] = datetime.now().isoformat()
+        
+        if record['status'] == 'with-batches' and any(op['op'] in BATCH_OPS for op in ops):
+            sync_with_database(record)
+        
+        state_cache.upsert_image(record)
+        print(f"✏️ {len(ops)} operaciones aplicadas a {name} (revisión {record['revision']})")
+        return record, None
+
+# ===== SUBIDAS POR CONTENIDO =====
+
+_upload_preprocessor = None
+_upload_preprocessor_lock = threading.Lock()
+
+def upload_content_path(content_id, extension):
+    """Ruta canónica de un archivo subido: uploads/sha256/<2 primeros>/<sha256>.<ext>"""
+    return os.path.join(UPLOAD_HASH_FOLDER, content_id[:2], f"{content_id}.{extension}")
+
+def store_upload(file):
+    """Guarda una subida por contenido, calculando el SHA-256 mientras se escribe
+    
+    Si el contenido ya existe, se descarta la copia nueva y se reutiliza el
+    archivo canónico. Retorna (registro de la tabla uploads, es_duplicado).
+    """
+    extension = file.filename.rsplit('.', 1)[1].lower()
+    os.makedirs(UPLOAD_HASH_FOLDER, exist_ok=True)
+    
+    sha256 = hashlib.sha256()
+    size = 0
+    with tempfile.NamedTemporaryFile(dir=UPLOAD_HASH_FOLDER, suffix='.part', delete=False) as temp_file:
+        temp_path = temp_file.name
+        try:
+            for chunk in iter(lambda: file.stream.read(UPLOAD_CHUNK_SIZE), b''):
+                sha256.update(chunk)
+                temp_file.write(chunk)
+                size += len(chunk)
+        except Exception:
+            temp_file.close()
+            os.remove(temp_path)
+            raise
+    return commit_upload(temp_path, sha256.hexdigest(), size, file.filename, extension)
+
+def commit_upload(temp_path, content_id, size, original_name, extension):
+    """Mueve un archivo temporal ya verificado a su ruta por contenido
+    
+    Si el contenido ya existía se borra el temporal. Retorna (registro, es_duplicado).
+    """
+    existing = store.get_upload(content_id)
+    if existing and os.path.exists(existing['path']):
+        os.remove(temp_path)
+        return store.record_upload(content_id, existing['path'], size, original_name), True
+    
+    final_path = upload_content_path(content_id, extension)
+    os.makedirs(os.path.dirname(final_path), exist_ok=True)
+    os.replace(temp_path, final_path)
+    return store.record_upload(content_id, final_path, size, original_name), False
+
+def preprocess_upload(filepath, content_id=None):
+    """Deja lista una imagen recién subida: hash para la caché de detección, decodificación y miniaturas"""
+    try:
+        started = time.perf_counter()
+        cached_file_hash(filepath)
+        detector._decode_for_inference(filepath)
+        if content_id:
+            image, _ = detector._decode_scaled(filepath, max(size for size in IMAGE_LEVELS.values() if size))
+            if image is not None:
+                build_image_pyramid(content_id, image)
+        print(f"🧮 Pre-decodificada: {filepath} ({(time.perf_counter() - started) * 1000:.0f}ms)")
+    except Exception as e:
+        print(f"⚠️ Error pre-decodificando {filepath}: {e}")
+
+def schedule_upload_preprocess(filepath, content_id=None):
+    """Encola preprocess_upload en un hilo de fondo (uno solo, para no competir con el modelo)"""
+    global _upload_preprocessor
+    if not UPLOAD_PREDECODE or detector.decoded is None:
+        return
+    with _upload_preprocessor_lock:
+        if _upload_preprocessor is None:
+            _upload_preprocessor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='upload-preprocess')
+    _upload_preprocessor.submit(preprocess_upload, filepath, content_id)
+
+def upload_response(record, duplicate, filename):
+    """Cuerpo JSON común de /upload, /upload_multiple, /uploads/<id>/complete y /upload/exists"""
+    return {
+        'success': True,
+        'filename': filename,
+        'filepath': record['path'],
+        'content_id': record['sha256'],
+        'duplicate': duplicate,
+        'images': {level: f"/images/{record['sha256']}/{level}" for level in IMAGE_LEVELS}
+    }
+
+# ===== IMÁGENES DERIVADAS (PIRÁMIDE) =====
+
+def derived_image_path(content_id, level):
+    return os.path.join(DERIVED_FOLDER, f"{content_id}_{level}.jpg")
+
+def _write_derived_image(content_id, level, image):
+    """Codifica y guarda una derivada con escritura atómica; retorna su ruta (None si falla)"""
+    ok, buffer = cv2.imencode('.jpg', image, [cv2.IMWRITE_JPEG_QUALITY, DERIVED_JPEG_QUALITY])
+    if not ok:
+        return None
+    path = derived_image_path(content_id, level)
+    os.makedirs(DERIVED_FOLDER, exist_ok=True)
+    with tempfile.NamedTemporaryFile(dir=DERIVED_FOLDER, suffix='.tmp', delete=False) as temp_file:
+        temp_file.write(buffer.tobytes())
+        temp_filename = temp_file.name
+    os.replace(temp_filename, path)
+    return path
+
+def build_image_pyramid(content_id, image):
+    """Genera los niveles reducidos que falten, cada uno a partir del anterior (más barato que desde el original)"""
+    levels = sorted((size, level) for level, size in IMAGE_LEVELS.items() if size)
+    built = 0
+    for size, level in reversed(levels):
+        image, _ = resize_to_max_side(image, size)
+        if not os.path.exists(derived_image_path(content_id, level)):
+            _write_derived_image(content_id, level, image)
+            built += 1
+    if built:
+        prune_cache_folder(DERIVED_FOLDER, DERIVED_MAX_MB, 'caché de imágenes derivadas')
+    return built
+
+def derived_image(content_id, level):
+    """Ruta de la imagen en el nivel pedido, generándola si hace falta (None si el contenido no existe)
+    
+    Las derivadas se nombran por hash de contenido: una vez escritas no cambian.
+    """
+    record = store.get_upload(content_id)
+    if not record or not os.path.exists(record['path']):
+        return None
+    if IMAGE_LEVELS[level] is None:
+        return record['path']
+    
+    path = derived_image_path(content_id, level)
+    if os.path.exists(path):
+        try:
+            os.utime(path)  # Marca de uso para expulsar primero las menos pedidas
+        except OSError:
+            pass
+        return path
+    
+    # La pirámide se genera desde una decodificación reducida al nivel más grande
+    image, _ = detector._decode_scaled(record['path'], max(size for size in IMAGE_LEVELS.values() if size))
+    if image is None:
+        return None
+    build_image_pyramid(content_id, image)
+    return path if os.path.exists(path) else None
+
+def handoff_to_detection(filepath, options):
+    """Encola la detección de un archivo recién subido (trabajo asíncrono)
+    
+    options admite los mismos parámetros que /detect. Retorna el bloque 'job'
+    de la respuesta: ids y URLs del trabajo, o el error si no pudo encolarse.
+    """
+    params, failure = parse_detect_params({**options, 'filepath': filepath})
+    if failure:
+        return {'error': failure[0]}
+    try:
+        job_id = detection_jobs.submit(params)
+    except SchedulerFullError as e:
+        return {'error': str(e), 'retry_after': INFERENCE_RETRY_AFTER}
+    return {
+        'job_id': job_id,
+        'status_url': f'/detect_jobs/{job_id}',
+        'result_url': f'/detect_jobs/{job_id}/result',
+        'events_url': f'/detect_jobs/{job_id}/events'
+    }
+
+def parse_flag(value):
+    """Interpreta un booleano de formulario o JSON ('detect', 'tiled', ...)"""
+    if isinstance(value, str):
+        return value.strip().lower() in ('1', 'true', 'yes', 'si', 'sí')
+    return bool(value)
+
+# ----- Subidas por fragmentos reanudables -----
+#
+# POST /uploads crea la sesión (nombre, tamaño y, opcionalmente, SHA-256 del
+# archivo completo). Cada fragmento se envía con PUT /uploads/<id>/chunks/<n>
+# junto con su checksum (X-Chunk-SHA256 o X-Chunk-CRC32) y se escribe en su
+# posición del archivo parcial, así que pueden llegar en cualquier orden o
+# repetirse. GET /uploads/<id> dice qué fragmentos faltan tras un corte y
+# POST /uploads/<id>/complete verifica el archivo y lo guarda por contenido.
+
+def _upload_session_part_path(session_id):
+    return os.path.join(UPLOAD_SESSIONS_FOLDER, f"{session_id}.part")
+
+def upload_session_view(session):
+    """Estado público de una subida por fragmentos"""
+    received = session['received']
+    return {
+        'upload_id': session['id'],
+        'filename': session['filename'],
+        'size': session['size'],
+        'chunk_size': session['chunk_size'],
+        'total_chunks': session['total_chunks'],
+        'received': received,
+        'missing': session['total_chunks'] - len(received),
+        'complete': len(received) == session['total_chunks'],
+        'chunk_url': f"/uploads/{session['id']}/chunks/{{index}}",
+        'updated_at': session['updated_at']
+    }
+
+def prune_upload_sessions():
+    """Descarta subidas por fragmentos abandonadas (más antiguas que UPLOAD_SESSION_TTL)"""
+    cutoff = (datetime.now() - timedelta(seconds=UPLOAD_SESSION_TTL)).isoformat()
+    for session_id in store.stale_upload_sessions(cutoff):
+        discard_upload_session(session_id)
+        print(f"🧹 Subida por fragmentos abandonada descartada: {session_id[:8]}")
+
+def discard_upload_session(session_id):
+    store.delete_upload_session(session_id)
+    part_path = _upload_session_part_path(session_id)
+    if os.path.exists(part_path):
+        os.remove(part_path)
+
+def create_upload_session(data):
+    """Valida y crea una subida por fragmentos; retorna (sesión, None) o (None, (mensaje, código))"""
+    data = data or {}
+    filename = data.get('filename') or ''
+    if not detector.allowed_file(filename):
+        return None, ('Invalid file type', 400)
+    
+    max_chunk = app.config['MAX_CONTENT_LENGTH']
+    try:
+        size = int(data.get('size'))
+        chunk_size = int(data.get('chunk_size') or UPLOAD_SESSION_CHUNK_MB * 1024 * 1024)
+    except (ValueError, TypeError):
+        return None, ('size y chunk_size deben ser enteros', 400)
+    if size <= 0 or size > UPLOAD_MAX_FILE_MB * 1024 * 1024:
+        return None, (f'Tamaño no permitido (máximo {UPLOAD_MAX_FILE_MB:g} MB)', 413)
+    if chunk_size <= 0 or chunk_size > max_chunk:
+        return None, (f'chunk_size debe estar entre 1 y {max_chunk} bytes', 400)
+    
+    sha256 = (data.get('sha256') or '').lower() or None
+    if sha256 and (len(sha256) != 64 or any(c not in '0123456789abcdef' for c in sha256)):
+        return None, ('sha256 debe ser un hash hexadecimal de 64 caracteres', 400)
+    
+    prune_upload_sessions()
+    os.makedirs(UPLOAD_SESSIONS_FOLDER, exist_ok=True)
+    session_id = uuid.uuid4().hex
+    with open(_upload_session_part_path(session_id), 'wb') as part_file:
+        part_file.truncate(size)
+    total_chunks = (size + chunk_size - 1) // chunk_size
+    session = store.create_upload_session(session_id, filename, size, chunk_size, total_chunks, sha256)
+    print(f"🧩 Subida por fragmentos {session_id[:8]}: {filename} ({size} bytes, {total_chunks} fragmentos)")
+    return session, None
+
+def write_upload_chunk(session, index, payload, checksums):
+    """Verifica y escribe un fragmento en su posición; retorna (sesión, None) o (None, (mensaje, código))"""
+    if index < 0 or index >= session['total_chunks']:
+        return None, (f"Fragmento fuera de rango (0-{session['total_chunks'] - 1})", 400)
+    
+    offset = index * session['chunk_size']
+    expected = min(session['chunk_size'], session['size'] - offset)
+    if len(payload) != expected:
+        return None, (f'El fragmento {index} debe tener {expected} bytes (recibidos {len(payload)})', 400)
+    
+    sha256, crc32 = checksums.get('sha256'), checksums.get('crc32')
+    if not sha256 and not crc32:
+        return None, ('Falta el checksum del fragmento (X-Chunk-SHA256 o X-Chunk-CRC32)', 400)
+    if sha256 and hashlib.sha256(payload).hexdigest() != sha256.lower():
+        return None, (f'Checksum SHA-256 incorrecto en el fragmento {index}', 422)
+    if crc32:
+        try:
+            valid = (zlib.crc32(payload) & 0xffffffff) == int(crc32, 16)
+        except ValueError:
+            valid = False
+        if not valid:
+            return None, (f'Checksum CRC32 incorrecto en el fragmento {index}', 422)
+    
+    with open(_upload_session_part_path(session['id']), 'r+b') as part_file:
+        part_file.seek(offset)
+        part_file.write(payload)
+    return store.mark_chunk_received(session['id'], index), None
+
+# Ensamblados en curso o recientes por id de sesión: un POST /complete repetido o concurrente
+# recibe el mismo resultado en vez de buscar un archivo parcial que ya se movió
+_completed_uploads = {}  # id -> (Future, instante de inicio, sesión)
+_completed_uploads_lock = threading.Lock()
+COMPLETED_UPLOAD_REPLAY = 600  # Segundos que se recuerda el resultado de un ensamblado
+
+def complete_upload_session(session):
+    """Ensambla la subida: verifica fragmentos y hash, y la guarda por contenido
+    
+    Idempotente: si la misma sesión ya se está completando (o se completó hace
+    poco) espera y retorna ese resultado.
+    Retorna ((registro, es_duplicado), None) o (None, (mensaje, código)).
+    """
+    missing = session['total_chunks'] - len(session['received'])
+    if missing:
+        return None, (f'Faltan {missing} fragmento(s)', 409)
+    
+    now = time.monotonic()
+    with _completed_uploads_lock:
+        for session_id, (future, started, _) in list(_completed_uploads.items()):
+            if future.done() and now - started > COMPLETED_UPLOAD_REPLAY:
+                del _completed_uploads[session_id]
+        entry = _completed_uploads.get(session['id'])
+        owner = entry is None
+        if owner:
+            entry = _completed_uploads[session['id']] = (Future(), now, session)
+    future = entry[0]
+    if not owner:
+        return future.result()
+    
+    try:
+        outcome = _assemble_upload_session(session)
+    except BaseException as e:
+        with _completed_uploads_lock:
+            _completed_uploads.pop(session['id'], None)
+        future.set_exception(e)
+        raise
+    if outcome[1]:
+        # Fallo verificable (hash distinto...): no se recuerda, se puede reintentar
+        with _completed_uploads_lock:
+            _completed_uploads.pop(session['id'], None)
+    future.set_result(outcome)
+    return outcome
+
+def recent_upload_session(session_id):
+    """Sesión ya borrada del almacén por un ensamblado en curso o reciente (None si no hay)"""
+    with _completed_uploads_lock:
+        entry = _completed_uploads.get(session_id)
+    return entry[2] if entry else None
+
+def _assemble_upload_session(session):
+    """Verifica el hash del archivo parcial y lo guarda por contenido (ver complete_upload_session)"""
+    part_path = _upload_session_part_path(session['id'])
+    sha256 = hashlib.sha256()
+    with open(part_path, 'rb') as part_file:
+        for chunk in iter(lambda: part_file.read(UPLOAD_CHUNK_SIZE), b''):
+            sha256.update(chunk)
+    content_id = sha256.hexdigest()
+    if session['sha256'] and session['sha256'] != content_id:
+        return None, ('El SHA-256 del archivo ensamblado no coincide con el declarado', 422)
+    
+    extension = session['filename'].rsplit('.', 1)[1].lower()
+    result = commit_upload(part_path, content_id, session['size'], session['filename'], extension)
+    store.delete_upload_session(session['id'])
+    return result, None
+
+# ===== EXPORTACIÓN DE DATOS =====
+
+EXPORT_COLUMNS = {
+    'historico': [('fecha', 'string'), ('nombre_imagen', 'string'), ('numero_lote', 'string'),
+                  ('cantidad_slabs', 'int64')],
+    'puntos': [('nombre_imagen', 'string'), ('punto_id', 'int64'), ('x', 'float64'), ('y', 'float64'),
+               ('numero_lote', 'string'), ('confianza', 'float64'), ('original', 'bool_'),
+               ('actualizado', 'string')],
+    'lotes': [('nombre_imagen', 'string'), ('numero_lote', 'string'), ('color', 'string'),
+              ('cantidad_puntos', 'int64'), ('creado', 'string')],
+}
+EXPORT_FORMATS = {'parquet': '.parquet', 'arrow': '.arrow', 'csv': '.csv', 'csv.gz': '.csv.gz', 'csv.zst': '.csv.zst'}
+
+def _in_date_range(value, desde, hasta):
+    day = (value or '')[:10]
+    return (not desde or day >= desde) and (not hasta or day <= hasta)
+
+def iter_export_rows(dataset, desde=None, hasta=None):
+    """Genera las filas de un conjunto exportable sin cargarlo completo en memoria
+    
+    historico: filas vivas del CSV en orden de fecha.
+    puntos:    un registro por manualPoint (filtrado por updatedAt de la imagen).
+    lotes:     un registro por lote (filtrado por createdAt del lote).
+    """
+    if dataset == 'historico':
+        hasta_completo = hasta + ' 23:59:59' if hasta else None
+        _, registros = history_log.query(desde=desde, hasta=hasta_completo)
+        for _, registro in registros:
+            try:
+                registro['cantidad_slabs'] = int(registro['cantidad_slabs'])
+            except ValueError:
+                registro['cantidad_slabs'] = None
+            yield registro
+        return
+    
+    for name in state_cache.names():
+        img_data = state_cache.get_image(name)
+        if img_data is None:
+            continue
+        if dataset == 'puntos':
+            if not _in_date_range(img_data.get('updatedAt'), desde, hasta):
+                continue
+            for point in img_data.get('manualPoints', []):
+                batch_number = point.get('batchNumber')
+                yield {
+                    'nombre_imagen': name,
+                    'punto_id': point.get('id'),
+                    'x': point.get('x'),
+                    'y': point.get('y'),
+                    'numero_lote': str(batch_number) if batch_number is not None else None,
+                    'confianza': point.get('confidence'),
+                    'original': point.get('isOriginal'),
+                    'actualizado': img_data.get('updatedAt')
+                }
+        else:
+            for batch in img_data.get('batches', []):
+                created = batch.get('createdAt') or img_data.get('updatedAt')
+                if not _in_date_range(created, desde, hasta):
+                    continue
+                yield {
+                    'nombre_imagen': name,
+                    'numero_lote': str(batch.get('number')),
+                    'color': batch.get('color'),
+                    'cantidad_puntos': len(batch.get('points', [])),
+                    'creado': created
+                }
+
+def _chunks(rows, size):
+    while True:
+        chunk = list(islice(rows, size))
+        if not chunk:
+            return
+        yield chunk
+
+def _csv_compressor(formato):
+    """Objeto con compress()/flush() para el formato CSV pedido (None = sin comprimir)"""
+    if formato == 'csv.gz':
+        return zlib.compressobj(6, zlib.DEFLATED, 31)  # wbits=31: contenedor gzip
+    if formato == 'csv.zst':
+        if zstandard is None:
+            raise ValueError("zstandard no está instalado; use formato 'csv.gz'")
+        return zstandard.ZstdCompressor(level=3).compressobj()
+    return None
+
+def export_csv_chunks(dataset, formato='csv.gz', desde=None, hasta=None, chunk_rows=None, stats=None):
+    """Genera el CSV exportado en bloques de bytes (comprimidos si corresponde)"""
+    compressor = _csv_compressor(formato)
+    fieldnames = [name for name, _ in EXPORT_COLUMNS[dataset]]
+    
+    def encode(text):
+        data = text.encode('utf-8')
+        return compressor.compress(data) if compressor else data
+    
+    buffer = io.StringIO(newline='')
+    writer = csv.DictWriter(buffer, fieldnames=fieldnames)
+    writer.writeheader()
+    yield encode(buffer.getvalue())
+    
+    for chunk in _chunks(iter_export_rows(dataset, desde, hasta), chunk_rows or EXPORT_CHUNK_ROWS):
+        buffer = io.StringIO(newline='')
+        writer = csv.DictWriter(buffer, fieldnames=fieldnames)
+        writer.writerows(chunk)
+        if stats is not None:
+            stats['rows'] = stats.get('rows', 0) + len(chunk)
+        block = encode(buffer.getvalue())
+        if block:
+            yield block
+    
+    if compressor:
+        yield compressor.flush()
+
+def export_dataset(dataset, formato, destination, desde=None, hasta=None, chunk_rows=None):
+    """Escribe un conjunto al archivo `destination` por bloques; retorna la cantidad de filas"""
+    chunk_rows = chunk_rows or EXPORT_CHUNK_ROWS
+    
+    if formato.startswith('csv'):
+        stats = {'rows': 0}
+        with open(destination, 'wb') as f:
+            for block in export_csv_chunks(dataset, formato, desde, hasta, chunk_rows, stats):
+                f.write(block)
+        return stats['rows']
+    
+    if pa is None:
+        raise ValueError("pyarrow no está instalado; use formato 'csv.gz' o 'csv.zst'")
+    
+    schema = pa.schema([(name, getattr(pa, type_name)()) for name, type_name in EXPORT_COLUMNS[dataset]])
+    if formato == 'parquet':
+        writer = pq.ParquetWriter(destination, schema, compression='zstd')
+    else:
+        writer = pa.ipc.new_file(destination, schema)
+    
+    total = 0
+    try:
+        # Cada bloque es un row group (Parquet) o un record batch (Arrow)
+        for chunk in _chunks(iter_export_rows(dataset, desde, hasta), chunk_rows):
+            writer.write_batch(pa.RecordBatch.from_pylist(chunk, schema=schema))
+            total += len(chunk)
+    finally:
+        writer.close()
+    return total
+
+def export_filename(dataset, formato, desde=None, hasta=None):
+    return f"{dataset}_{desde or 'inicio'}_{hasta or datetime.now().strftime('%Y-%m-%d')}{EXPORT_FORMATS[formato]}"
+
+# ===== PROCESAMIENTO POR LOTES (CLI) =====
+#
+# `python basic_slab_v11.py batch uploads/ --output results/backfill.jsonl`
+# procesa carpetas o patrones glob sin pasar por el servidor. Tras cada bloque
+# de imágenes la salida se sincroniza a disco y se añade una línea al archivo
+# <salida>.checkpoint con las imágenes terminadas y el tamaño válido de la
+# salida; al relanzar el mismo comando se descarta lo escrito después del
+# último checkpoint y se continúa con las imágenes pendientes (si la salida ya
+# no coincide con el checkpoint, el lote empieza de nuevo).
+
+BATCH_CSV_FIELDS = ['image', 'count', 'mean_confidence', 'error', 'model', 'processed_at']
+
+def collect_batch_inputs(inputs, recursive=False):
+    """Rutas de imagen (ordenadas y sin repetir) a partir de archivos, carpetas o patrones glob"""
+    paths = set()
+    for item in inputs:
+        if os.path.isdir(item):
+            pattern = os.path.join(item, '**', '*') if recursive else os.path.join(item, '*')
+            candidates = glob.glob(pattern, recursive=recursive)
+        elif glob.has_magic(item):
+            candidates = glob.glob(item, recursive=True)
+        else:
+            candidates = [item]
+        paths.update(
+            os.path.normpath(path) for path in candidates
+            if os.path.isfile(path) and detector.allowed_file(path)
+        )
+    return sorted(paths)
+
+def read_batch_checkpoint(checkpoint_path):
+    """(imágenes ya procesadas, bytes válidos de la salida) o (vacío, None) sin checkpoint"""
+    done, output_bytes = set(), None
+    if not os.path.exists(checkpoint_path):
+        return done, output_bytes
+    with open(checkpoint_path, 'r', encoding='utf-8') as f:
+        for line in f:
+            try:
+                entry = json.loads(line)
+            except json.JSONDecodeError:
+                break  # Última línea a medio escribir
+            done.update(entry['images'])
+            output_bytes = entry['output_bytes']
+    return done, output_bytes
+
+def batch_output_matches_checkpoint(output, output_bytes, formato, done):
+    """Comprueba que los primeros output_bytes de la salida contienen justo las imágenes del checkpoint
+    
+    Si la salida se borró, se truncó o se reemplazó, reanudar saltaría imágenes
+    cuyos resultados ya no están escritos.
+    """
+    if not os.path.exists(output) or os.path.getsize(output) < output_bytes:
+        return False
+    
+    def valid_lines():
+        remaining = output_bytes
+        with open(output, 'rb') as f:
+            for line in f:
+                if remaining <= 0:
+                    break
+                line = line[:remaining]
+                remaining -= len(line)
+                yield line.decode('utf-8')
+    
+    try:
+        if formato == 'csv':
+            images = [row['image'] for row in csv.DictReader(valid_lines())]
+        else:
+            images = [json.loads(line)['image'] for line in valid_lines() if line.strip()]
+    except (ValueError, KeyError, TypeError, csv.Error):
+        return False
+    return len(images) == len(done) and set(images) == done
+
+def batch_result_row(image_path, detections, error, model_name):
+    """Fila de resultado de una imagen (JSONL; en CSV se omite 'detections')"""
+    confidences = [d['confidence'] for d in detections] if detections else []
+    return {
+        'image': image_path,
+        'count': len(detections) if detections is not None else None,
+        'mean_confidence': round(sum(confidences) / len(confidences), 4) if confidences else None,
+        'error': error,
+        'model': model_name,
+        'processed_at': datetime.now().isoformat(),
+        'detections': detections
+    }
+
+def run_batch(image_paths, output, formato='jsonl', confidence=0.60, batch_size=None,
+              checkpoint_every=None, resume=True):
+    """Detecta sobre image_paths escribiendo los resultados en output a medida que avanza
+    
+    Retorna un resumen con imágenes procesadas, errores, palanquillas y velocidad.
+    """
+    batch_size = max(1, int(batch_size or DETECT_BATCH_SIZE))
+    checkpoint_every = max(batch_size, int(checkpoint_every or batch_size * 8))
+    checkpoint_path = output + '.checkpoint'
+    
+    done, output_bytes = read_batch_checkpoint(checkpoint_path) if resume else (set(), None)
+    if output_bytes is not None and not batch_output_matches_checkpoint(output, output_bytes, formato, done):
+        print("⚠️ La salida no coincide con el checkpoint (borrada, truncada o de otro formato): se reinicia el lote")
+        output_bytes = None
+    if output_bytes is None:
+        output_bytes = 0
+        done = set()
+        if os.path.exists(checkpoint_path):
+            os.remove(checkpoint_path)
+    pending = [path for path in image_paths if path not in done]
+    if done:
+        print(f"🔁 Reanudando: {len(done)} imágenes ya procesadas, {len(pending)} pendientes")
+    
+    model_name = detector.model_version or os.path.basename(detector.model_path)
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    
+    summary = {'images': 0, 'errors': 0, 'slabs': 0, 'skipped': len(image_paths) - len(pending)}
+    started = time.perf_counter()
+    with open(output, 'a', encoding='utf-8', newline='') as out:
+        out.truncate(output_bytes)  # Descarta lo escrito después del último checkpoint
+        writer = None
+        if formato == 'csv':
+            writer = csv.DictWriter(out, fieldnames=BATCH_CSV_FIELDS, extrasaction='ignore')
+            if output_bytes == 0:
+                writer.writeheader()
+        
+        for start in range(0, len(pending), checkpoint_every):
+            block = pending[start:start + checkpoint_every]
+            outputs = detector.detect_slabs_batch(block, confidence, batch_size, log=False)
+            for image_path, (detections, error) in zip(block, outputs):
+                row = batch_result_row(image_path, detections, error, model_name)
+                if writer:
+                    writer.writerow(row)
+                else:
+                    out.write(json.dumps(row, ensure_ascii=False) + '\n')
+                summary['images'] += 1
+                summary['errors'] += error is not None
+                summary['slabs'] += row['count'] or 0
+            
+            out.flush()
+            os.fsync(out.fileno())
+            with open(checkpoint_path, 'a', encoding='utf-8') as checkpoint:
+                checkpoint.write(json.dumps({'output_bytes': os.fstat(out.fileno()).st_size, 'images': block}) + '\n')
             
-    except Exception as e:
-        print(f"❌ Error limpiando CSV: {e}")
-        return False
+            elapsed = time.perf_counter() - started
+            rate = summary['images'] / elapsed if elapsed else 0.0
+            remaining = len(pending) - summary['images']
+            eta = f", ETA {remaining / rate / 60:.1f} min" if rate and remaining else ""
+            print(f"📦 {summary['skipped'] + summary['images']}/{len(image_paths)} imágenes · "
+                  f"{rate:.2f} img/s · {summary['errors']} errores{eta}")
+    
+    summary['seconds'] = round(time.perf_counter() - started, 2)
+    summary['images_per_second'] = round(summary['images'] / summary['seconds'], 2) if summary['seconds'] else 0.0
+    return summary
 
-def clean_uploaded_images():
-    """Limpia todas las imágenes subidas del directorio uploads"""
-    try:
-        if not os.path.exists(UPLOAD_FOLDER):
-            print("📁 Directorio uploads no existe")
-            return True, 0
+# ===== PARIDAD DE BACKENDS =====
+
+def _match_boxes(reference, candidate, iou_threshold):
+    """Emparejamiento voraz por IoU; retorna [(i_referencia, j_candidato), ...]"""
+    if not len(reference) or not len(candidate):
+        return []
+    top_left = np.maximum(reference[:, None, :2], candidate[None, :, :2])
+    bottom_right = np.minimum(reference[:, None, 2:], candidate[None, :, 2:])
+    intersection = np.clip(bottom_right - top_left, 0, None).prod(axis=2)
+    area_ref = (reference[:, 2:] - reference[:, :2]).prod(axis=1)
+    area_cand = (candidate[:, 2:] - candidate[:, :2]).prod(axis=1)
+    iou = intersection / np.maximum(area_ref[:, None] + area_cand[None, :] - intersection, 1e-9)
+    
+    pairs, used_ref, used_cand = [], set(), set()
+    for flat in np.argsort(-iou, axis=None):
+        i, j = divmod(int(flat), iou.shape[1])
+        if iou[i, j] < iou_threshold:
+            break
+        if i not in used_ref and j not in used_cand:
+            pairs.append((i, j))
+            used_ref.add(i)
+            used_cand.add(j)
+    return pairs
+
+def _timed_predict(model, image, repeats):
+    """(mediana en ms, (xyxy, conf)) de `repeats` pasadas del modelo sobre una imagen"""
+    times = []
+    for _ in range(max(1, repeats)):
+        started = time.perf_counter()
+        results = model(image, verbose=False)
+        times.append((time.perf_counter() - started) * 1000)
+    return float(np.median(times)), BasicSlabDetector._result_to_arrays(results[0] if results else None)
+
+def compare_backends(image_paths, backend, precision, confidence=0.60, repeats=3, iou_threshold=0.5):
+    """Compara un backend exportado con PyTorch (best.pt) en cajas y latencia
+    
+    Ambos modelos procesan las mismas imágenes ya decodificadas; solo se cuentan
+    cajas con confianza >= confidence, igual que detect_slabs.
+    """
+    reference = YOLO(detector.model_path, task='detect')
+    candidate = YOLO(export_model(detector.model_path, backend, precision), task='detect')
+    
+    rows = []
+    for image_path in image_paths:
+        image = cv2.imread(image_path)
+        if image is None:
+            print(f"⚠️ Imagen inválida, se omite: {image_path}")
+            continue
+        if not rows:
+            reference(image, verbose=False)  # Calentamiento
+            candidate(image, verbose=False)
         
-        files = os.listdir(UPLOAD_FOLDER)
-        image_files = [f for f in files if f.lower().endswith(('.png', '.jpg', '.jpeg', '.bmp', '.tiff', '.webp'))]
+        ref_ms, (ref_xyxy, ref_conf) = _timed_predict(reference, image, repeats)
+        cand_ms, (cand_xyxy, cand_conf) = _timed_predict(candidate, image, repeats)
+        ref_keep, cand_keep = ref_conf >= confidence, cand_conf >= confidence
+        pairs = _match_boxes(ref_xyxy[ref_keep], cand_xyxy[cand_keep], iou_threshold)
+        conf_diffs = [abs(float(ref_conf[ref_keep][i]) - float(cand_conf[cand_keep][j])) for i, j in pairs]
         
-        deleted_count = 0
-        for filename in image_files:
-            try:
-                file_path = os.path.join(UPLOAD_FOLDER, filename)
-                if os.path.isfile(file_path):
-                    os.remove(file_path)
-                    deleted_count += 1
-                    print(f"🗑️ Imagen eliminada: {filename}")
-            except Exception as e:
-                print(f"⚠️ Error eliminando {filename}: {e}")
+        row = {
+            'image': image_path,
+            'reference_count': int(ref_keep.sum()),
+            'candidate_count': int(cand_keep.sum()),
+            'matched': len(pairs),
+            'max_conf_diff': max(conf_diffs) if conf_diffs else 0.0,
+            'reference_ms': ref_ms,
+            'candidate_ms': cand_ms
+        }
+        rows.append(row)
+        print(f"   {os.path.basename(image_path)}: {row['reference_count']} → {row['candidate_count']} "
+              f"(emparejadas {row['matched']}), {ref_ms:.0f}ms → {cand_ms:.0f}ms")
+    
+    if not rows:
+        return {'images': 0}
+    union = sum(max(row['reference_count'], row['candidate_count']) for row in rows)
+    reference_ms = float(np.mean([row['reference_ms'] for row in rows]))
+    candidate_ms = float(np.mean([row['candidate_ms'] for row in rows]))
+    return {
+        'images': len(rows),
+        'backend': f"{backend}-{precision}",
+        'match_rate': sum(row['matched'] for row in rows) / union if union else 1.0,
+        'same_count_rate': sum(row['reference_count'] == row['candidate_count'] for row in rows) / len(rows),
+        'max_conf_diff': max(row['max_conf_diff'] for row in rows),
+        'reference_ms': reference_ms,
+        'candidate_ms': candidate_ms,
+        'speedup': reference_ms / candidate_ms if candidate_ms else None
+    }
+
+# ===== BENCHMARK DE POST-PROCESAMIENTO =====
+
+def _legacy_extract_detections(boxes, confidence):
+    """Post-procesamiento anterior (bucle por caja con .item() y .cpu() por caja), solo para comparar"""
+    detection_points = []
+    for i, conf_tensor in enumerate(boxes.conf):
+        conf = float(conf_tensor.item())
+        if conf >= confidence:
+            x1, y1, x2, y2 = boxes.xyxy[i].cpu().numpy()
+            detection_points.append({
+                'x': int((x1 + x2) / 2),
+                'y': int((y1 + y2) / 2),
+                'confidence': float(conf),
+                'bbox': [float(x1), float(y1), float(x2), float(y2)]
+            })
+    return detection_points
+
+def benchmark_postprocess(box_counts=(10, 100, 500, 1000, 2000), repeats=20, confidence=0.60, device='cpu'):
+    """Compara el tiempo de post-procesamiento por bucle vs vectorizado según cantidad de cajas"""
+    import torch
+    from ultralytics.engine.results import Boxes
+    
+    class _FakeResult:
+        def __init__(self, boxes):
+            self.boxes = boxes
+    
+    print(f"⏱️ Post-procesamiento en {device} ({repeats} repeticiones, conf >= {confidence})")
+    print(f"{'cajas':>8} | {'bucle (ms)':>11} | {'vectorizado (ms)':>16} | {'aceleración':>11}")
+    print("-" * 56)
+    
+    rows = []
+    generator = torch.Generator().manual_seed(0)
+    for count in box_counts:
+        xy = torch.rand((count, 2), generator=generator) * 3000
+        wh = torch.rand((count, 2), generator=generator) * 80 + 20
+        conf = torch.rand((count, 1), generator=generator)
+        cls = torch.zeros((count, 1))
+        data = torch.cat([xy, xy + wh, conf, cls], dim=1).to(device)
+        boxes = Boxes(data, (4000, 3000))
         
-        print(f"✅ {deleted_count} imágenes eliminadas del directorio uploads")
-        return True, deleted_count
+        # Verificar que ambos caminos producen lo mismo antes de medir
+        legacy = _legacy_extract_detections(boxes, confidence)
+        vectorized = BasicSlabDetector._extract_detections(*BasicSlabDetector._result_to_arrays(_FakeResult(boxes)), confidence, log=False)
+        if legacy != vectorized:
+            print(f"⚠️ Resultados distintos con {count} cajas")
         
-    except Exception as e:
-        print(f"❌ Error limpiando imágenes: {e}")
-        return False, str(e)
+        start = time.perf_counter()
+        for _ in range(repeats):
+            _legacy_extract_detections(boxes, confidence)
+        legacy_ms = (time.perf_counter() - start) * 1000 / repeats
+        
+        start = time.perf_counter()
+        for _ in range(repeats):
+            BasicSlabDetector._extract_detections(*BasicSlabDetector._result_to_arrays(_FakeResult(boxes)), confidence, log=False)
+        vectorized_ms = (time.perf_counter() - start) * 1000 / repeats
+        
+        speedup = legacy_ms / vectorized_ms if vectorized_ms else float('inf')
+        rows.append({'boxes': count, 'loop_ms': legacy_ms, 'vectorized_ms': vectorized_ms, 'speedup': speedup})
+        print(f"{count:>8} | {legacy_ms:>11.3f} | {vectorized_ms:>16.3f} | {speedup:>10.1f}x")
+    return rows
 
-def optimize_persistent_data():
-    """Optimiza el archivo de persistencia eliminando datos pesados innecesarios"""
-    with persistence_file_lock():
-        try:
-            data = load_persistent_data()
-            
-            # Optimizar cada imagen
-            optimized_images = []
-            for img_data in data.get('images', []):
-                # Crear versión optimizada sin detectionData pesado
-                optimized_img = {
-                    'name': img_data.get('name'),
-                    'status': img_data.get('status'),
-                    'manualPoints': img_data.get('manualPoints', []),
-                    'batches': img_data.get('batches', []),
-                    'nextPointId': img_data.get('nextPointId', 1),
-                    'detectionSummary': img_data.get('detectionSummary'),
-                    'createdAt': img_data.get('createdAt'),
-                    'updatedAt': img_data.get('updatedAt')
-                }
-                optimized_images.append(optimized_img)
-            
-            # Guardar versión optimizada
-            optimized_data = {
-                'images': optimized_images,
-                'next_image_id': data.get('next_image_id', 1),
-                'last_updated': datetime.now().isoformat(),
-                'optimized_at': datetime.now().isoformat()
-            }
-            
-            success = save_persistent_data_internal(optimized_data)
-            if success:
-                print(f"✅ Archivo optimizado: {len(optimized_images)} imágenes")
-            return success
-            
-        except Exception as e:
-            print(f"❌ Error optimizando persistencia: {e}")
-            return False
+def _synthetic_points(count, seed=0):
+    rng = np.random.default_rng(seed)
+    xy = rng.integers(0, 4000, size=(count, 2))
+    confidence = rng.random(count)
+    return [{'id': index + 1, 'x': int(x), 'y': int(y), 'confidence': float(conf), 'isOriginal': True,
+             'batchNumber': (index // 50) + 1 if index % 3 else None, 'isSelected': False}
+            for index, ((x, y), conf) in enumerate(zip(xy, confidence))]
 
-def escribir_base_datos_historica(registros):
-    """Escribe registros a la base de datos CSV de forma segura"""
-    try:
-        with open(DATABASE_FILE, 'w', newline='', encoding='utf-8') as file:
-            fieldnames = ['fecha', 'nombre_imagen', 'numero_lote', 'cantidad_slabs']
-            writer = csv.DictWriter(file, fieldnames=fieldnames)
-            writer.writeheader()
-            writer.writerows(registros)
-    except Exception as e:
-        print(f"❌ Error escribiendo CSV: {e}")
-        raise e
+def benchmark_points_encoding(point_counts=(100, 1000, 5000), repeats=20):
+    """Compara tamaño y tiempo de parseo de manualPoints: lista de objetos vs columnar"""
+    documents = [('almacén', [img.get('manualPoints') or [] for img in state_cache.load_document()['images']])]
+    documents += [(f"{count} pts", [_synthetic_points(count)]) for count in point_counts]
+    
+    print(f"📐 Codificación de puntos ({repeats} repeticiones de parseo)")
+    print(f"{'datos':>10} | {'puntos':>7} | {'JSON indent (KB)':>16} | {'objetos (KB)':>12} | "
+          f"{'columnar (KB)':>13} | {'parseo obj (ms)':>15} | {'parseo col (ms)':>15}")
+    print("-" * 108)
+    
+    rows = []
+    for label, images in documents:
+        points = sum(len(image_points) for image_points in images)
+        indented = json.dumps(images, indent=2, ensure_ascii=False)  # Como el antiguo slab_data.json
+        objects = json.dumps(images, ensure_ascii=False, separators=(',', ':'))
+        columnar = json.dumps([encode_points(image_points) for image_points in images],
+                              ensure_ascii=False, separators=(',', ':'))
+        
+        start = time.perf_counter()
+        for _ in range(repeats):
+            json.loads(objects)
+        objects_ms = (time.perf_counter() - start) * 1000 / repeats
+        
+        # El parseo columnar incluye reconstruir los objetos (lo que hace el servidor al cargar)
+        start = time.perf_counter()
+        for _ in range(repeats):
+            [decode_points(encoded) for encoded in json.loads(columnar)]
+        columnar_ms = (time.perf_counter() - start) * 1000 / repeats
+        
+        row = {'data': label, 'points': points, 'indented_bytes': len(indented.encode('utf-8')),
+               'object_bytes': len(objects.encode('utf-8')), 'columnar_bytes': len(columnar.encode('utf-8')),
+               'object_parse_ms': objects_ms, 'columnar_parse_ms': columnar_ms}
+        rows.append(row)
+        print(f"{label:>10} | {points:>7} | {row['indented_bytes'] / 1024:>16.1f} | {row['object_bytes'] / 1024:>12.1f} | "
+              f"{row['columnar_bytes'] / 1024:>13.1f} | {objects_ms:>15.3f} | {columnar_ms:>15.3f}")
+    return rows
+
+@app.before_request
+def ensure_model_loading():
+    """Con un servidor WSGI externo (sin __main__) el modelo empieza a cargarse con la primera petición"""
+    if _is_main_process:
+        startup.start(load_and_warm_model)
+
+@app.route('/health', methods=['GET'])
+def health():
+    """Liveness: el proceso atiende peticiones (aunque el modelo siga cargando)"""
+    return jsonify({'success': True, 'status': 'alive', 'startup': startup.status()})
+
+@app.route('/ready', methods=['GET'])
+def ready():
+    """Readiness: 200 cuando el modelo está cargado y calentado, 503 mientras tanto"""
+    status = startup.status()
+    if status['ready']:
+        return jsonify({'success': True, 'ready': True, 'startup': status})
+    return jsonify({'success': False, 'ready': False, 'startup': status}), 503, {
+        'Retry-After': str(READY_RETRY_AFTER)
+    }
 
 @app.route('/')
 def index():
@@ -705,6 +4770,14 @@ def serve_logo():
     """Servir el logo de AZA"""
     return send_from_directory('.', 'logo_aza.JPG')
 
+@app.errorhandler(413)
+def request_too_large(e):
+    """Petición mayor que MAX_CONTENT_LENGTH: indicar la subida por fragmentos"""
+    return jsonify({
+        'success': False,
+        'error': f'Petición demasiado grande (máximo {MAX_CONTENT_MB:g} MB); use /uploads para subir por fragmentos'
+    }), 413
+
 @app.route('/upload', methods=['POST'])
 def upload_file():
     """Sube archivo"""
@@ -717,64 +4790,418 @@ def upload_file():
     
     if file and detector.allowed_file(file.filename):
         filename = secure_filename(file.filename)
-        filepath = os.path.join(app.config['UPLOAD_FOLDER'], filename)
-        file.save(filepath)
+        record, duplicate = store_upload(file)
         
-        print(f"📁 Archivo guardado: {filepath}")
+        if duplicate:
+            print(f"♻️ Contenido ya existente, sin duplicar: {filename} → {record['path']}")
+        else:
+            print(f"📁 Archivo guardado: {record['path']}")
+            schedule_upload_preprocess(record['path'], record['sha256'])
         
-        return jsonify({
-            'success': True,
-            'filename': filename,
-            'filepath': filepath
-        })
+        return jsonify(upload_response(record, duplicate, filename))
     
     return jsonify({'error': 'Invalid file type'}), 400
 
+@app.route('/upload/exists/<content_id>', methods=['GET'])
+def upload_exists(content_id):
+    """Permite al navegador saltarse la subida si el contenido (SHA-256) ya está en el servidor"""
+    record = store.get_upload(content_id.lower())
+    if not record or not os.path.exists(record['path']):
+        return jsonify({'success': True, 'exists': False, 'content_id': content_id}), 404
+    # Mismo cuerpo que una subida (incluidas las URLs de la pirámide) para que el navegador lo use tal cual
+    response = upload_response(record, True, record['original_name'])
+    response.update(exists=True, size=record['size'])
+    return jsonify(response)
+
+@app.route('/upload_multiple', methods=['POST'])
+def upload_multiple():
+    """Sube varios archivos en una sola petición (campo 'files')
+    
+    Con detect=1 cada archivo se encola en /detect_jobs; se aceptan los mismos
+    parámetros de detección que /detect (confidence, tiled, ...).
+    """
+    files = [f for f in request.files.getlist('files') + request.files.getlist('file') if f.filename]
+    if not files:
+        return jsonify({'success': False, 'error': 'No files uploaded'}), 400
+    
+    detect = parse_flag(request.form.get('detect'))
+    options = {key: value for key, value in request.form.items() if key != 'detect'}
+    for flag in ('tiled', 'include_full'):
+        if flag in options:
+            options[flag] = parse_flag(options[flag])
+    results = []
+    for file in files:
+        filename = secure_filename(file.filename)
+        if not detector.allowed_file(file.filename):
+            results.append({'success': False, 'filename': filename, 'error': 'Invalid file type'})
+            continue
+        
+        record, duplicate = store_upload(file)
+        result = upload_response(record, duplicate, filename)
+        if detect:
+            result['job'] = handoff_to_detection(record['path'], options)
+        elif not duplicate:
+            schedule_upload_preprocess(record['path'], record['sha256'])
+        results.append(result)
+    
+    stored = sum(1 for result in results if result['success'])
+    print(f"📁 Subida múltiple: {stored}/{len(results)} archivo(s) guardados")
+    return jsonify({
+        'success': stored > 0,
+        'count': stored,
+        'files': results
+    })
+
+@app.route('/uploads', methods=['POST'])
+def start_chunked_upload():
+    """Inicia una subida por fragmentos: {filename, size, sha256?, chunk_size?}"""
+    session, failure = create_upload_session(request.get_json(silent=True))
+    if failure:
+        return jsonify({'success': False, 'error': failure[0]}), failure[1]
+    return jsonify({'success': True, 'upload': upload_session_view(session)}), 201, {
+        'Location': f"/uploads/{session['id']}"
+    }
+
+@app.route('/uploads/<upload_id>', methods=['GET'])
+def chunked_upload_status(upload_id):
+    """Fragmentos recibidos hasta ahora (para reanudar tras un corte)"""
+    session = store.get_upload_session(upload_id)
+    if session is None:
+        return jsonify({'success': False, 'error': 'Subida no encontrada'}), 404
+    return jsonify({'success': True, 'upload': upload_session_view(session)})
+
+@app.route('/uploads/<upload_id>/chunks/<int:index>', methods=['PUT'])
+def upload_chunk(upload_id, index):
+    """Recibe un fragmento (cuerpo binario) verificando su checksum"""
+    session = store.get_upload_session(upload_id)
+    if session is None:
+        return jsonify({'success': False, 'error': 'Subida no encontrada'}), 404
+    
+    session, failure = write_upload_chunk(session, index, request.get_data(cache=False), {
+        'sha256': request.headers.get('X-Chunk-SHA256'),
+        'crc32': request.headers.get('X-Chunk-CRC32')
+    })
+    if failure:
+        return jsonify({'success': False, 'error': failure[0]}), failure[1]
+    return jsonify({'success': True, 'upload': upload_session_view(session)})
+
+@app.route('/uploads/<upload_id>/complete', methods=['POST'])
+def complete_chunked_upload(upload_id):
+    """Ensambla el archivo; con {"detect": true, ...} lo encola también para detección"""
+    session = store.get_upload_session(upload_id) or recent_upload_session(upload_id)
+    if session is None:
+        return jsonify({'success': False, 'error': 'Subida no encontrada'}), 404
+    
+    result, failure = complete_upload_session(session)
+    if failure:
+        return jsonify({'success': False, 'error': failure[0], 'upload': upload_session_view(session)}), failure[1]
+    
+    record, duplicate = result
+    response = upload_response(record, duplicate, secure_filename(session['filename']))
+    options = request.get_json(silent=True) or {}
+    if parse_flag(options.pop('detect', False)):
+        response['job'] = handoff_to_detection(record['path'], options)
+    elif not duplicate:
+        schedule_upload_preprocess(record['path'], record['sha256'])
+    
+    print(f"📁 Subida por fragmentos completada: {session['filename']} → {record['path']}")
+    return jsonify(response)
+
+@app.route('/uploads/<upload_id>', methods=['DELETE'])
+def abort_chunked_upload(upload_id):
+    """Cancela una subida por fragmentos y borra el archivo parcial"""
+    if store.get_upload_session(upload_id) is None:
+        return jsonify({'success': False, 'error': 'Subida no encontrada'}), 404
+    discard_upload_session(upload_id)
+    return jsonify({'success': True})
+
 @app.route('/detect', methods=['POST'])
 def detect():
     """Ejecuta detección"""
-    data = request.get_json()
-    filepath = data.get('filepath')
-    confidence = float(data.get('confidence', 0.60))
-    
-    if not filepath or not os.path.exists(filepath):
-        return jsonify({'error': 'File not found'}), 400
+    params, failure = parse_detect_params(request.get_json())
+    if failure:
+        return jsonify({'error': failure[0]}), failure[1]
     
     print(f"\n🚀 Iniciando detección...")
-    print(f"📂 Archivo: {filepath}")
-    print(f"🎯 Confidence: {confidence}")
+    print(f"📂 Archivo: {params['filepath']}")
+    print(f"🎯 Confidence: {params['confidence']}")
     
-    # Detectar palanquillas
-    detections, error = detector.detect_slabs(filepath, confidence)
+    try:
+        result, failure = run_detection(params)
+    except (SchedulerFullError, SchedulerTimeoutError) as e:
+        return scheduler_busy_response(e)
     
-    if error:
-        return jsonify({'error': error}), 500
+    if failure:
+        return jsonify({'error': failure[0]}), failure[1]
     
-    # Dibujar detecciones
-    image_with_detections = detector.draw_detections(filepath, detections)
+    print(f"✅ Resultado: {result['count']} palanquillas detectadas")
+    return jsonify(result)
+
+@app.route('/detect_jobs', methods=['POST'])
+def submit_detect_job():
+    """Encola una detección y responde de inmediato con el id del trabajo (202)"""
+    params, failure = parse_detect_params(request.get_json())
+    if failure:
+        return jsonify({'success': False, 'error': failure[0]}), failure[1]
     
-    if not image_with_detections:
-        return jsonify({'error': 'Error generating result image'}), 500
+    try:
+        job_id = detection_jobs.submit(params)
+    except SchedulerFullError as e:
+        return scheduler_busy_response(e)
     
-    result = {
+    print(f"📥 Trabajo de detección {job_id[:8]} encolado: {params['filepath']}")
+    return jsonify({
         'success': True,
-        'count': len(detections),
-        'detections': detections,
-        'image_data': image_with_detections
-    }
+        'job_id': job_id,
+        'status_url': f'/detect_jobs/{job_id}',
+        'result_url': f'/detect_jobs/{job_id}/result',
+        'events_url': f'/detect_jobs/{job_id}/events'
+    }), 202, {'Location': f'/detect_jobs/{job_id}'}
+
+@app.route('/detect_jobs/<job_id>', methods=['GET'])
+def detect_job_status(job_id):
+    """Estado del trabajo: queued / running / done / error, etapa actual y tiempos"""
+    job = detection_jobs.get(job_id)
+    if job is None:
+        return jsonify({'success': False, 'error': 'Trabajo no encontrado'}), 404
+    return jsonify({'success': True, 'job': job})
+
+@app.route('/detect_jobs/<job_id>/result', methods=['GET'])
+def detect_job_result(job_id):
+    """Resultado de un trabajo terminado (202 mientras siga pendiente)"""
+    job, result = detection_jobs.result(job_id)
+    if job is None:
+        return jsonify({'success': False, 'error': 'Trabajo no encontrado'}), 404
+    if job['status'] == 'error':
+        return jsonify({'success': False, 'error': job['error'], 'job': job}), job.get('error_code', 500)
+    if job['status'] != 'done':
+        return jsonify({'success': False, 'pending': True, 'job': job}), 202, {'Retry-After': '1'}
+    return jsonify(dict(result, job=job))
+
+@app.route('/detect_jobs/<job_id>/events', methods=['GET'])
+def detect_job_events(job_id):
+    """Server-Sent Events con cada cambio de estado del trabajo hasta que termina"""
+    job = detection_jobs.get(job_id)
+    if job is None:
+        return jsonify({'success': False, 'error': 'Trabajo no encontrado'}), 404
     
-    print(f"✅ Resultado: {len(detections)} palanquillas detectadas")
-    return jsonify(result)
+    def generate(job):
+        while True:
+            yield f"event: {job['status']}\ndata: {json.dumps(job)}\n\n"
+            if job['status'] in DetectionJobs.FINAL_STATES:
+                return
+            version = job['version']
+            while True:
+                updated = detection_jobs.wait_for_change(job_id, version, JOB_SSE_HEARTBEAT)
+                if updated is None:
+                    return
+                if updated['version'] != version:
+                    job = updated
+                    break
+                yield ": keep-alive\n\n"
+    
+    return Response(stream_with_context(generate(job)), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+@app.route('/results/<path:filename>', methods=['GET'])
+def serve_result_image(filename):
+    """Sirve imágenes anotadas con ETag, Range y caché de larga duración"""
+    response = send_from_directory(RESULTS_FOLDER, filename, conditional=True, max_age=RESULTS_CACHE_MAX_AGE)
+    response.cache_control.public = True
+    response.cache_control.immutable = True
+    return response
+
+@app.route('/images/<content_id>/<level>', methods=['GET'])
+def serve_image_level(content_id, level):
+    """Sirve una imagen subida en el nivel pedido (thumb / screen / full), generándolo si hace falta"""
+    if level not in IMAGE_LEVELS:
+        return jsonify({'success': False, 'error': f'Nivel no válido: {level}. Opciones: {list(IMAGE_LEVELS)}'}), 400
+    path = derived_image(content_id.lower(), level)
+    if path is None:
+        return jsonify({'success': False, 'error': 'Imagen no encontrada'}), 404
+    
+    # Mismo contenido, misma URL: caché de larga duración como en /results
+    response = send_from_directory(os.path.dirname(path), os.path.basename(path), conditional=True,
+                                   max_age=RESULTS_CACHE_MAX_AGE)
+    response.cache_control.public = True
+    response.cache_control.immutable = True
+    return response
+
+@app.route('/detect_batch', methods=['POST'])
+def detect_batch():
+    """Ejecuta detección por lotes sobre varias imágenes"""
+    if not startup.ready:
+        return jsonify({
+            'error': f"Modelo cargándose ({startup.phase}), reintente en {READY_RETRY_AFTER}s"
+        }), 503, {'Retry-After': str(READY_RETRY_AFTER)}
+    
+    data = request.get_json() or {}
+    filepaths = data.get('filepaths')
+    confidence = data.get('confidence', 0.60)
+    batch_size = data.get('batch_size')
+    # include_images se mantiene por compatibilidad (equivale a image_mode='base64')
+    image_mode = data.get('image_mode', 'base64' if data.get('include_images') else 'none')
+    image_level = data.get('image_level', 'full')
+    
+    if not isinstance(filepaths, list) or not filepaths:
+        return jsonify({'error': 'Lista de archivos requerida (filepaths)'}), 400
+    
+    if image_mode not in IMAGE_MODES:
+        return jsonify({'error': f'image_mode no válido: {image_mode}. Opciones: {list(IMAGE_MODES)}'}), 400
+    if image_level not in IMAGE_LEVELS:
+        return jsonify({'error': f'image_level no válido: {image_level}. Opciones: {list(IMAGE_LEVELS)}'}), 400
+    
+    try:
+        batch_size = int(batch_size) if batch_size is not None else None
+    except (ValueError, TypeError):
+        return jsonify({'error': 'batch_size debe ser un número válido'}), 400
+    
+    try:
+        confidence = float(confidence)
+        if np.isnan(confidence):
+            raise ValueError(confidence)
+    except (ValueError, TypeError):
+        return jsonify({'error': 'confidence debe ser un número entre 0 y 1'}), 400
+    confidence = min(1.0, max(0.0, confidence))  # Fuera de rango: se ajusta a [0, 1]
+    
+    print(f"\n🚀 Iniciando detección por lotes: {len(filepaths)} imágenes")
+    
+    # El tiempo límite escala con la cantidad de lotes a procesar
+    effective_batch = batch_size or DETECT_BATCH_SIZE
+    timeout = INFERENCE_TIMEOUT * max(1, -(-len(filepaths) // max(1, effective_batch)))
+    try:
+        outputs = scheduler.submit(filepaths, confidence, batch_size, timeout=timeout)
+    except (SchedulerFullError, SchedulerTimeoutError) as e:
+        return scheduler_busy_response(e)
+    
+    results = []
+    for filepath, (detections, error) in zip(filepaths, outputs):
+        if error:
+            results.append({'filepath': filepath, 'success': False, 'error': error})
+            continue
+        
+        item = {
+            'filepath': filepath,
+            'success': True,
+            'count': len(detections),
+            'detections': detections
+        }
+        item.update(detection_image_fields(filepath, detections, image_mode, image_level) or {})
+        results.append(item)
+    
+    processed = sum(1 for item in results if item['success'])
+    print(f"✅ Resultado lote: {processed}/{len(filepaths)} imágenes procesadas")
+    return jsonify({
+        'success': True,
+        'total': len(filepaths),
+        'processed': processed,
+        'results': results
+    })
+
+@app.route('/models', methods=['GET'])
+def list_models():
+    """Versiones registradas, activa, anterior y estado del último cambio en caliente"""
+    return jsonify({'success': True, 'models': model_registry.list(), **model_registry.status()})
+
+@app.route('/models', methods=['POST'])
+def register_model():
+    """Registra un modelo subido (campo 'file', .pt); con activate=1 lo pone en uso en caliente"""
+    file = request.files.get('file')
+    if not file or not file.filename.lower().endswith('.pt'):
+        return jsonify({'success': False, 'error': 'Se requiere un archivo .pt en el campo file'}), 400
+    
+    os.makedirs(MODEL_REGISTRY_FOLDER, exist_ok=True)
+    with tempfile.NamedTemporaryFile(dir=MODEL_REGISTRY_FOLDER, suffix='.part', delete=False) as temp_file:
+        shutil.copyfileobj(file.stream, temp_file, UPLOAD_CHUNK_SIZE)
+    try:
+        record, created = model_registry.register(temp_file.name, request.form.get('version') or None,
+                                                  request.form.get('notes'), move=True)
+    except ValueError as e:
+        os.remove(temp_file.name)
+        return jsonify({'success': False, 'error': str(e)}), 400
+    
+    response = {'success': True, 'model': record, 'created': created}
+    if parse_flag(request.form.get('activate')):
+        response['switching'] = model_registry.activate(record['version'])
+    return jsonify(response), 201 if created else 200
+
+@app.route('/models/<version>/activate', methods=['POST'])
+def activate_model(version):
+    """Carga y calienta la versión en segundo plano y la pone en uso sin cortar detecciones"""
+    try:
+        started = model_registry.activate(version)
+    except KeyError:
+        return jsonify({'success': False, 'error': f'Versión no registrada: {version}'}), 404
+    if not started:
+        return jsonify({'success': False, 'error': 'Ya hay un cambio de modelo en curso',
+                        **model_registry.status()}), 409
+    return jsonify({'success': True, **model_registry.status()}), 202
+
+@app.route('/models/rollback', methods=['POST'])
+def rollback_model():
+    """Vuelve a la versión activa anterior"""
+    if not model_registry.rollback():
+        return jsonify({'success': False, 'error': 'No hay versión anterior o ya hay un cambio en curso',
+                        **model_registry.status()}), 409
+    return jsonify({'success': True, **model_registry.status()}), 202
+
+@app.route('/inference_status', methods=['GET'])
+def inference_status():
+    """Endpoint con el estado de la cola de inferencia"""
+    return jsonify({
+        'success': True,
+        'scheduler': scheduler.status(),
+        'startup': startup.status(),
+        'backend': {
+            'name': detector.backend,
+            'precision': detector.precision,
+            'model': detector.runtime_path,
+            'model_version': detector.model_version,
+            'input_size': detector.inference_input_size()
+        },
+        'pool': detector.pool.status() if detector.pool else None,
+        'cache': detector.cache.status() if detector.cache else None,
+        'jobs': detection_jobs.status(),
+        'decoded_images': detector.decoded.status() if detector.decoded else None
+    })
+
+@app.route('/detection_cache/clear', methods=['POST'])
+def clear_detection_cache():
+    """Endpoint para vaciar la caché de detecciones"""
+    if detector.cache:
+        detector.cache.clear()
+    return jsonify({
+        'success': True,
+        'message': 'Caché de detecciones vaciada'
+    })
+
+def conditional_json(etag, build):
+    """Responde 304 si el cliente ya tiene esta versión (If-None-Match); si no, el JSON de build()
+    
+    no-cache obliga al navegador a revalidar siempre, así que el 304 es transparente para fetch().
+    """
+    if request.if_none_match.contains(etag):
+        response = Response(status=304)
+    else:
+        response = jsonify(build())
+    response.set_etag(etag)
+    response.headers['Cache-Control'] = 'no-cache'
+    return response
 
 @app.route('/load_persistent_data', methods=['GET'])
 def load_data_route():
     """Endpoint para cargar datos persistentes"""
     try:
-        persistent_data = load_persistent_data()
-        return jsonify({
-            'success': True,
-            'data': persistent_data
-        })
+        columnar = wants_columnar_points()
+        
+        def build():
+            persistent_data = load_persistent_data()
+            if columnar:
+                persistent_data['images'] = [pack_image_record(img) for img in persistent_data['images']]
+            return {'success': True, 'data': persistent_data}
+        
+        # El ETag sale de revisiones y hashes ya calculados: sin cambios no se serializa nada
+        return conditional_json(state_cache.document_etag() + ('-c' if columnar else ''), build)
     except Exception as e:
         return jsonify({
             'success': False,
@@ -783,7 +5210,7 @@ def load_data_route():
 
 @app.route('/save_image_data', methods=['POST'])
 def save_image_data_route():
-    """Endpoint para guardar datos de imagen"""
+    """Endpoint para guardar datos de imagen: {"imageData": {...}, "revision": n (opcional, revisión base)}"""
     try:
         data = request.get_json()
         image_data = data.get('imageData')
@@ -794,10 +5221,22 @@ def save_image_data_route():
                 'error': 'Datos de imagen inválidos'
             }), 400
         
-        success = save_image_data(image_data)
+        try:
+            revision = save_image_data(image_data, data.get('revision'))
+        except RevisionConflictError as conflict:
+            # Igual que el 409 de PATCH: se devuelve el registro actual para que el cliente rehaga sus cambios
+            return jsonify({
+                'success': False,
+                'error': str(conflict),
+                'data': conflict.record,
+                'revision': conflict.revision
+            }), 409
+        saved = find_image_data_by_name(image_data.get('name')) if revision else None
         
         return jsonify({
-            'success': success,
+            'success': bool(revision),
+            'revision': revision or None,
+            'content_hash': saved.get('contentHash') if saved else None,
             'message': f"Datos guardados para: {image_data.get('name')}"
         })
     except Exception as e:
@@ -806,6 +5245,31 @@ def save_image_data_route():
             'error': str(e)
         }), 500
 
+@app.route('/image_data/<filename>', methods=['PATCH'])
+def patch_image_data_route(filename):
+    """Aplica operaciones incrementales a una imagen: {"revision": n, "ops": [...]}"""
+    data = request.get_json(silent=True) or {}
+    if not isinstance(data.get('revision'), int):
+        return jsonify({'success': False, 'error': 'Se requiere la revisión base'}), 400
+    
+    record, error = apply_image_ops(filename, data['revision'], data.get('ops'))
+    if error:
+        message, code = error
+        response = {'success': False, 'error': message}
+        if code == 409:
+            # Se devuelve el registro actual para que el cliente rehaga sus cambios encima
+            response['data'] = find_image_data_by_name(filename)
+            response['revision'] = response['data'].get('revision', 0)
+        return jsonify(response), code
+    
+    return jsonify({
+        'success': True,
+        'revision': record['revision'],
+        'content_hash': image_content_hash(record),
+        'points': len(record['manualPoints']),
+        'batches': len(record['batches'])
+    })
+
 @app.route('/get_image_data/<filename>', methods=['GET'])
 def get_image_data_route(filename):
     """Endpoint para obtener datos de una imagen específica"""
@@ -813,9 +5277,10 @@ def get_image_data_route(filename):
         image_data = find_image_data_by_name(filename)
         
         if image_data:
-            return jsonify({
+            columnar = wants_columnar_points()
+            return conditional_json(image_etag(image_data) + ('-c' if columnar else ''), lambda: {
                 'success': True,
-                'data': image_data
+                'data': pack_image_record(image_data) if columnar else image_data
             })
         else:
             return jsonify({
@@ -887,13 +5352,132 @@ def guardar_lote_historico():
 
 @app.route('/obtener_datos_historicos', methods=['GET'])
 def obtener_datos_historicos():
-    """Endpoint para obtener todos los datos históricos"""
+    """Endpoint para obtener los datos históricos
+    
+    Nunca retorna el histórico completo de una vez: pagina por cursor (la UI
+    sigue next_cursor hasta agotarlo) o lo transmite como NDJSON, y filtra:
+      desde / hasta   fecha inicial y final inclusivas ('2025-08-06' o '2025-08-06 09:45:54')
+      numero_lote     lote exacto
+      nombre_imagen   imagen exacta
+      orden           'desc' (por defecto, más recientes primero) o 'asc'
+      limite          registros por página (por defecto HISTORY_PAGE_SIZE)
+      cursor          'fecha|id|generación' retornado como next_cursor en la página anterior
+                      (409 si el histórico se compactó desde entonces: volver a la primera página)
+      formato         'ndjson' para recibir un registro por línea en streaming
+    """
+    try:
+        args = request.args
+        orden = args.get('orden', 'desc').lower()
+        formato = args.get('formato', 'json').lower()
+        if orden not in ('asc', 'desc') or formato not in ('json', 'ndjson'):
+            return jsonify({
+                'success': False,
+                'error': "orden debe ser 'asc' o 'desc' y formato 'json' o 'ndjson'"
+            }), 400
+        
+        try:
+            limite = args.get('limite')
+            if limite is not None:
+                limite = max(1, min(int(limite), HISTORY_MAX_PAGE_SIZE))
+            elif formato == 'json':
+                limite = HISTORY_PAGE_SIZE
+            
+            cursor = None
+            if args.get('cursor'):
+                fecha_cursor, id_cursor, generacion = args['cursor'].rsplit('|', 2)
+                cursor = (fecha_cursor, int(id_cursor), generacion)
+        except ValueError:
+            return jsonify({
+                'success': False,
+                'error': "limite debe ser un número y cursor tener el formato 'fecha|id|generación'"
+            }), 400
+        
+        hasta = args.get('hasta') or None
+        if hasta and len(hasta) == 10:
+            hasta += ' 23:59:59'  # Fecha sin hora: incluir el día completo
+        
+        try:
+            generacion, resultados = history_log.query(
+                desde=args.get('desde') or None,
+                hasta=hasta,
+                numero_lote=args.get('numero_lote') or None,
+                nombre_imagen=args.get('nombre_imagen') or None,
+                descending=orden == 'desc',
+                after=cursor
+            )
+        except HistoryCursorError as e:
+            return jsonify({
+                'success': False,
+                'error': str(e)
+            }), 409
+        
+        if formato == 'ndjson':
+            # Streaming: cada línea es un registro con su id y el cursor para
+            # continuar desde ella
+            def generate():
+                for row_id, registro in islice(resultados, limite):
+                    registro['id'] = row_id
+                    registro['cursor'] = f"{registro['fecha']}|{row_id}|{generacion}"
+                    yield json.dumps(registro, ensure_ascii=False) + '\n'
+            return Response(stream_with_context(generate()), mimetype='application/x-ndjson')
+        
+        pagina = []
+        for row_id, registro in islice(resultados, limite + 1):
+            registro['id'] = row_id
+            pagina.append(registro)
+        has_more = len(pagina) > limite
+        pagina = pagina[:limite]
+        
+        return jsonify({
+            'success': True,
+            'data': pagina,
+            'count': len(pagina),
+            'has_more': has_more,
+            'next_cursor': f"{pagina[-1]['fecha']}|{pagina[-1]['id']}|{generacion}" if has_more else None
+        })
+        
+    except Exception as e:
+        return jsonify({
+            'success': False,
+            'error': str(e)
+        }), 500
+
+@app.route('/estadisticas_produccion', methods=['GET'])
+def estadisticas_produccion_route():
+    """Totales de slabs por día, hora, turno o lote (desde acumulados precalculados)
+    
+    Parámetros: agrupar = dia | hora | turno | lote, desde / hasta = 'YYYY-MM-DD' inclusivos.
+    """
     try:
-        registros = leer_base_datos_historica()
+        agrupar = request.args.get('agrupar', 'dia')
+        desde = request.args.get('desde') or None
+        hasta = request.args.get('hasta') or None
+        if agrupar not in ('dia', 'hora', 'turno', 'lote'):
+            return jsonify({
+                'success': False,
+                'error': "agrupar debe ser 'dia', 'hora', 'turno' o 'lote'"
+            }), 400
+        try:
+            for value in (desde, hasta):
+                if value:
+                    datetime.strptime(value, '%Y-%m-%d')
+        except ValueError:
+            return jsonify({
+                'success': False,
+                'error': "desde y hasta deben tener el formato YYYY-MM-DD"
+            }), 400
+        
+        data = estadisticas_produccion(agrupar, desde, hasta)
         return jsonify({
             'success': True,
-            'data': registros,
-            'total': len(registros)
+            'agrupar': agrupar,
+            'desde': desde,
+            'hasta': hasta,
+            'data': data,
+            'total_slabs': sum(item['cantidad_slabs'] for item in data),
+            'total_registros': sum(item['registros'] for item in data),
+            'turnos': [{'nombre': name, 'inicio': start, 'fin': end}
+                       for name, start, end in parse_shifts(PRODUCTION_SHIFTS)] if agrupar == 'turno' else None
         })
         
     except Exception as e:
@@ -902,6 +5486,76 @@ def obtener_datos_historicos():
             'error': str(e)
         }), 500
 
+@app.route('/exportar', methods=['GET'])
+def exportar_datos():
+    """Descarga el histórico, los puntos o los lotes en formato columnar o CSV comprimido
+    
+    Parámetros: dataset = historico | puntos | lotes,
+    formato = parquet | arrow | csv | csv.gz | csv.zst, desde / hasta = 'YYYY-MM-DD' inclusivos.
+    """
+    try:
+        dataset = request.args.get('dataset', 'historico')
+        formato = request.args.get('formato', 'parquet' if pa is not None else 'csv.gz')
+        desde = request.args.get('desde') or None
+        hasta = request.args.get('hasta') or None
+        
+        if dataset not in EXPORT_COLUMNS or formato not in EXPORT_FORMATS:
+            return jsonify({
+                'success': False,
+                'error': f'dataset debe ser uno de {sorted(EXPORT_COLUMNS)} y formato uno de {sorted(EXPORT_FORMATS)}'
+            }), 400
+        try:
+            for value in (desde, hasta):
+                if value:
+                    datetime.strptime(value, '%Y-%m-%d')
+            if formato.startswith('csv'):
+                _csv_compressor(formato)
+            elif pa is None:
+                raise ValueError("pyarrow no está instalado; use formato 'csv.gz' o 'csv.zst'")
+        except ValueError as e:
+            return jsonify({
+                'success': False,
+                'error': str(e)
+            }), 400
+        
+        if formato.startswith('csv'):
+            # CSV: se genera y comprime por bloques mientras se envía
+            mimetype = {'csv': 'text/csv', 'csv.gz': 'application/gzip', 'csv.zst': 'application/zstd'}[formato]
+            response = Response(stream_with_context(export_csv_chunks(dataset, formato, desde, hasta)),
+                                mimetype=mimetype)
+        else:
+            # Parquet/Arrow: se escribe por bloques a un archivo temporal y se envía en streaming
+            fd, temp_path = tempfile.mkstemp(dir=EXPORTS_FOLDER, suffix=EXPORT_FORMATS[formato])
+            os.close(fd)
+            try:
+                rows = export_dataset(dataset, formato, temp_path, desde, hasta)
+            except Exception:
+                os.remove(temp_path)
+                raise
+            
+            def stream_file():
+                try:
+                    with open(temp_path, 'rb') as f:
+                        for block in iter(lambda: f.read(1024 * 1024), b''):
+                            yield block
+                finally:
+                    os.remove(temp_path)
+            
+            mimetype = 'application/vnd.apache.parquet' if formato == 'parquet' else 'application/vnd.apache.arrow.file'
+            response = Response(stream_file(), mimetype=mimetype)
+            response.headers['Content-Length'] = str(os.path.getsize(temp_path))
+            response.headers['X-Export-Rows'] = str(rows)
+        
+        response.headers['Content-Disposition'] = f'attachment; filename="{export_filename(dataset, formato, desde, hasta)}"'
+        return response
+        
+    except Exception as e:
+        print(f"❌ Error exportando datos: {e}")
+        return jsonify({
+            'success': False,
+            'error': str(e)
+        }), 500
+
 @app.route('/actualizar_registro_historico', methods=['POST'])
 def actualizar_registro_historico_route():
     """Endpoint para actualizar un registro específico en la base de datos histórica"""
@@ -1060,9 +5714,16 @@ def verify_save_status():
         
         server_points = len(server_data.get('manualPoints', []))
         server_batches = len(server_data.get('batches', []))
+        server_revision = server_data.get('revision', 0)
+        server_hash = server_data.get('contentHash') or image_content_hash(server_data)
         
-        # Verificar si están sincronizados
-        is_synced = (client_points == server_points and client_batches == server_batches)
+        # Verificar si están sincronizados: por revisión/hash si el cliente los conoce, si no por recuentos
+        if client_data.get('revision') is not None:
+            is_synced = client_data['revision'] == server_revision
+        elif client_data.get('contentHash'):
+            is_synced = client_data['contentHash'] == server_hash
+        else:
+            is_synced = (client_points == server_points and client_batches == server_batches)
         
         # Determinar estado de guardado
         has_work = client_points > 0 or client_batches > 0
@@ -1079,6 +5740,8 @@ def verify_save_status():
             'server_data': {
                 'points': server_points,
                 'batches': server_batches,
+                'revision': server_revision,
+                'content_hash': server_hash,
                 'last_updated': server_data.get('updatedAt')
             },
             'message': 'Datos sincronizados' if is_synced else 'Datos no sincronizados'
@@ -1095,15 +5758,15 @@ def verify_save_status():
 def force_save_backup():
     """Endpoint para forzar un respaldo completo del sistema"""
     try:
-        # Crear respaldo inmediato
+        # Escribir cambios pendientes en memoria y crear respaldo inmediato
+        state_cache.flush()
         create_backup_if_needed()
         
         # Optimizar persistencia
         optimize_success = optimize_persistent_data()
         
         # Verificar integridad de datos
-        persistent_data = load_persistent_data()
-        image_count = len(persistent_data.get('images', []))
+        image_count = state_cache.count()
         
         # Verificar CSV
         csv_records = leer_base_datos_historica()
@@ -1116,7 +5779,8 @@ def force_save_backup():
                 'images_in_json': image_count,
                 'records_in_csv': csv_count,
                 'optimization_success': optimize_success,
-                'backup_file': PERSISTENCE_BACKUP,
+                'backup_file': STORE_BACKUP,
+                'persistence': state_cache.status(),
                 'timestamp': datetime.now().isoformat()
             }
         })
@@ -1245,34 +5909,32 @@ def clean_image_data():
         print(f"🗑️ Limpiando datos para imagen: {image_name}")
         
         with _persistence_lock:
-            # Cargar datos actuales
-            current_data = load_persistent_data()
-            images = current_data.get('images', [])
-            
-            # Buscar y limpiar la imagen específica
-            image_found = False
-            for img_data in images:
-                if img_data.get('name') == image_name:
-                    # Limpiar datos manteniendo solo lo básico
-                    img_data['manualPoints'] = []
-                    img_data['batches'] = []
-                    img_data['detectionData'] = None
-                    img_data['status'] = 'uploaded'
-                    img_data['nextPointId'] = 1
-                    img_data['updatedAt'] = datetime.now().isoformat()
-                    
-                    image_found = True
-                    print(f"✅ Datos limpiados para: {image_name}")
-                    break
+            # Solo se lee y reescribe la fila de esta imagen
+            img_data = state_cache.get_image(image_name)
             
-            if not image_found:
+            if img_data is None:
                 return jsonify({
                     'success': False,
                     'error': f'Imagen no encontrada: {image_name}'
                 }), 404
             
+            # Limpiar datos manteniendo solo lo básico
+            img_data['manualPoints'] = []
+            img_data['batches'] = []
+            img_data['detectionData'] = None
+            img_data['status'] = 'uploaded'
+            img_data['nextPointId'] = 1
+            img_data['updatedAt'] = datetime.now().isoformat()
+            print(f"✅ Datos limpiados para: {image_name}")
+            
             # Guardar datos actualizados
-            success = save_persistent_data(current_data)
+            create_backup_if_needed()
+            try:
+                state_cache.upsert_image(img_data)
+                success = True
+            except Exception as e:
+                print(f"❌ Error guardando datos: {e}")
+                success = False
             
             if success:
                 return jsonify({
@@ -1297,9 +5959,107 @@ if __name__ == '__main__':
     
     parser = argparse.ArgumentParser(description='Basic Slab Detector')
     parser.add_argument('--port', type=int, default=5000, help='Port to run the server on')
+    subparsers = parser.add_subparsers(dest='command')
+    
+    bench_parser = subparsers.add_parser('bench-postprocess', help='Benchmark post-processing time vs box count')
+    bench_parser.add_argument('--boxes', default='10,100,500,1000,2000', help='Comma-separated box counts')
+    bench_parser.add_argument('--repeats', type=int, default=20, help='Repetitions per box count')
+    bench_parser.add_argument('--device', default='cpu', help='Torch device for the synthetic boxes')
+    
+    points_bench_parser = subparsers.add_parser('bench-points', help='Compare manualPoints size and parse time: objects vs columnar')
+    points_bench_parser.add_argument('--points', default='100,1000,5000', help='Comma-separated synthetic point counts')
+    points_bench_parser.add_argument('--repeats', type=int, default=20, help='Parse repetitions per dataset')
+    
+    migrate_parser = subparsers.add_parser('migrate-json', help='Re-import slab_data.json (or a backup) into the SQLite store')
+    migrate_parser.add_argument('source', nargs='?', help='JSON file to import (default: slab_data.json, then its backup)')
+    
+    export_parser = subparsers.add_parser('export', help='Export history, points or batches to Parquet, Arrow or compressed CSV')
+    export_parser.add_argument('dataset', choices=sorted(EXPORT_COLUMNS), help='Dataset to export')
+    export_parser.add_argument('--format', dest='formato', choices=sorted(EXPORT_FORMATS),
+                               default='parquet' if pa is not None else 'csv.gz', help='Output format')
+    export_parser.add_argument('--from', dest='desde', help='First day (YYYY-MM-DD, inclusive)')
+    export_parser.add_argument('--to', dest='hasta', help='Last day (YYYY-MM-DD, inclusive)')
+    export_parser.add_argument('--output', help='Output file (default: exports/<dataset>_<from>_<to>.<ext>)')
+    export_parser.add_argument('--chunk-rows', type=int, default=EXPORT_CHUNK_ROWS, help='Rows per written block')
+    
+    batch_parser = subparsers.add_parser('batch', help='Run detection over folders or globs of images, writing JSONL/CSV results')
+    batch_parser.add_argument('inputs', nargs='+', help='Image files, directories or glob patterns')
+    batch_parser.add_argument('--output', default=os.path.join(RESULTS_FOLDER, 'batch_detections.jsonl'),
+                              help='Results file (.jsonl or .csv); <output>.checkpoint tracks progress')
+    batch_parser.add_argument('--format', dest='formato', choices=['jsonl', 'csv'],
+                              help='Output format (default: from the output extension)')
+    batch_parser.add_argument('--confidence', type=float, default=0.60, help='Confidence threshold')
+    batch_parser.add_argument('--batch-size', type=int, default=DETECT_BATCH_SIZE, help='Images per model pass')
+    batch_parser.add_argument('--checkpoint-every', type=int, help='Images between checkpoints (default: 8 batches)')
+    batch_parser.add_argument('--recursive', action='store_true', help='Descend into subdirectories')
+    batch_parser.add_argument('--restart', action='store_true', help='Ignore the checkpoint and start over')
+    
+    parity_parser = subparsers.add_parser('backend-parity', help='Compare an exported backend against PyTorch (accuracy and latency)')
+    parity_parser.add_argument('inputs', nargs='+', help='Image files, directories or glob patterns')
+    parity_parser.add_argument('--backend', choices=[name for name in INFERENCE_BACKENDS if name != 'torch'],
+                               default='onnx', help='Exported backend to check')
+    parity_parser.add_argument('--precision', default='fp32', help='fp32, fp16 (openvino) or int8')
+    parity_parser.add_argument('--confidence', type=float, default=0.60, help='Confidence threshold')
+    parity_parser.add_argument('--limit', type=int, default=20, help='Maximum images to compare')
+    parity_parser.add_argument('--repeats', type=int, default=3, help='Timed passes per image and model')
+    parity_parser.add_argument('--iou', type=float, default=0.5, help='IoU to consider two boxes the same slab')
+    parity_parser.add_argument('--min-match', type=float, default=0.98, help='Fail (exit 1) below this box match rate')
+    
     args = parser.parse_args()
     
+    if args.command == 'backend-parity':
+        image_paths = collect_batch_inputs(args.inputs)[:args.limit]
+        print(f"⚖️ Paridad {args.backend}-{args.precision} vs PyTorch en {len(image_paths)} imágenes")
+        summary = compare_backends(image_paths, args.backend, args.precision, args.confidence, args.repeats, args.iou)
+        if not summary['images']:
+            print("❌ No hay imágenes válidas para comparar")
+            raise SystemExit(1)
+        print(f"📊 Cajas emparejadas: {summary['match_rate']:.1%} · mismo conteo: {summary['same_count_rate']:.1%} · "
+              f"máx. Δconfianza: {summary['max_conf_diff']:.4f}")
+        print(f"⏱️ PyTorch {summary['reference_ms']:.1f}ms → {summary['backend']} {summary['candidate_ms']:.1f}ms "
+              f"(x{summary['speedup']:.2f})")
+        raise SystemExit(0 if summary['match_rate'] >= args.min_match else 1)
+    
+    if args.command == 'batch':
+        startup.run(load_and_warm_model)
+        if not startup.ready:
+            raise SystemExit(1)
+        image_paths = collect_batch_inputs(args.inputs, args.recursive)
+        formato = args.formato or ('csv' if args.output.lower().endswith('.csv') else 'jsonl')
+        print(f"🗂️ {len(image_paths)} imágenes encontradas → {args.output} ({formato})")
+        summary = run_batch(image_paths, args.output, formato, args.confidence, args.batch_size,
+                            args.checkpoint_every, resume=not args.restart)
+        print(f"✅ {summary['images']} imágenes en {summary['seconds']}s ({summary['images_per_second']} img/s), "
+              f"{summary['slabs']} palanquillas, {summary['errors']} errores, {summary['skipped']} ya procesadas")
+        raise SystemExit(0)
+    
+    if args.command == 'migrate-json':
+        imported = store.migrate_from_json([args.source] if args.source else None)
+        print(f"✅ {imported} imágenes importadas en {STORE_FILE}")
+        raise SystemExit(0)
+    
+    if args.command == 'export':
+        output = args.output or os.path.join(EXPORTS_FOLDER, export_filename(args.dataset, args.formato, args.desde, args.hasta))
+        started = time.perf_counter()
+        rows = export_dataset(args.dataset, args.formato, output, args.desde, args.hasta, args.chunk_rows)
+        print(f"✅ {rows} filas exportadas a {output} ({os.path.getsize(output) / 1024:.1f} KB, "
+              f"{time.perf_counter() - started:.2f}s)")
+        raise SystemExit(0)
+    
+    if args.command == 'bench-points':
+        point_counts = [int(value) for value in args.points.split(',') if value.strip()]
+        benchmark_points_encoding(point_counts, repeats=args.repeats)
+        raise SystemExit(0)
+    
+    if args.command == 'bench-postprocess':
+        box_counts = [int(value) for value in args.boxes.split(',') if value.strip()]
+        benchmark_postprocess(box_counts, repeats=args.repeats, device=args.device)
+        raise SystemExit(0)
+    
     port = args.port
+    # Con debug=True el proceso que lanza el script solo vigila archivos (reloader);
+    # el que atiende peticiones es el hijo con WERKZEUG_RUN_MAIN=true
+    serving_process = os.environ.get('WERKZEUG_RUN_MAIN') == 'true'
     
     print("\n" + "="*60)
     print("🔍 BASIC SLAB DETECTOR V10 - Versión Optimizada y Limpia")
@@ -1309,15 +6069,12 @@ if __name__ == '__main__':
     print("📊 Inicializando base de datos CSV...")
     inicializar_base_datos()
     
-    # OPTIMIZAR PERSISTENCIA AL INICIO
-    print("🔧 Optimizando archivo de persistencia...")
-    optimize_success = optimize_persistent_data()
-    if optimize_success:
-        print("✅ Persistencia optimizada exitosamente")
-    else:
-        print("⚠️ Advertencia: No se pudo optimizar la persistencia")
     print(f"📁 Modelo: {detector.model_path}")
-    print(f"🤖 Estado del modelo: {'✅ Cargado' if detector.model else '❌ Error'}")
+    if serving_process:
+        # El modelo se carga y calienta mientras el servidor ya atiende (/health, /ready)
+        startup.start(load_and_warm_model)
+        mode = f"🧩 Pool de {DETECTOR_POOL_WORKERS} procesos" if DETECTOR_POOL_WORKERS > 0 else "proceso web"
+        print(f"🤖 Estado del modelo: ⏳ Cargando en segundo plano ({mode}); ver /ready")
     print(f"📂 Carpeta uploads: {UPLOAD_FOLDER}")
     print("="*60)
     print("🌐 ACCESO AL SERVIDOR:")
@@ -1333,23 +6090,24 @@ if __name__ == '__main__':
     print("🛑 Presiona CTRL+C para detener el servidor")
     print("="*60)
     
-    # Inicializar sistema de persistencia robusta
-    print("🔧 Inicializando sistema de persistencia robusto...")
-    try:
-        # Verificar y optimizar datos existentes
-        if os.path.exists(PERSISTENCE_FILE):
-            file_size = os.path.getsize(PERSISTENCE_FILE)
-            if file_size > 500000:  # Si es mayor a 500KB, optimizar
-                print(f"⚠️ Archivo grande detectado ({file_size} bytes), optimizando...")
-                optimize_persistent_data()
-        
-        # Crear respaldo inicial
-        create_backup_if_needed()
-        
-        # Verificar integridad de datos
-        test_data = load_persistent_data()
-        print(f"✅ Sistema de persistencia inicializado: {len(test_data.get('images', []))} imágenes")
-    except Exception as e:
-        print(f"⚠️ Error inicializando persistencia: {e}")
+    def persistence_maintenance():
+        """Respaldo inicial y optimización, fuera del camino crítico del arranque"""
+        print("🔧 Inicializando sistema de persistencia robusto...")
+        try:
+            # Crear respaldo inicial
+            create_backup_if_needed()
+            
+            # Cargar el estado en memoria una sola vez al arrancar
+            print(f"✅ Sistema de persistencia inicializado: {state_cache.count()} imágenes en {STORE_FILE}")
+            if not optimize_persistent_data():
+                print("⚠️ Advertencia: No se pudo optimizar la persistencia")
+        except Exception as e:
+            print(f"⚠️ Error inicializando persistencia: {e}")
+    
+    if serving_process:
+        threading.Thread(target=persistence_maintenance, name='persistence-maintenance', daemon=True).start()
+    
+    # SIGTERM (docker stop) debe pasar por atexit para escribir los cambios pendientes
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
     
     app.run(host='0.0.0.0', port=port, debug=True)
\ No newline at end of file
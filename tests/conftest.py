@@ -0,0 +1,9 @@
+import os
+import sys
+import tempfile
+
+# El módulo crea uploads/, data/, database/... relativos al directorio actual al importarse:
+# las pruebas trabajan en una carpeta temporal para no tocar los datos reales
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+os.chdir(tempfile.mkdtemp(prefix='slab-tests-'))
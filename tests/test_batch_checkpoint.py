@@ -0,0 +1,84 @@
+import csv
+import json
+
+import pytest
+
+import basic_slab_v11 as slab
+
+IMAGES = [f"img{i:02d}.jpg" for i in range(10)]
+
+
+@pytest.fixture
+def calls(monkeypatch):
+    """Imágenes que llegan al detector, en orden (el detector es falso)"""
+    seen = []
+
+    def detect_slabs_batch(image_paths, confidence, batch_size, log=True):
+        seen.extend(image_paths)
+        return [([{'confidence': 0.8}, {'confidence': 0.6}], None) for _ in image_paths]
+
+    monkeypatch.setattr(slab.detector, 'detect_slabs_batch', detect_slabs_batch)
+    return seen
+
+
+def run(output, images=IMAGES, formato='jsonl'):
+    return slab.run_batch(images, str(output), formato, batch_size=2, checkpoint_every=2)
+
+
+def output_images(output, formato='jsonl'):
+    with open(output, encoding='utf-8', newline='') as f:
+        if formato == 'csv':
+            return [row['image'] for row in csv.DictReader(f)]
+        return [json.loads(line)['image'] for line in f]
+
+
+@pytest.mark.parametrize('formato', ['jsonl', 'csv'])
+def test_resume_skips_finished_images(tmp_path, calls, formato):
+    output = tmp_path / f"salida.{formato}"
+    assert run(output, IMAGES[:6], formato)['images'] == 6
+    calls.clear()
+
+    summary = run(output, formato=formato)
+    assert summary['skipped'] == 6
+    assert calls == IMAGES[6:]
+    assert output_images(output, formato) == IMAGES
+
+
+def test_writes_after_the_last_checkpoint_are_discarded(tmp_path, calls):
+    output = tmp_path / 'salida.jsonl'
+    run(output, IMAGES[:4])
+    with open(output, 'a', encoding='utf-8') as f:
+        f.write('{"image": "img04.jpg", "count"')  # Corte a mitad de un bloque
+    calls.clear()
+
+    run(output)
+    assert calls == IMAGES[4:]
+    assert output_images(output) == IMAGES
+
+
+@pytest.mark.parametrize('damage', ['delete', 'truncate', 'replace'])
+def test_output_that_disagrees_with_checkpoint_restarts(tmp_path, calls, damage):
+    output = tmp_path / 'salida.jsonl'
+    run(output, IMAGES[:6])
+    if damage == 'delete':
+        output.unlink()
+    elif damage == 'truncate':
+        with open(output, 'r+b') as f:
+            f.truncate(40)
+    else:
+        output.write_text(open(output, encoding='utf-8').read().replace('img00', 'zzz00'), encoding='utf-8')
+    calls.clear()
+
+    summary = run(output)
+    assert summary['skipped'] == 0
+    assert calls == IMAGES
+    assert output_images(output) == IMAGES
+
+
+def test_no_resume_starts_over(tmp_path, calls):
+    output = tmp_path / 'salida.jsonl'
+    run(output, IMAGES[:4])
+    calls.clear()
+    slab.run_batch(IMAGES, str(output), batch_size=2, checkpoint_every=2, resume=False)
+    assert calls == IMAGES
+    assert output_images(output) == IMAGES
@@ -0,0 +1,89 @@
+import hashlib
+import os
+import threading
+
+import pytest
+
+import basic_slab_v11 as slab
+
+CHUNK = 1024
+
+
+@pytest.fixture
+def client(monkeypatch):
+    monkeypatch.setattr(slab, 'schedule_upload_preprocess', lambda *args, **kwargs: None)
+    return slab.app.test_client()
+
+
+@pytest.fixture
+def payload():
+    return os.urandom(CHUNK * 3 + 100)
+
+
+def start(client, payload, **extra):
+    response = client.post('/uploads', json={'filename': 'foto.jpg', 'size': len(payload),
+                                             'chunk_size': CHUNK, **extra})
+    assert response.status_code == 201
+    return response.get_json()['upload']['upload_id']
+
+
+def put_chunk(client, upload_id, payload, index, checksum=None):
+    chunk = payload[index * CHUNK:(index + 1) * CHUNK]
+    return client.put(f'/uploads/{upload_id}/chunks/{index}', data=chunk,
+                      headers={'X-Chunk-SHA256': checksum or hashlib.sha256(chunk).hexdigest()})
+
+
+def test_resume_after_checksum_mismatch(client, payload):
+    upload_id = start(client, payload, sha256=hashlib.sha256(payload).hexdigest())
+    assert put_chunk(client, upload_id, payload, 0).status_code == 200
+    assert put_chunk(client, upload_id, payload, 2, checksum='0' * 64).status_code == 422
+
+    # Tras el corte el cliente pregunta qué falta y reenvía solo eso
+    status = client.get(f'/uploads/{upload_id}').get_json()['upload']
+    assert status['received'] == [0]
+    assert status['missing'] == 3
+    assert client.post(f'/uploads/{upload_id}/complete').status_code == 409
+
+    for index in (3, 1, 2):
+        assert put_chunk(client, upload_id, payload, index).status_code == 200
+    response = client.post(f'/uploads/{upload_id}/complete')
+    assert response.status_code == 200
+    record = slab.store.get_upload(hashlib.sha256(payload).hexdigest())
+    with open(record['path'], 'rb') as f:
+        assert f.read() == payload
+
+
+def test_crc32_mismatch_is_rejected(client, payload):
+    upload_id = start(client, payload)
+    chunk = payload[:CHUNK]
+    response = client.put(f'/uploads/{upload_id}/chunks/0', data=chunk, headers={'X-Chunk-CRC32': 'deadbeef'})
+    assert response.status_code == 422
+    assert client.get(f'/uploads/{upload_id}').get_json()['upload']['received'] == []
+
+
+def test_declared_hash_mismatch_keeps_the_session(client, payload):
+    upload_id = start(client, payload, sha256='f' * 64)
+    for index in range(4):
+        put_chunk(client, upload_id, payload, index)
+    assert client.post(f'/uploads/{upload_id}/complete').status_code == 422
+    assert client.get(f'/uploads/{upload_id}').status_code == 200
+
+
+def test_concurrent_completes_return_the_same_upload(client, payload):
+    upload_id = start(client, payload)
+    for index in range(4):
+        put_chunk(client, upload_id, payload, index)
+
+    responses = []
+
+    def complete():
+        response = slab.app.test_client().post(f'/uploads/{upload_id}/complete')
+        responses.append((response.status_code, response.get_json()))
+
+    threads = [threading.Thread(target=complete) for _ in range(3)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert [status for status, _ in responses] == [200, 200, 200]
+    assert len({body['content_id'] for _, body in responses}) == 1
@@ -0,0 +1,74 @@
+import numpy as np
+
+import basic_slab_v11 as slab
+
+
+def boxes(count, score=0.9):
+    xyxy = np.array([[i, i, i + 10, i + 10] for i in range(count)], dtype=np.float32)
+    return xyxy, np.full(count, score, dtype=np.float32)
+
+
+def test_lru_evicts_least_recently_used():
+    cache = slab.DetectionCache(max_entries=2)
+    cache.put(('a', 'm'), *boxes(1))
+    cache.put(('b', 'm'), *boxes(1))
+    assert cache.get(('a', 'm')) is not None  # 'a' pasa a ser el más reciente
+    cache.put(('c', 'm'), *boxes(1))
+    assert cache.get(('b', 'm')) is None
+    assert cache.get(('a', 'm')) is not None
+    assert cache.status()['evictions'] == 1
+
+
+def test_byte_limit_evicts_entries():
+    xyxy, conf = boxes(10)
+    cache = slab.DetectionCache(max_entries=100, max_bytes=(xyxy.nbytes + conf.nbytes) * 2)
+    for name in 'abc':
+        cache.put((name, 'm'), xyxy, conf)
+    status = cache.status()
+    assert status['entries'] == 2
+    assert status['bytes'] <= status['max_bytes']
+
+
+def test_entries_survive_restart_on_disk(tmp_path):
+    folder = str(tmp_path / 'cache')
+    xyxy, conf = boxes(3, score=0.7)
+    slab.DetectionCache(folder=folder).put(('img', 'model_r2'), xyxy, conf)
+
+    reloaded = slab.DetectionCache(folder=folder)
+    stored_xyxy, stored_conf = reloaded.get(('img', 'model_r2'))
+    np.testing.assert_array_equal(stored_xyxy, xyxy)
+    np.testing.assert_array_equal(stored_conf, conf)
+    assert reloaded.status()['disk_hits'] == 1
+
+    reloaded.clear()
+    assert slab.DetectionCache(folder=folder).get(('img', 'model_r2')) is None
+
+
+def test_probe_without_recording_a_miss():
+    cache = slab.DetectionCache()
+    assert cache.get(('x', 'm'), record_miss=False) is None
+    assert cache.status()['misses'] == 0
+    assert cache.get(('x', 'm')) is None
+    assert cache.status()['misses'] == 1
+
+
+def test_cached_boxes_are_refiltered_by_confidence():
+    cache = slab.DetectionCache()
+    xyxy = np.array([[0, 0, 10, 10], [20, 20, 40, 40]], dtype=np.float32)
+    cache.put(('img', 'm'), xyxy, [0.9, 0.4])
+    cached = cache.get(('img', 'm'))
+    assert len(slab.BasicSlabDetector._extract_detections(*cached, 0.3, log=False)) == 2
+    detections = slab.BasicSlabDetector._extract_detections(*cached, 0.6, log=False)
+    assert len(detections) == 1
+    assert (detections[0]['x'], detections[0]['y']) == (5, 5)
+
+
+def test_reduced_decodes_get_their_own_key(tmp_path, monkeypatch):
+    image = tmp_path / 'img.jpg'
+    image.write_bytes(b'contenido')
+    monkeypatch.setattr(slab.detector, 'cache', slab.DetectionCache())
+    monkeypatch.setattr(slab.detector, 'get_model_hash', lambda: 'modelo')
+    full = slab.detector._cache_key(str(image))
+    reduced = slab.detector._cache_key(str(image), 4)
+    assert full[0] == reduced[0]
+    assert (full[1], reduced[1]) == ('modelo', 'modelo_r4')
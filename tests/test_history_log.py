@@ -0,0 +1,92 @@
+import threading
+
+import pytest
+
+import basic_slab_v11 as slab
+
+
+def make_log(tmp_path):
+    csv_path = tmp_path / 'historico.csv'
+    if not csv_path.exists():
+        csv_path.write_text('fecha,nombre_imagen,numero_lote,cantidad_slabs\r\n', encoding='utf-8')
+    return slab.HistoryLog(str(csv_path), str(tmp_path / 'historico.journal'), threading.RLock(),
+                           compact_ops=10_000, compact_interval=3600)
+
+
+def registro(fecha, imagen, lote, slabs):
+    return {'fecha': fecha, 'nombre_imagen': imagen, 'numero_lote': lote, 'cantidad_slabs': slabs}
+
+
+@pytest.fixture
+def log(tmp_path):
+    log = make_log(tmp_path)
+    log.append([
+        registro('2025-08-06 09:10:00', 'a.jpg', '1', 10),
+        registro('2025-08-06 09:40:00', 'b.jpg', '2', 5),
+        registro('2025-08-06 14:00:00', 'c.jpg', '1', 7),
+        registro('2025-08-07 08:00:00', 'd.jpg', '3', 4),
+    ])
+    return log
+
+
+def test_rollups_follow_appends_updates_and_deletes(log):
+    assert log.totals('dia') == [('2025-08-06', 22, 3), ('2025-08-07', 4, 1)]
+    assert log.totals('hora', desde='2025-08-06', hasta='2025-08-06') == [
+        ('2025-08-06 09', 15, 2), ('2025-08-06 14', 7, 1)]
+    assert log.lot_totals(hasta='2025-08-06') == {'1': [17, 2], '2': [5, 1]}
+
+    assert log.update(1, {'cantidad_slabs': 8, 'numero_lote': '1'})
+    assert log.delete([2]) == 1
+    assert log.totals('dia') == [('2025-08-06', 18, 2), ('2025-08-07', 4, 1)]
+    assert log.lot_totals(hasta='2025-08-06') == {'1': [18, 2]}
+
+    log.delete([3])
+    assert log.totals('dia') == [('2025-08-06', 18, 2)]
+    assert log.lot_totals(desde='2025-08-07') == {}
+
+
+def test_journal_is_replayed_on_reload(tmp_path, log):
+    log.update(0, {'cantidad_slabs': 11})
+    log.delete([1])
+    reloaded = make_log(tmp_path)
+    assert [r['nombre_imagen'] for r in reloaded.records()] == ['a.jpg', 'c.jpg', 'd.jpg']
+    assert reloaded.get(0)['cantidad_slabs'] == '11'
+    assert reloaded.totals('dia') == log.totals('dia')
+
+
+def test_compaction_drops_dead_rows_and_keeps_rollups(tmp_path, log):
+    log.delete([0, 2])
+    before = (log.records(), log.totals('hora'), log.lot_totals())
+    assert log.compact() == 2
+    assert log.status()['rows_in_file'] == 2
+    assert log.status()['journal_ops'] == 0
+    assert (log.records(), log.totals('hora'), log.lot_totals()) == before
+    assert log.compact() == 0
+
+    reloaded = make_log(tmp_path)
+    assert (reloaded.records(), reloaded.totals('hora'), reloaded.lot_totals()) == before
+
+
+def test_cursor_from_before_compaction_is_rejected(log):
+    generation, rows = log.query()
+    last_id, last = list(rows)[1]
+    log.delete([0])
+    log.compact()
+    with pytest.raises(slab.HistoryCursorError):
+        log.query(after=(last['fecha'], last_id, generation))
+
+
+def test_interrupted_compaction_is_not_replayed(tmp_path, log, monkeypatch):
+    log.delete([0])
+
+    def crash(csv_bytes):
+        raise OSError('corte de energía')
+
+    monkeypatch.setattr(log, '_write_journal_header', crash)
+    with pytest.raises(OSError):
+        log.compact()
+
+    # El CSV ya es el compactado: el diario anterior (que borraba la fila 0) no debe volver a aplicarse
+    reloaded = make_log(tmp_path)
+    assert [r['nombre_imagen'] for r in reloaded.records()] == ['b.jpg', 'c.jpg', 'd.jpg']
+    assert reloaded.totals('dia') == [('2025-08-06', 12, 2), ('2025-08-07', 4, 1)]
@@ -0,0 +1,78 @@
+import itertools
+
+import pytest
+
+import basic_slab_v11 as slab
+
+_names = itertools.count()
+
+
+@pytest.fixture
+def image_name():
+    """Imagen guardada en revisión 1 con dos puntos y un lote"""
+    name = f"ops_{next(_names)}.jpg"
+    revision = slab.save_image_data({
+        'name': name,
+        'status': 'detected',
+        'manualPoints': [
+            {'id': 1, 'x': 10, 'y': 10, 'confidence': 0.9, 'isOriginal': True, 'batchNumber': 1},
+            {'id': 2, 'x': 20, 'y': 20, 'confidence': 0.8, 'isOriginal': True, 'batchNumber': None},
+        ],
+        'batches': [{'id': 100, 'number': 1, 'points': [1]}],
+        'nextPointId': 3,
+    })
+    assert revision == 1
+    return name
+
+
+def test_ops_are_applied_and_bump_revision(image_name):
+    record, error = slab.apply_image_ops(image_name, 1, [
+        {'op': 'add_point', 'point': {'x': 30, 'y': 30}},
+        {'op': 'move_point', 'id': 2, 'x': 25, 'y': 26},
+        {'op': 'assign_point', 'id': 2, 'batch': 1},
+    ])
+    assert error is None
+    assert record['revision'] == 2
+    assert record['nextPointId'] == 4
+    points = {point['id']: point for point in record['manualPoints']}
+    assert (points[2]['x'], points[2]['y'], points[2]['batchNumber']) == (25, 26, 1)
+    assert points[3]['batchNumber'] is None
+    assert record['batches'][0]['points'] == [1, 2]
+    assert slab.find_image_data_by_name(image_name)['revision'] == 2
+
+
+def test_invalid_op_rejects_the_whole_list(image_name):
+    before = slab.find_image_data_by_name(image_name)
+    record, error = slab.apply_image_ops(image_name, 1, [
+        {'op': 'add_point', 'point': {'x': 30, 'y': 30}},
+        {'op': 'delete_point', 'id': 999},
+    ])
+    assert record is None
+    assert error[1] == 400
+    after = slab.find_image_data_by_name(image_name)
+    assert after['revision'] == 1
+    assert after['manualPoints'] == before['manualPoints']
+    assert after['batches'] == before['batches']
+
+
+def test_unknown_op_is_rejected(image_name):
+    record, error = slab.apply_image_ops(image_name, 1, [{'op': 'explode'}])
+    assert record is None
+    assert error[1] == 400
+
+
+def test_stale_revision_returns_409(image_name):
+    assert slab.apply_image_ops(image_name, 1, [{'op': 'delete_point', 'id': 2}])[1] is None
+    record, error = slab.apply_image_ops(image_name, 1, [{'op': 'delete_point', 'id': 1}])
+    assert record is None
+    assert error[1] == 409
+    assert len(slab.find_image_data_by_name(image_name)['manualPoints']) == 1
+
+
+def test_stale_full_save_is_rejected(image_name):
+    assert slab.apply_image_ops(image_name, 1, [{'op': 'add_point', 'point': {'x': 5, 'y': 5}}])[1] is None
+    with pytest.raises(slab.RevisionConflictError) as conflict:
+        slab.save_image_data({'name': image_name, 'manualPoints': []}, base_revision=1)
+    assert conflict.value.revision == 2
+    assert len(slab.find_image_data_by_name(image_name)['manualPoints']) == 3
+    assert slab.save_image_data({'name': image_name, 'manualPoints': []}, base_revision=2) == 3
@@ -0,0 +1,80 @@
+import json
+import sqlite3
+
+import pytest
+
+import basic_slab_v11 as slab
+
+
+def test_round_trip_keeps_points_and_extra_keys():
+    points = [
+        {'id': 1, 'x': 10, 'y': 11, 'confidence': 0.912345, 'isOriginal': True, 'batchNumber': 2,
+         'isSelected': True},
+        {'id': 2, 'x': 20, 'y': 21, 'confidence': 1.0, 'isOriginal': False, 'batchNumber': None,
+         'label': 'dudoso'},
+    ]
+    encoded = slab.encode_points(points)
+    assert encoded['format'] == slab.POINTS_FORMAT
+    assert encoded['count'] == 2
+    assert encoded['isOriginal'] == [1, 0]
+    assert encoded['extra'] == {'1': {'label': 'dudoso'}}
+
+    decoded = slab.decode_points(json.loads(json.dumps(encoded)))
+    assert decoded == [
+        {'id': 1, 'x': 10, 'y': 11, 'confidence': 0.912345, 'isOriginal': True, 'batchNumber': 2},
+        {'id': 2, 'x': 20, 'y': 21, 'confidence': 1.0, 'isOriginal': False, 'batchNumber': None,
+         'label': 'dudoso'},
+    ]
+
+
+def test_all_null_columns_are_omitted():
+    encoded = slab.encode_points([{'id': 1, 'x': 1, 'y': 2}, {'id': 2, 'x': 3, 'y': 4}])
+    assert set(encoded) == {'format', 'count', 'id', 'x', 'y'}
+    assert slab.decode_points(encoded) == [{'id': 1, 'x': 1, 'y': 2}, {'id': 2, 'x': 3, 'y': 4}]
+
+
+def test_missing_keys_stay_missing():
+    points = [
+        {'id': 1, 'x': 1, 'y': 1, 'confidence': None, 'batchNumber': 3},
+        {'id': 2, 'x': 2, 'y': 2, 'isOriginal': False},
+    ]
+    encoded = slab.encode_points(points)
+    assert encoded['absent'] == {'confidence': [1], 'isOriginal': [0], 'batchNumber': [1]}
+    assert slab.decode_points(json.loads(json.dumps(encoded))) == points
+
+
+def test_legacy_columnar_rows_are_still_readable():
+    legacy = {'format': slab.LEGACY_POINTS_FORMAT, 'count': 2, 'id': [1, 2], 'x': [1, 2], 'y': [1, 2],
+              'confidence': [0.5, None]}
+    assert slab.decode_points(legacy) == [
+        {'id': 1, 'x': 1, 'y': 1, 'confidence': 0.5, 'batchNumber': None},
+        {'id': 2, 'x': 2, 'y': 2, 'batchNumber': None},
+    ]
+
+
+def test_decode_accepts_lists_and_rejects_unknown_formats():
+    points = [{'id': 1, 'x': 1, 'y': 1}]
+    assert slab.decode_points(points) is points
+    assert slab.decode_points(None) == []
+    with pytest.raises(ValueError):
+        slab.decode_points({'format': 'columnar-99', 'count': 0})
+
+
+def test_store_upgrades_list_rows_to_columnar(tmp_path):
+    path = str(tmp_path / 'store.db')
+    points = [{'id': 1, 'x': 5, 'y': 6, 'confidence': 0.876543219, 'isOriginal': True, 'batchNumber': None}]
+    conn = sqlite3.connect(path)
+    conn.executescript(slab.SlabStore.SCHEMA)
+    conn.execute("INSERT INTO images (name, status, data) VALUES (?, ?, ?)",
+                 ('old.jpg', 'detected', json.dumps({'name': 'old.jpg', 'manualPoints': points})))
+    conn.execute("INSERT INTO meta (key, value) VALUES ('_migrated_from_json', 'true')")
+    conn.commit()
+    conn.close()
+
+    store = slab.SlabStore(path, str(tmp_path / 'backup.db'))
+    assert store.get_image('old.jpg')['manualPoints'] == points
+    assert store.get_meta('_points_format') == slab.POINTS_FORMAT
+
+    raw = json.loads(sqlite3.connect(path).execute("SELECT data FROM images").fetchone()[0])
+    assert raw['manualPoints']['format'] == slab.POINTS_FORMAT
+    assert slab.decode_points(raw['manualPoints']) == points
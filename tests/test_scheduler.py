@@ -0,0 +1,95 @@
+import threading
+import time
+
+import pytest
+
+import basic_slab_v11 as slab
+
+
+class FakeDetector:
+    """Detector falso que registra los lotes y cuántos corren a la vez"""
+
+    def __init__(self, delay=0.05):
+        self.delay = delay
+        self.batches = []
+        self.active = 0
+        self.max_active = 0
+        self._lock = threading.Lock()
+
+    def detect_slabs_batch(self, image_paths, confidences, batch_size):
+        with self._lock:
+            self.active += 1
+            self.max_active = max(self.max_active, self.active)
+            self.batches.append(list(image_paths))
+        time.sleep(self.delay)
+        with self._lock:
+            self.active -= 1
+        return [([{'path': path, 'confidence': conf}], None) for path, conf in zip(image_paths, confidences)]
+
+
+def run_concurrently(scheduler, count, confidence=0.5):
+    results = [None] * count
+
+    def submit(index):
+        results[index] = scheduler.detect(f"img{index}.jpg", confidence, timeout=10)
+
+    threads = [threading.Thread(target=submit, args=(index,)) for index in range(count)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return results
+
+
+def test_without_pool_uses_a_single_thread(monkeypatch):
+    monkeypatch.setattr(slab, 'DETECTOR_POOL_WORKERS', 0)
+    monkeypatch.setattr(slab, 'INFERENCE_WORKERS', 4)
+    assert slab.inference_worker_threads() == 1
+
+
+def test_with_pool_uses_one_thread_per_process(monkeypatch):
+    monkeypatch.setattr(slab, 'DETECTOR_POOL_WORKERS', 3)
+    monkeypatch.setattr(slab, 'INFERENCE_WORKERS', 0)
+    assert slab.inference_worker_threads() == 3
+    monkeypatch.setattr(slab, 'INFERENCE_WORKERS', 2)
+    assert slab.inference_worker_threads() == 2
+
+
+def test_single_thread_never_overlaps_model_calls():
+    detector = FakeDetector()
+    scheduler = slab.InferenceScheduler(detector, workers=1, batch_window_ms=0, max_batch=1)
+    results = run_concurrently(scheduler, 6)
+    assert detector.max_active == 1
+    assert [detections[0]['path'] for detections, _ in results] == [f"img{i}.jpg" for i in range(6)]
+
+
+def test_pool_mode_runs_batches_in_parallel():
+    detector = FakeDetector(delay=0.2)
+    scheduler = slab.InferenceScheduler(detector, workers=3, batch_window_ms=0, max_batch=1)
+    run_concurrently(scheduler, 3)
+    assert detector.max_active > 1
+
+
+def test_requests_in_the_window_share_a_batch():
+    detector = FakeDetector()
+    scheduler = slab.InferenceScheduler(detector, workers=1, batch_window_ms=200, max_batch=8)
+    results = run_concurrently(scheduler, 4)
+    assert sorted(len(batch) for batch in detector.batches) == [4]
+    assert all(error is None for _, error in results)
+    assert scheduler.status()['batches'] == 1
+
+
+def test_full_queue_is_rejected():
+    gate = threading.Event()
+    scheduler = slab.InferenceScheduler(FakeDetector(), queue_size=1, workers=1)
+    blocker = threading.Thread(target=lambda: scheduler.run(gate.wait, timeout=10))
+    blocker.start()
+    time.sleep(0.1)  # El hilo del modelo ya tomó la tarea bloqueante
+    queued = threading.Thread(target=lambda: scheduler.run(lambda: None, timeout=10))
+    queued.start()
+    time.sleep(0.1)
+    with pytest.raises(slab.SchedulerFullError):
+        scheduler.run(lambda: None, timeout=1)
+    gate.set()
+    blocker.join()
+    queued.join()